@@ -1,19 +1,90 @@
-from flask import Flask, jsonify, render_template, request, redirect, url_for, flash, send_file
+from flask import Flask, current_app, jsonify, render_template, request, redirect, url_for, flash, send_file, g, has_request_context, \
+    Response, stream_with_context, stream_template
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
+from collections import Counter
+from contextlib import contextmanager, suppress
+from functools import lru_cache
+import atexit
+import click
+from concurrent.futures import ProcessPoolExecutor
 import csv
+import hashlib
+import hmac
 import io
+import json
+import math
+import logging
 import os
+import queue
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
 from fpdf import FPDF
+try:
+    import brotli
+except ImportError:  # optional; responses fall back to gzip
+    brotli = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///inventory.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///inventory.db')
 app.config['JSON_AS_ASCII'] = False
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
-db = SQLAlchemy(app)
+# Request profiling is opt-in; a query budget makes over-budget routes fail under TESTING
+app.config['SQL_PROFILING'] = os.environ.get('SQL_PROFILING') == '1'
+app.config['SQL_QUERY_BUDGET'] = None
+# Budgets per endpoint, over the route's own @query_budget and SQL_QUERY_BUDGET
+app.config['SQL_QUERY_BUDGETS'] = {}
+app.config['SLOW_REQUEST_MS'] = 500
+app.config['N_PLUS_ONE_THRESHOLD'] = 5
+# /metrics is open unless a bearer token is configured
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# Branch sync: changes are only logged when this copy has a branch id
+app.config['BRANCH_ID'] = os.environ.get('BRANCH_ID')
+app.config['SYNC_TOKEN'] = os.environ.get('SYNC_TOKEN')
+# Reports can read a periodically refreshed copy of the database instead of the live file
+app.config['REPORT_SNAPSHOT'] = os.environ.get('REPORT_SNAPSHOT') == '1'
+app.config['REPORT_SNAPSHOT_MAX_AGE'] = int(os.environ.get('REPORT_SNAPSHOT_MAX_AGE', 300))
+# Audit entries are written behind the requests, by default to <database>-audit.db next to a
+# SQLite database so they never wait for the sales' write lock; AUDIT_DATABASE=main keeps them inside it
+app.config['AUDIT_DATABASE'] = os.environ.get('AUDIT_DATABASE')
+app.config['AUDIT_QUEUE_SIZE'] = int(os.environ.get('AUDIT_QUEUE_SIZE', 10000))
+# Database maintenance (ANALYZE, incremental vacuum, WAL checkpoint); the
+# in-app scheduler runs it once a day within MAINTENANCE_HOURS (local, end exclusive)
+app.config['MAINTENANCE_SCHEDULE'] = os.environ.get('MAINTENANCE_SCHEDULE') == '1'
+app.config['MAINTENANCE_HOURS'] = os.environ.get('MAINTENANCE_HOURS', '2-5')
+# Maintenance is put off while more rows than this were written in the last few minutes
+app.config['MAINTENANCE_MAX_WRITES'] = int(os.environ.get('MAINTENANCE_MAX_WRITES', 20))
+# Text responses at least this big are sent gzip/brotli compressed
+app.config['COMPRESS_MIN_SIZE'] = 500
+# werkzeug hash method for passwords; stored hashes of another method are redone at login
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+# Seconds a worker reuses the logged-in user's id and role before reading them again; 0 disables
+app.config['AUTH_CACHE_TTL'] = int(os.environ.get('AUTH_CACHE_TTL', 300))
+
+class RoutingSession(FlaskSession):
+    """Sends the reads of reporting routes to the snapshot engine."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_request_context() \
+                and g.get('snapshot_engine') is not None:
+            return g.snapshot_engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
@@ -25,6 +96,8 @@ BACKUP_DIR = os.path.join(BASE_DIR, 'backups')
 # Configure upload and backup directories
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'static', 'uploads')
 BACKUP_FOLDER = os.path.join(BASE_DIR, 'backups')
+LOG_DIR = os.path.join(BASE_DIR, 'logs')
+METRICS_DIR = os.path.join(BASE_DIR, 'instance', 'metrics')
 os.makedirs(BACKUP_DIR, exist_ok=True)
 
 # Create necessary directories
@@ -44,10 +117,49 @@ def allowed_file(filename):
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
-    password = db.Column(db.String(120), nullable=False)
+    # A werkzeug hash; accounts from before hashing keep plaintext until they log in
+    password = db.Column(db.String(255), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
     role = db.Column(db.String(20), default='staff')  # 'owner', 'hr', 'staff'
 
+    def set_password(self, password):
+        self.password = generate_password_hash(password, method=app.config['PASSWORD_HASH_METHOD'])
+
+    def check_password(self, password):
+        """Whether password is right. A plaintext password or a hash made
+        with another method is rehashed on the way; the caller commits."""
+        method = self.password.split('$', 1)[0]
+        if self.password.count('$') == 2 and method.startswith(('scrypt:', 'pbkdf2:')):
+            valid = check_password_hash(self.password, password)
+        else:
+            valid = hmac.compare_digest(self.password.encode(), password.encode())
+            method = None
+        if valid and method != password_hash_prefix(app.config['PASSWORD_HASH_METHOD']):
+            self.set_password(password)
+        return valid
+
+@lru_cache()
+def password_hash_prefix(method):
+    """The method as written in its hashes, with the parameters werkzeug fills in."""
+    return generate_password_hash('', method=method).split('$', 1)[0]
+
+class Principal(UserMixin):
+    """The logged-in user as cached between requests: who it is and what it may do."""
+
+    def __init__(self, id, username, role, is_admin):
+        self.id = id
+        self.username = username
+        self.role = role
+        self.is_admin = bool(is_admin)
+
+# user id -> (Principal, monotonic expiry), per worker
+principal_cache = {}
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def forget_principal(mapper, connection, user):
+    principal_cache.pop(str(user.id), None)
+
 
 class Client(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -59,6 +171,14 @@ class Client(db.Model):
     invoices = db.relationship('Invoice', backref='client', lazy=True)
 
 class Invoice(db.Model):
+    __table_args__ = (
+        db.Index('ix_invoice_date_id', 'date', 'id'),
+        db.Index('ix_invoice_status_date_id', 'status', 'date', 'id'),
+        db.Index('ix_invoice_payment_method_date_id', 'payment_method', 'date', 'id'),
+        db.Index('ix_invoice_client_date_id', 'client_id', 'date', 'id'),
+        # Covers the receivables aging scan, which reads nothing else
+        db.Index('ix_invoice_aging', 'client_id', 'status', 'date', 'total_amount', 'paid_amount'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     invoice_number = db.Column(db.String(50), unique=True)
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'))    
@@ -67,18 +187,32 @@ class Invoice(db.Model):
     paid_amount = db.Column(db.Float, default=0.0)
     remaining_amount = db.Column(db.Float, default=0.0)
     payments = db.relationship('Payment', backref='invoice', lazy=True)
-    payment_method = db.Column(db.String(20))  # cash, visa, wallet
+    payment_method = db.Column(db.String(20))  # cash, visa, wallet, bank
     payment_status = db.Column(db.String(20))  # paid, partial, pending
     status = db.Column(db.String(20), default='pending')  # pending, paid, cancelled
     items = db.relationship('InvoiceItem', backref='invoice', lazy=True)
+    archived_items = db.relationship('InvoiceItemHistory', backref='invoice', lazy=True)
+    archived_payments = db.relationship('PaymentHistory', backref='invoice', lazy=True)
+
+    @property
+    def line_items(self):
+        return self.items + self.archived_items
+
+    @property
+    def all_payments(self):
+        return self.payments + self.archived_payments
 
 class Payment(db.Model):
+    __table_args__ = (
+        db.Index('ix_payment_invoice_id', 'invoice_id', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'))
     amount = db.Column(db.Float, nullable=False)
     payment_method = db.Column(db.String(20), nullable=False)
     payment_date = db.Column(db.DateTime, default=datetime.utcnow)
     notes = db.Column(db.Text)
+    reference = db.Column(db.String(100), index=True)  # bank/wallet transaction id of imported payments
 class Warehouse(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -87,15 +221,27 @@ class Warehouse(db.Model):
     items = db.relationship('InvoiceItem', back_populates='warehouse')
 
 class InvoiceItem(db.Model):
+    """An invoice line, and the sales fact the sales pages and reports read."""
+    __table_args__ = (
+        # Cover the date-range and per-product sales queries without touching the table
+        db.Index('ix_invoice_item_sale_date', 'sale_date', 'jeans_id', 'quantity', 'subtotal'),
+        db.Index('ix_invoice_item_jeans_sale_date', 'jeans_id', 'sale_date', 'quantity', 'subtotal'),
+        # Invoice lookups and the bought-together self-join, without touching the table
+        db.Index('ix_invoice_item_invoice_jeans', 'invoice_id', 'jeans_id', 'sale_date'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'))
     jeans_id = db.Column(db.Integer, db.ForeignKey('jeans.id'))
     warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'))  # Add this line
+    variant_id = db.Column(db.Integer, db.ForeignKey('jeans_variant.id'))
     quantity = db.Column(db.Integer)
     price = db.Column(db.Float)
     subtotal = db.Column(db.Float)
+    # When the line was first sold; cleared when its invoice is cancelled
+    sale_date = db.Column(db.DateTime, default=datetime.utcnow)
     jeans = db.relationship('Jeans', backref='invoice_items')
     warehouse = db.relationship('Warehouse', back_populates='items')
+    variant = db.relationship('JeansVariant')
 
 
 def admin_required(f):
@@ -122,10 +268,10 @@ def register():
         # Create new user if username is available
         new_user = User(
             username=username,
-            password=request.form['password'],
             role=request.form['role'],
             is_admin=request.form['role'] in ['owner', 'hr']
         )
+        new_user.set_password(request.form['password'])
         db.session.add(new_user)
         db.session.commit()
         flash(f'User {username} created successfully!')
@@ -135,14 +281,42 @@ def register():
 
 class JeansStock(db.Model):
     __tablename__ = 'jeans_stock'
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        db.Index('ix_jeans_stock_variant_warehouse', 'variant_id', 'warehouse_id'),
+        db.Index('ix_jeans_stock_warehouse_jeans', 'warehouse_id', 'jeans_id'),
+        {'extend_existing': True},
+    )
     id = db.Column(db.Integer, primary_key=True)
     jeans_id = db.Column(db.Integer, db.ForeignKey('jeans.id'))
     warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'))
+    # Empty for stock that is not broken down by size and color
+    variant_id = db.Column(db.Integer, db.ForeignKey('jeans_variant.id'))
     quantity = db.Column(db.Integer, default=0)
     warehouse = db.relationship('Warehouse', backref='jeans_stocks')
+    variant = db.relationship('JeansVariant', backref='stocks')
+
+class JeansVariant(db.Model):
+    """One size and color of a product."""
+    __tablename__ = 'jeans_variant'
+    __table_args__ = (
+        db.UniqueConstraint('jeans_id', 'size', 'color', name='uq_jeans_variant'),
+        db.Index('ix_jeans_variant_size_color', 'size', 'color'),
+        db.Index('ix_jeans_variant_color', 'color'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    jeans_id = db.Column(db.Integer, db.ForeignKey('jeans.id'), nullable=False)
+    size = db.Column(db.String(20), nullable=False)
+    color = db.Column(db.String(50), nullable=False)
+    jeans = db.relationship('Jeans', backref=db.backref('variants', order_by='JeansVariant.id'))
+
+    @property
+    def label(self):
+        return f'{self.size} / {self.color}'
 
 class Jeans(db.Model):
+    __table_args__ = (
+        db.Index('ix_jeans_name_id', 'name', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)  # اسم المنتج
     barcode = db.Column(db.String(50), unique=True)  # الكود
@@ -184,17 +358,689 @@ class Settings(db.Model):
     show_settings = db.Column(db.Boolean, default=True)
     sidebar_order = db.Column(db.String(500), default='dashboard,inventory,warehouses,sales,alerts,invoices,reports,debtors,clients')
 
-class Sale(db.Model):
+# History tables for closed periods, filled by archive_closed_periods().
+# They carry no relationships back to the hot tables' write paths, so the
+# hot tables stay small while old rows remain readable.
+class InvoiceItemHistory(db.Model):
+    __tablename__ = 'invoice_item_history'
+    __table_args__ = (
+        db.Index('ix_invoice_item_history_jeans_sale_date', 'jeans_id', 'sale_date'),
+    )
+    archived = True
     id = db.Column(db.Integer, primary_key=True)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), index=True)
     jeans_id = db.Column(db.Integer, db.ForeignKey('jeans.id'))
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'))
+    variant_id = db.Column(db.Integer, db.ForeignKey('jeans_variant.id'))
+    quantity = db.Column(db.Integer)
+    price = db.Column(db.Float)
+    subtotal = db.Column(db.Float)
+    sale_date = db.Column(db.DateTime)
+    jeans = db.relationship('Jeans')
+    warehouse = db.relationship('Warehouse')
+    variant = db.relationship('JeansVariant')
+
+class PaymentHistory(db.Model):
+    __tablename__ = 'payment_history'
+    archived = True
+    id = db.Column(db.Integer, primary_key=True)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), index=True)
+    amount = db.Column(db.Float, nullable=False)
+    payment_method = db.Column(db.String(20), nullable=False)
+    payment_date = db.Column(db.DateTime)
+    notes = db.Column(db.Text)
+    reference = db.Column(db.String(100), index=True)
+
+class SalesSummary(db.Model):
+    """Daily per-product totals of archived invoice lines, kept for reports."""
+    __tablename__ = 'sales_summary'
+    __table_args__ = (db.UniqueConstraint('day', 'jeans_id', name='uq_sales_summary_day_jeans'),)
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    jeans_id = db.Column(db.Integer)
+    sale_count = db.Column(db.Integer, default=0)
+    quantity = db.Column(db.Integer, default=0)
+    total_amount = db.Column(db.Float, default=0.0)
+
+class ChangeLog(db.Model):
+    """Row-level changes recorded for branch sync, numbered by seq in commit order."""
+    __tablename__ = 'change_log'
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(50), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(10), nullable=False)  # insert, update, delete
+    origin = db.Column(db.String(50), nullable=False)  # branch the change was made at
+    data = db.Column(db.Text)
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SyncKey(db.Model):
+    """Maps rows received from other branches to their local ids."""
+    __tablename__ = 'sync_key'
+    __table_args__ = (
+        db.UniqueConstraint('table_name', 'origin', 'origin_id', name='uq_sync_key_origin'),
+        db.Index('ix_sync_key_local', 'table_name', 'local_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(50), nullable=False)
+    local_id = db.Column(db.Integer, nullable=False)
+    origin = db.Column(db.String(50), nullable=False)
+    origin_id = db.Column(db.Integer, nullable=False)
+
+class SyncPeer(db.Model):
+    __tablename__ = 'sync_peer'
+    id = db.Column(db.Integer, primary_key=True)
+    branch_id = db.Column(db.String(50), unique=True, nullable=False)
+    url = db.Column(db.String(200))
+    last_pulled_seq = db.Column(db.Integer, default=0)  # their changes applied here
+    last_pushed_seq = db.Column(db.Integer, default=0)  # our changes they acknowledged
+    last_synced_at = db.Column(db.DateTime)
+
+class StockMovement(db.Model):
+    """Append-only ledger of every change to JeansStock.quantity."""
+    __tablename__ = 'stock_movement'
+    __table_args__ = (
+        db.Index('ix_stock_movement_stock_id', 'jeans_id', 'warehouse_id', 'id'),
+        db.Index('ix_stock_movement_created_at', 'created_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    jeans_id = db.Column(db.Integer, db.ForeignKey('jeans.id'), nullable=False)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), nullable=False)
+    variant_id = db.Column(db.Integer, db.ForeignKey('jeans_variant.id'))
+    movement_type = db.Column(db.String(20), nullable=False)  # receipt, sale, return, adjustment, sync
+    reference = db.Column(db.String(50))  # e.g. invoice:12
+    delta = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+class StockSnapshot(db.Model):
+    """On-hand stock of every product and warehouse as of one ledger position."""
+    __tablename__ = 'stock_snapshot'
+    id = db.Column(db.Integer, primary_key=True)
+    taken_at = db.Column(db.DateTime, nullable=False, index=True)
+    last_movement_id = db.Column(db.Integer, nullable=False, default=0)  # movements up to here are included
+
+class StockSnapshotLine(db.Model):
+    __tablename__ = 'stock_snapshot_line'
+    __table_args__ = (
+        db.Index('ix_stock_snapshot_line_snapshot_warehouse', 'snapshot_id', 'warehouse_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    snapshot_id = db.Column(db.Integer, db.ForeignKey('stock_snapshot.id'), nullable=False)
+    jeans_id = db.Column(db.Integer, nullable=False)
+    warehouse_id = db.Column(db.Integer, nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
-    sale_date = db.Column(db.DateTime, default=datetime.utcnow)
-    total_amount = db.Column(db.Float, nullable=False)
-    jeans = db.relationship('Jeans', backref='sales')
+
+class PriceHistory(db.Model):
+    """Every change to Jeans.price; invoice lines keep the price they were sold at."""
+    __tablename__ = 'price_history'
+    __table_args__ = (
+        db.Index('ix_price_history_jeans_changed_at', 'jeans_id', 'changed_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    jeans_id = db.Column(db.Integer, db.ForeignKey('jeans.id'), nullable=False)
+    old_price = db.Column(db.Float)
+    new_price = db.Column(db.Float, nullable=False)
+    reason = db.Column(db.String(200))  # the bulk rule, or empty for a single edit
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+class AuditEntry(db.Model):
+    """Who changed which stock, price, invoice or payment row, and how."""
+    __tablename__ = 'audit_log'
+    __table_args__ = (
+        db.Index('ix_audit_log_table_row', 'table_name', 'row_id', 'id'),
+        db.Index('ix_audit_log_username', 'username', 'id'),
+        db.Index('ix_audit_log_created_at', 'created_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    username = db.Column(db.String(80))  # empty for CLI jobs and sync
+    path = db.Column(db.String(200))
+    table_name = db.Column(db.String(50), nullable=False)
+    row_id = db.Column(db.Integer)  # empty for bulk statements without ids
+    operation = db.Column(db.String(20), nullable=False)  # insert, update, delete, bulk_update, bulk_delete
+    changes = db.Column(db.Text)  # JSON: {column: [old, new]}, or {'rows': n} for bulk statements
+
+class MaintenanceRun(db.Model):
+    """One database maintenance run, with the file's size before and after."""
+    __tablename__ = 'maintenance_run'
+    id = db.Column(db.Integer, primary_key=True)
+    started_at = db.Column(db.DateTime, nullable=False, index=True)
+    trigger = db.Column(db.String(20), nullable=False)  # cli, scheduler
+    status = db.Column(db.String(20), nullable=False)  # running, done, skipped, failed
+    duration_ms = db.Column(db.Float)
+    size_before = db.Column(db.Integer)
+    size_after = db.Column(db.Integer)
+    free_pages_before = db.Column(db.Integer)
+    free_pages_after = db.Column(db.Integer)
+    wal_size_before = db.Column(db.Integer)
+    wal_size_after = db.Column(db.Integer)
+    details = db.Column(db.Text)  # JSON: timing and result of each task, or why it was skipped
+
+class ClientRfm(db.Model):
+    """A client's recency, frequency and monetary scores (1-5), rebuilt by the analytics job."""
+    __tablename__ = 'client_rfm'
+    __table_args__ = (
+        db.Index('ix_client_rfm_segment', 'segment', 'monetary_total'),
+    )
+    client_id = db.Column(db.Integer, primary_key=True)
+    last_purchase = db.Column(db.DateTime)
+    invoice_count = db.Column(db.Integer)
+    monetary_total = db.Column(db.Float)
+    recency = db.Column(db.Integer)
+    frequency = db.Column(db.Integer)
+    monetary = db.Column(db.Integer)
+    segment = db.Column(db.String(20))
+
+class ProductPair(db.Model):
+    """How many invoices sold both products; jeans_id is the smaller id."""
+    __tablename__ = 'product_pair'
+    __table_args__ = (
+        db.Index('ix_product_pair_invoice_count', 'invoice_count'),
+        db.Index('ix_product_pair_other', 'other_jeans_id'),
+    )
+    jeans_id = db.Column(db.Integer, primary_key=True)
+    other_jeans_id = db.Column(db.Integer, primary_key=True)
+    invoice_count = db.Column(db.Integer, nullable=False)
+
+class AnalyticsRun(db.Model):
+    """One refresh of the analytics tables, and how far it read the change feeds."""
+    __tablename__ = 'analytics_run'
+    id = db.Column(db.Integer, primary_key=True)
+    started_at = db.Column(db.DateTime, nullable=False)
+    mode = db.Column(db.String(20), nullable=False)  # full, incremental
+    duration_ms = db.Column(db.Float)
+    clients = db.Column(db.Integer)
+    products = db.Column(db.Integer)  # products whose pairs were recounted
+    last_movement_id = db.Column(db.Integer, default=0)
+    last_item_id = db.Column(db.Integer, default=0)
+    last_removal_id = db.Column(db.Integer, default=0)
+
+class RemovedInvoiceLine(db.Model):
+    """Products of invoice lines deleted or voided, a change feed for the
+    analytics run; not every removal moves stock."""
+    __tablename__ = 'removed_invoice_line'
+    id = db.Column(db.Integer, primary_key=True)
+    jeans_id = db.Column(db.Integer, nullable=False)
+    removed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+def upgrade_schema():
+    """Create columns and indexes that db.create_all() skips on tables that already exist."""
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        with db.engine.begin() as connection:
+            for column in table.columns:
+                if column.name not in columns:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    connection.execute(db.text(
+                        f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                    ))
+
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+
+def merge_sale_table():
+    """Date the invoice lines from the old sale table, which duplicated
+    them, then drop it.
+
+    Lines keep the date of their first sale. Lines without one were either
+    sold before sales were linked to lines, and take their invoice's date
+    moved to UTC, or had their sale archived already, and stay undated so
+    SalesSummary doesn't count them twice.
+    """
+    inspector = db.inspect(db.engine)
+    if not inspector.has_table('sale'):
+        return
+    archived_until = 'SELECT MAX(sale_date) FROM sale_history' if inspector.has_table('sale_history') else 'NULL'
+    # Invoice dates are local time, sale dates UTC
+    offset = datetime.now().astimezone().utcoffset()
+    shift = f'{-int(offset.total_seconds())} seconds'
+    with db.engine.begin() as connection:
+        connection.execute(db.text("""
+            UPDATE invoice_item SET sale_date = COALESCE(
+                (SELECT MIN(sale.sale_date) FROM sale WHERE sale.invoice_item_id = invoice_item.id),
+                (SELECT datetime(invoice.date, :shift) FROM invoice WHERE invoice.id = invoice_item.invoice_id
+                    AND COALESCE(invoice.status, '') != 'cancelled'
+                    AND datetime(invoice.date, :shift) > COALESCE(({archived_until}), '')))
+        """.format(archived_until=archived_until)), {'shift': shift})
+        connection.execute(db.text("""
+            UPDATE invoice_item_history SET sale_date =
+                (SELECT datetime(invoice.date, :shift) FROM invoice WHERE invoice.id = invoice_item_history.invoice_id)
+            WHERE sale_date IS NULL
+        """), {'shift': shift})
+        connection.execute(db.text('DROP TABLE sale'))
+
+def backup_database(label):
+    """Copy the SQLite database into BACKUP_FOLDER with the online backup
+    API and return the copy's path."""
+    source = db.engine.url.database
+    os.makedirs(BACKUP_FOLDER, exist_ok=True)
+    backup_path = os.path.join(BACKUP_FOLDER, f"backup_{label}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db")
+    live, copy = sqlite3.connect(source), sqlite3.connect(backup_path)
+    try:
+        live.backup(copy)
+    finally:
+        copy.close()
+        live.close()
+    return backup_path
+
+@app.cli.command('migrate-sales')
+def migrate_sales_command():
+    """Back up the database, then merge the old sale table into the invoice lines."""
+    if not db.inspect(db.engine).has_table('sale'):
+        click.echo('No sale table; nothing to migrate')
+        return
+    backup_path = backup_database('before_migrate_sales')
+    click.echo(f'Backed up to {backup_path}')
+    merge_sale_table()
+    click.echo('Merged the sale table into the invoice lines and dropped it')
+
+def use_incremental_vacuum(connection):
+    """Switch the database to auto_vacuum=INCREMENTAL. This takes a full
+    VACUUM, which rewrites the file; on a new, empty database that is instant."""
+    connection.exec_driver_sql('PRAGMA auto_vacuum = INCREMENTAL')
+    connection.exec_driver_sql('VACUUM')
 
 with app.app_context():
+    new_database = db.engine.url.get_backend_name() == 'sqlite' and not db.inspect(db.engine).get_table_names()
     db.create_all()
-    
+    upgrade_schema()
+    if db.inspect(db.engine).has_table('sale'):
+        app.logger.warning('The old sale table is still there; sales reports miss its dates until '
+                           '"flask migrate-sales" is run')
+    if new_database:
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            use_incremental_vacuum(connection)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+def query_budget(limit):
+    """The most queries the route should run, checked when SQL_PROFILING is on."""
+    def decorator(f):
+        f.query_budget = limit
+        return f
+    return decorator
+
+def query_budget_for(endpoint):
+    if endpoint in app.config['SQL_QUERY_BUDGETS']:
+        return app.config['SQL_QUERY_BUDGETS'][endpoint]
+    view = app.view_functions.get(endpoint)
+    return getattr(view, 'query_budget', app.config['SQL_QUERY_BUDGET'])
+
+slow_request_log = logging.getLogger('slow_requests')
+
+def slow_request_logger():
+    if not slow_request_log.handlers:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        handler = logging.FileHandler(os.path.join(LOG_DIR, 'slow_requests.log'), encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        slow_request_log.addHandler(handler)
+        slow_request_log.setLevel(logging.INFO)
+        slow_request_log.propagate = False
+    return slow_request_log
+
+def profiling_request():
+    """Whether a request of this app is being profiled; the listeners are
+    on every Engine, so they skip the queries of any other app."""
+    return has_request_context() and current_app._get_current_object() is app and 'sql_profile' in g
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if profiling_request():
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    if not (profiling_request() and conn.info.get('query_started')):
+        return
+    elapsed_ms = (time.perf_counter() - conn.info['query_started'].pop()) * 1000
+    g.sql_profile['statements'].append((elapsed_ms, statement))
+
+@app.before_request
+def start_request_profile():
+    if app.config['SQL_PROFILING']:
+        g.sql_profile = {'started': time.perf_counter(), 'statements': []}
+
+@app.after_request
+def finish_request_profile(response):
+    """Report the request's queries. A streamed body still runs queries
+    after this, so its profile is left running until teardown."""
+    profile = g.get('sql_profile')
+    if profile is None:
+        return response
+    statements = profile['statements']
+    sql_ms = sum(elapsed for elapsed, _ in statements)
+    total_ms = (time.perf_counter() - profile['started']) * 1000
+    response.headers['Server-Timing'] = (
+        f'db;dur={sql_ms:.1f};desc="{len(statements)} queries{" before streaming" if response.is_streamed else ""}", '
+        f'app;dur={total_ms:.1f}'
+    )
+    if response.is_streamed:
+        profile['status_code'] = response.status_code
+    else:
+        g.pop('sql_profile')
+        report_request_profile(profile, response.status_code)
+    return response
+
+@app.teardown_request
+def finish_streamed_profile(exc=None):
+    profile = g.pop('sql_profile', None)
+    if profile is not None and 'status_code' in profile:
+        report_request_profile(profile, profile['status_code'])
+
+def report_request_profile(profile, status_code):
+    """Log N+1 patterns and slow requests, and check the route's query budget."""
+    total_ms = (time.perf_counter() - profile['started']) * 1000
+    statements = profile['statements']
+    sql_ms = sum(elapsed for elapsed, _ in statements)
+    repeated = [(' '.join(statement.split()), count) for statement, count
+                in Counter(statement for _, statement in statements).most_common()
+                if count >= app.config['N_PLUS_ONE_THRESHOLD']]
+
+    if repeated:
+        app.logger.warning('Possible N+1 in %s: %s', request.endpoint,
+                           '; '.join(f'{count}x {statement[:120]}' for statement, count in repeated))
+
+    if total_ms >= app.config['SLOW_REQUEST_MS']:
+        lines = [f'{request.method} {request.full_path.rstrip("?")} {status_code} '
+                 f'{total_ms:.1f} ms, {len(statements)} queries, {sql_ms:.1f} ms SQL']
+        for elapsed, statement in sorted(statements, key=lambda item: item[0], reverse=True)[:5]:
+            lines.append(f'    {elapsed:8.2f} ms  {" ".join(statement.split())[:300]}')
+        for statement, count in repeated:
+            lines.append(f'    repeated {count}x  {statement[:300]}')
+        slow_request_logger().info('\n'.join(lines))
+
+    budget = query_budget_for(request.endpoint)
+    if budget is not None and len(statements) > budget:
+        message = f'{request.endpoint} ran {len(statements)} queries (budget {budget})'
+        if app.testing:
+            raise QueryBudgetExceeded(message)
+        app.logger.warning(message)
+
+
+COMPRESSED_MIMETYPES = {'text/html', 'text/css', 'text/csv', 'text/plain', 'application/json',
+                        'application/javascript', 'text/javascript', 'image/svg+xml'}
+# Streamed output goes out in chunks of about this size, so the first rows
+# still leave early without every small template chunk costing a write
+STREAM_CHUNK_SIZE = 16 * 1024
+
+def accepted_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+def compressor(encoding):
+    """(compress, flush, finish) functions for one response body."""
+    if encoding is None:
+        return (lambda data: data), bytes, bytes
+    if encoding == 'br':
+        stream = brotli.Compressor(quality=5)
+        return stream.process, stream.flush, stream.finish
+    stream = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return stream.compress, lambda: stream.flush(zlib.Z_SYNC_FLUSH), stream.flush
+
+def compress_stream(chunks, encoding):
+    compress, flush, finish = compressor(encoding)
+    pending, size = [], 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        pending.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_CHUNK_SIZE:
+            yield compress(b''.join(pending)) + flush()
+            pending, size = [], 0
+    yield compress(b''.join(pending)) + finish()
+
+@app.after_request
+def compress_response(response):
+    """gzip (or brotli, when installed) text responses the client accepts
+    compressed. Streamed responses stay streamed, in STREAM_CHUNK_SIZE chunks."""
+    if response.status_code != 200 or 'Content-Encoding' in response.headers \
+            or response.mimetype not in COMPRESSED_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accepted_encoding()
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.direct_passthrough = False
+        if encoding is None:
+            return response
+        response.headers.pop('Content-Length', None)
+    elif encoding is None:
+        return response
+    else:
+        body = response.get_data()
+        if len(body) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        compress, _, finish = compressor(encoding)
+        response.set_data(compress(body) + finish())
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+STREAM_BATCH_SIZE = 500
+
+def stream_rows(query, key, *options):
+    """Yield the rows of query in order, STREAM_BATCH_SIZE at a time, for
+    pages rendered with stream_template.
+
+    Only the keys are read up front; each batch is a short query of its own,
+    so a client on a slow connection never keeps a read open on the database
+    while the page streams out. options are loader options for the batches.
+    """
+    keys = [row_key for (row_key,) in query.with_entities(key)]
+    for start in range(0, len(keys), STREAM_BATCH_SIZE):
+        yield from query.options(*options).filter(key.in_(keys[start:start + STREAM_BATCH_SIZE]))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Counters kept with MetricsStore.increment, and their help text
+COUNTERS = {'audit_entries_dropped_total': 'Audit entries dropped because the writer fell behind or failed.'}
+
+class MetricsStore:
+    """Request metrics for this process, flushed to one JSON file per process
+    so /metrics can add up every worker behind the same instance directory.
+    A worker removes its file when it exits; files left by workers that died
+    are removed by the next scrape."""
+
+    def __init__(self, directory, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.caches = {}
+        self.in_flight = 0
+        self.queue_depths = {}
+        self.counters = {}
+        self.last_flush = 0.0
+
+    def request_started(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def request_finished(self, endpoint, seconds):
+        with self.lock:
+            self.in_flight -= 1
+            buckets, totals = self.latency.setdefault(endpoint, ([0] * (len(LATENCY_BUCKETS) + 1), [0.0, 0]))
+            buckets[next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), -1)] += 1
+            totals[0] += seconds
+            totals[1] += 1
+        self.flush()
+
+    def record_cache(self, name, hit):
+        with self.lock:
+            self.caches.setdefault(name, [0, 0])[0 if hit else 1] += 1
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def register_queue(self, name, depth):
+        """depth is a callable returning the current length of a job queue."""
+        self.queue_depths[name] = depth
+
+    def snapshot(self):
+        with app.app_context():
+            pool = db.engine.pool
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'latency': {endpoint: [buckets[:], totals[:]] for endpoint, (buckets, totals) in self.latency.items()},
+                'caches': {name: counts[:] for name, counts in self.caches.items()},
+                'counters': dict(self.counters),
+                'in_flight': self.in_flight,
+                'queues': {name: depth() for name, depth in self.queue_depths.items()},
+                'pool': {
+                    'size': pool.size() if hasattr(pool, 'size') else 0,
+                    'checked_out': pool.checkedout() if hasattr(pool, 'checkedout') else 0,
+                    'overflow': max(pool.overflow(), 0) if hasattr(pool, 'overflow') else 0
+                }
+            }
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_flush < self.flush_interval:
+            return
+        self.last_flush = now
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+        try:
+            os.remove(os.path.join(self.directory, f'{os.getpid()}.json'))
+        except OSError:
+            pass
+
+    def collect(self):
+        """Snapshots of every live worker; this process contributes its live state."""
+        snapshots = [self.snapshot()]
+        if not os.path.isdir(self.directory):
+            return snapshots
+        for filename in os.listdir(self.directory):
+            pid, ext = os.path.splitext(filename)
+            if ext != '.json' or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            if not process_alive(int(pid)):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            snapshots.append(snapshot)
+        return snapshots
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+metrics = MetricsStore(METRICS_DIR)
+atexit.register(metrics.close)
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    metrics.request_started()
+
+@app.teardown_request
+def finish_request_metrics(exc=None):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        metrics.request_finished(request.endpoint or 'unknown', time.perf_counter() - started)
+
+def render_metrics(snapshots):
+    latency, caches, queues, pools = {}, {}, {}, []
+    counters = dict.fromkeys(COUNTERS, 0)
+    in_flight = 0
+    for snapshot in snapshots:
+        for endpoint, (buckets, totals) in snapshot['latency'].items():
+            merged = latency.setdefault(endpoint, ([0] * (len(LATENCY_BUCKETS) + 1), [0.0, 0]))
+            for i, count in enumerate(buckets):
+                merged[0][i] += count
+            merged[1][0] += totals[0]
+            merged[1][1] += totals[1]
+        for name, (hits, misses) in snapshot['caches'].items():
+            counts = caches.setdefault(name, [0, 0])
+            counts[0] += hits
+            counts[1] += misses
+        for name, depth in snapshot['queues'].items():
+            queues[name] = queues.get(name, 0) + depth
+        for name, count in snapshot.get('counters', {}).items():
+            counters[name] = counters.get(name, 0) + count
+        in_flight += snapshot['in_flight']
+        if snapshot['pool']:
+            pools.append((snapshot['pid'], snapshot['pool']))
+
+    lines = [
+        '# HELP http_request_duration_seconds Request latency by endpoint.',
+        '# TYPE http_request_duration_seconds histogram'
+    ]
+    for endpoint, (buckets, (total, count)) in sorted(latency.items()):
+        cumulative = 0
+        for bound, bucket in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+            cumulative += bucket
+            lines.append(f'http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+        lines.append(f'http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {total:.6f}')
+        lines.append(f'http_request_duration_seconds_count{{endpoint="{endpoint}"}} {count}')
+
+    lines += [
+        '# HELP http_requests_in_flight Requests being served right now.',
+        '# TYPE http_requests_in_flight gauge',
+        f'http_requests_in_flight {in_flight}',
+        '# HELP db_pool_connections Database connections per worker pool.',
+        '# TYPE db_pool_connections gauge'
+    ]
+    for pid, pool in pools:
+        for state in ('size', 'checked_out', 'overflow'):
+            lines.append(f'db_pool_connections{{pid="{pid}",state="{state}"}} {pool[state]}')
+
+    lines += [
+        '# HELP cache_requests_total Cache lookups by result.',
+        '# TYPE cache_requests_total counter'
+    ]
+    for name, (hits, misses) in sorted(caches.items()):
+        lines.append(f'cache_requests_total{{cache="{name}",result="hit"}} {hits}')
+        lines.append(f'cache_requests_total{{cache="{name}",result="miss"}} {misses}')
+    lines += ['# HELP cache_hit_ratio Share of cache lookups that hit.', '# TYPE cache_hit_ratio gauge']
+    for name, (hits, misses) in sorted(caches.items()):
+        lines.append(f'cache_hit_ratio{{cache="{name}"}} {hits / (hits + misses) if hits + misses else 0:.4f}')
+
+    lines += ['# HELP job_queue_depth Jobs waiting in background queues.', '# TYPE job_queue_depth gauge']
+    for name, depth in sorted(queues.items()):
+        lines.append(f'job_queue_depth{{queue="{name}"}} {depth}')
+    for name, count in sorted(counters.items()):
+        lines += [f'# HELP {name} {COUNTERS.get(name, name)}', f'# TYPE {name} counter', f'{name} {count}']
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics')
+def prometheus_metrics():
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return 'Unauthorized', 401
+    return render_metrics(metrics.collect()), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 
 @app.route('/')
 def index():
@@ -225,17 +1071,22 @@ def add():
             dozens_per_package=int(request.form['dozens_per_package'])
         )
         db.session.add(new_jeans)
+        sync_variants(new_jeans)
         db.session.commit()
 
         # Add stock to selected warehouses
+        stock_reason('receipt', f'jeans:{new_jeans.id}')
         warehouses = request.form.getlist('warehouses')
         quantities = request.form.getlist('quantities')
+        # With a single size and color the stock can only be that variant
+        variant_id = new_jeans.variants[0].id if len(new_jeans.variants) == 1 else None
         
         for warehouse_id, quantity in zip(warehouses, quantities):
             if quantity and int(quantity) > 0:
                 stock = JeansStock(
                     jeans_id=new_jeans.id,
                     warehouse_id=int(warehouse_id),
+                    variant_id=variant_id,
                     quantity=int(quantity)
                 )
                 db.session.add(stock)
@@ -259,6 +1110,7 @@ def inject_settings():
 
 @app.route('/invoice/<int:invoice_id>/add_payment', methods=['POST'])
 @login_required
+@query_budget(6)
 def add_payment(invoice_id):
     invoice = Invoice.query.get_or_404(invoice_id)
     amount = float(request.form['amount'])
@@ -351,21 +1203,19 @@ def settings():
 @login_required
 def profile():
     if request.method == 'POST':
-        current_user.username = request.form.get('username')
+        # current_user is the cached principal; changes go to the user row
+        user = db.session.get(User, current_user.id)
+        username = request.form.get('username', '').strip()
+        if username and username != user.username:
+            if User.query.filter_by(username=username).first():
+                flash(f'Username {username} is already taken. Please choose another username.')
+                return redirect(url_for('profile'))
+            user.username = username
         if request.form.get('new_password'):
-            current_user.password = request.form.get('new_password')
-            email = request.form.get('email')
-        if username and username != current_user.username:
-            current_user.username = username
-            
-        if new_password:
-            current_user.password = new_password
-            
-        if email:
-            current_user.email = email
-            
+            user.set_password(request.form['new_password'])
         db.session.commit()
         flash('Profile updated successfully!', 'success')
+        return redirect(url_for('profile'))
     return render_template('profile.html')
 
 @app.route('/warehouses', methods=['GET'])
@@ -432,9 +1282,28 @@ def update(id):
             jeans.name = request.form['name']
             jeans.sizes = request.form['sizes']
             jeans.colors = request.form['colors']
-            jeans.price = float(request.form['price'])
+            price = float(request.form['price'])
+            if price != jeans.price:
+                db.session.add(PriceHistory(jeans_id=jeans.id, old_price=jeans.price, new_price=price))
+                jeans.price = price
+            sync_variants(jeans)
             for stock in jeans.stocks:
-                stock.quantity = int(request.form[f'quantity_{stock.warehouse_id}'])
+                stock.quantity = int(request.form[f'quantity_{stock.id}'])
+
+            # Stock for a size and color that has none in that warehouse yet
+            variant_id = request.form.get('new_variant_id', type=int)
+            warehouse_id = request.form.get('new_warehouse_id', type=int)
+            quantity = request.form.get('new_quantity', type=int)
+            if variant_id and warehouse_id and quantity:
+                # The reason labels the whole flush, so write the edits above as adjustments first
+                db.session.flush()
+                variant = JeansVariant.query.filter_by(id=variant_id, jeans_id=jeans.id).first_or_404()
+                stock = JeansStock.query.filter_by(jeans_id=jeans.id, warehouse_id=warehouse_id, variant_id=variant.id).first()
+                if stock:
+                    stock.quantity += quantity
+                else:
+                    db.session.add(JeansStock(jeans_id=jeans.id, warehouse_id=warehouse_id, variant_id=variant.id, quantity=quantity))
+                stock_reason('receipt', f'jeans:{jeans.id}')
             
             jeans.pieces_per_dozen = int(request.form['pieces_per_dozen'])
             jeans.dozens_per_package = int(request.form['dozens_per_package'])
@@ -445,8 +1314,107 @@ def update(id):
         except:
             flash('حدث خطأ في تحديث المنتج', 'danger')
             
-    return render_template('update.html', jeans=jeans)
+    return render_template('update.html', jeans=jeans, warehouses=Warehouse.query.all())
+
+
+REPRICE_PREVIEW_ROWS = 100
+
+def reprice_rule(args):
+    """The repricing rule from a form: (rule, error message)."""
+    try:
+        rule = {
+            'mode': args.get('mode', 'percent'),
+            'value': float(args.get('value') or 0),
+            'round_to': float(args.get('round_to') or 0),
+            'name': args.get('name', '').strip(),
+            'warehouse_id': args.get('warehouse_id', type=int),
+            'added_from': parse_date(args.get('added_from')),
+            'added_to': parse_date(args.get('added_to')),
+        }
+    except ValueError:
+        return None, 'قيمة غير صحيحة'
+    if rule['mode'] not in ('percent', 'amount') or rule['round_to'] < 0:
+        return None, 'قيمة غير صحيحة'
+    return rule, None
+
+def reprice_columns(rule):
+    """(new price expression, filter) for a rule, both evaluated by the database."""
+    if rule['mode'] == 'percent':
+        price = Jeans.price * (1 + rule['value'] / 100)
+    else:
+        price = Jeans.price + rule['value']
+    if rule['round_to']:
+        price = db.func.round(price / rule['round_to']) * rule['round_to']
+    price = db.func.round(db.func.max(price, 0), 2)
+
+    conditions = [price != Jeans.price]
+    if rule['name']:
+        conditions.append(Jeans.name.contains(rule['name']))
+    if rule['warehouse_id']:
+        conditions.append(Jeans.id.in_(db.select(JeansStock.jeans_id)
+                                       .where(JeansStock.warehouse_id == rule['warehouse_id'])))
+    if rule['added_from']:
+        conditions.append(Jeans.date_added >= rule['added_from'])
+    if rule['added_to']:
+        conditions.append(Jeans.date_added < rule['added_to'] + timedelta(days=1))
+    return price, db.and_(*conditions)
+
+def describe_rule(rule):
+    change = f"{rule['value']:+g}%" if rule['mode'] == 'percent' else f"{rule['value']:+g}"
+    parts = [change] + ([f"round {rule['round_to']:g}"] if rule['round_to'] else [])
+    parts += [f'{key}={rule[key]:%Y-%m-%d}' if isinstance(rule[key], datetime) else f'{key}={rule[key]}'
+              for key in ('name', 'warehouse_id', 'added_from', 'added_to') if rule[key]]
+    return ' '.join(parts)[:200]
 
+def apply_reprice(rule):
+    """Reprice every matching product with one INSERT ... SELECT into the
+    history and one UPDATE, and return how many changed. Invoice lines
+    keep their own price and are not touched."""
+    new_price, condition = reprice_columns(rule)
+    changed_at = datetime.utcnow()
+    changed_ids = sync_ids(Jeans, condition)
+    db.session.execute(PriceHistory.__table__.insert().from_select(
+        ('jeans_id', 'old_price', 'new_price', 'reason', 'changed_at'),
+        db.select(Jeans.id, Jeans.price, new_price, db.literal(describe_rule(rule)), db.literal(changed_at))
+        .where(condition)
+    ))
+    changed = db.session.execute(
+        db.update(Jeans).where(condition).values(price=new_price).execution_options(synchronize_session=False)
+    ).rowcount
+    log_changes(Jeans, 'update', changed_ids)
+    return changed
+
+@app.route('/products/reprice', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def reprice():
+    """Preview a bulk price change as a diff, then apply it in one go."""
+    rule, error = reprice_rule(request.form if request.method == 'POST' else request.args)
+    if error:
+        flash(error, 'danger')
+        return redirect(url_for('reprice'))
+
+    if request.method == 'POST':
+        changed = apply_reprice(rule)
+        db.session.commit()
+        flash(f'تم تعديل سعر {changed} منتج', 'success')
+        return redirect(url_for('reprice'))
+
+    preview, summary = [], None
+    if 'value' in request.args:
+        new_price, condition = reprice_columns(rule)
+        preview = db.session.execute(
+            db.select(Jeans.id, Jeans.name, Jeans.barcode, Jeans.price, new_price.label('new_price'))
+            .where(condition).order_by(Jeans.name, Jeans.id).limit(REPRICE_PREVIEW_ROWS)
+        ).all()
+        summary = db.session.execute(
+            db.select(db.func.count(), db.func.sum(Jeans.price), db.func.sum(new_price)).where(condition)
+        ).one()
+    history = db.session.query(PriceHistory, Jeans.name).join(Jeans, Jeans.id == PriceHistory.jeans_id)\
+        .order_by(PriceHistory.id.desc()).limit(20).all()
+    return render_template('reprice.html', rule=rule, preview=preview, summary=summary, history=history,
+                           warehouses=Warehouse.query.order_by(Warehouse.name).all(),
+                           args=request.args)
 
 @app.route('/delete/<int:id>')
 def delete(id):
@@ -503,21 +1471,15 @@ def alerts():
 @login_required
 def sales():
     sales = db.session.query(
-        Sale,
+        InvoiceItem,
         Jeans
-    ).join(Jeans).order_by(Sale.sale_date.desc()).all()
-    return render_template('sales.html', sales=sales)
+    ).join(Jeans).filter(InvoiceItem.sale_date.is_not(None)).order_by(InvoiceItem.sale_date.desc(), InvoiceItem.id.desc())
+    return stream_template('sales.html', sales=stream_rows(sales, InvoiceItem.id))
 
 @app.route('/search')
 @login_required
 def search():
-    query = request.args.get('q')
-    results = Jeans.query.filter(
-        (Jeans.brand.contains(query)) |
-        (Jeans.style.contains(query)) |
-        (Jeans.color.contains(query))
-    ).all()
-    return render_template('search_results.html', results=results)
+    return redirect(url_for('inventory', **request.args))
 
 
 @app.route('/')
@@ -528,7 +1490,8 @@ def login():
         password = request.form['password']
         user = User.query.filter_by(username=username).first()
         
-        if user and user.password == password:  # Use proper password hashing in production
+        if user and user.check_password(password):
+            db.session.commit()
             login_user(user)
             return redirect(url_for('dashboard'))
         flash('Invalid username or password')
@@ -600,12 +1563,29 @@ def logout():
     return redirect(url_for('login'))
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    """The principal of user_id, read once per AUTH_CACHE_TTL per worker.
+
+    Changes to a user drop its entry in this worker; other workers see
+    them when their entry expires.
+    """
+    cached = principal_cache.get(user_id)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    row = db.session.execute(db.select(User.id, User.username, User.role, User.is_admin)
+                             .where(User.id == int(user_id))).first()
+    if row is None:
+        principal_cache.pop(user_id, None)
+        return None
+    principal = Principal(*row)
+    if app.config['AUTH_CACHE_TTL'] > 0:
+        principal_cache[user_id] = (principal, time.monotonic() + app.config['AUTH_CACHE_TTL'])
+    return principal
 
 
 
 @app.route('/dashboard')
 @login_required
+@query_budget(12)
 def dashboard():
     total_items = db.session.query(db.func.sum(JeansStock.quantity)).scalar() or 0
     low_stock = db.session.query(JeansStock).filter(JeansStock.quantity < 48).count()
@@ -613,8 +1593,11 @@ def dashboard():
     partial_invoices = Invoice.query.filter_by(status='partial').count()
     pending_invoices = Invoice.query.filter_by(status='pending').count()
     recent_invoices = Invoice.query.order_by(Invoice.date.desc()).limit(5).all()
-    total_sales = Sale.query.count()
-    recent_sales = Sale.query.order_by(Sale.sale_date.desc()).limit(5).all()
+    sold = InvoiceItem.sale_date.is_not(None)
+    total_sales = InvoiceItem.query.filter(sold).count() + \
+        (db.session.query(db.func.sum(SalesSummary.sale_count)).scalar() or 0)
+    recent_sales = InvoiceItem.query.filter(sold).options(db.joinedload(InvoiceItem.jeans))\
+        .order_by(InvoiceItem.sale_date.desc()).limit(5).all()
     
     return render_template('dashboard.html', 
         total_items=total_items,
@@ -629,23 +1612,142 @@ def dashboard():
 
 @app.route('/inventory')
 @login_required
+@query_budget(5)
 def inventory():
-    items = Jeans.query.all()
-    return render_template('inventory.html', items=items)
+    """Stock rows, optionally narrowed to a size and/or color through the variant index."""
+    stocks = JeansStock.query.join(Jeans).outerjoin(JeansVariant, JeansStock.variant_id == JeansVariant.id)
+    size, color, q = request.args.get('size'), request.args.get('color'), request.args.get('q')
+    if size:
+        stocks = stocks.filter(JeansVariant.size == size)
+    if color:
+        stocks = stocks.filter(JeansVariant.color == color)
+    if q:
+        stocks = stocks.filter(db.or_(Jeans.name.contains(q), Jeans.barcode == q))
+    stocks = stocks.order_by(Jeans.id, JeansStock.warehouse_id, JeansVariant.size, JeansVariant.color)
+    stocks = stream_rows(stocks, JeansStock.id, db.contains_eager(JeansStock.jeans),
+                         db.contains_eager(JeansStock.variant), db.joinedload(JeansStock.warehouse))
+
+    sizes = [value for (value,) in db.session.query(JeansVariant.size).distinct().order_by(JeansVariant.size)]
+    colors = [value for (value,) in db.session.query(JeansVariant.color).distinct().order_by(JeansVariant.color)]
+    return stream_template('inventory.html', stocks=stocks, sizes=sizes, colors=colors,
+                           filters={'size': size, 'color': color, 'q': q})
+
+class ReportSnapshot:
+    """A read-only copy of the SQLite database for the reporting routes.
+
+    The copy is made with the SQLite online backup API a few pages at a
+    time, so checkout writes are only held up for one step at a time, and
+    is swapped in atomically. Stale snapshots are refreshed in the
+    background while the old one keeps serving.
+    """
+    PAGES_PER_STEP = 256
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.engines = {}
+        self.refreshing = False
+
+    def source(self):
+        url = db.engine.url
+        if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+            return None
+        return url.database
+
+    def as_of(self, path):
+        try:
+            return datetime.fromtimestamp(os.path.getmtime(path))
+        except OSError:
+            return None
+
+    def refresh(self, source):
+        """Copy source next to itself and return the time the copy started."""
+        target = f'{source}.snapshot'
+        temp = f'{target}.{os.getpid()}.tmp'
+        started = time.time()
+        live, copy = sqlite3.connect(source), sqlite3.connect(temp)
+        try:
+            live.backup(copy, pages=self.PAGES_PER_STEP, sleep=0.001)
+        finally:
+            copy.close()
+            live.close()
+        # The snapshot's mtime is its "as of" time
+        os.utime(temp, (started, started))
+        os.replace(temp, target)
+        return datetime.fromtimestamp(started)
+
+    def refresh_in_background(self, source):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def run():
+            try:
+                self.refresh(source)
+            except Exception:
+                app.logger.exception('Refreshing the report snapshot failed')
+            finally:
+                self.refreshing = False
+        threading.Thread(target=run, name='report-snapshot', daemon=True).start()
+
+    def engine(self, path):
+        with self.lock:
+            if path not in self.engines:
+                # NullPool: every request opens whichever file is current
+                self.engines[path] = create_engine(
+                    f'sqlite:///file:{path}?mode=ro&uri=true', poolclass=NullPool
+                )
+            return self.engines[path]
+
+    def for_request(self):
+        """(engine, as_of) to read from, or (None, None) for the live database."""
+        source = self.source()
+        if source is None:
+            return None, None
+        path = f'{source}.snapshot'
+        as_of = self.as_of(path)
+        fresh = as_of is not None and \
+            datetime.now() - as_of < timedelta(seconds=app.config['REPORT_SNAPSHOT_MAX_AGE'])
+        metrics.record_cache('report_snapshot', fresh)
+        if not fresh:
+            self.refresh_in_background(source)
+        if as_of is None:
+            return None, None
+        return self.engine(path), as_of
+
+report_snapshot = ReportSnapshot()
+
+def reporting_route(f):
+    """Serve the route from the report snapshot when one is configured."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if app.config['REPORT_SNAPSHOT']:
+            g.snapshot_engine, g.snapshot_as_of = report_snapshot.for_request()
+        return f(*args, **kwargs)
+    return decorated
+
+@app.cli.command('refresh-snapshot')
+def refresh_snapshot_command():
+    """Rebuild the report snapshot now."""
+    source = report_snapshot.source()
+    if source is None:
+        raise click.UsageError('report snapshots need a file-based SQLite database')
+    started = time.perf_counter()
+    as_of = report_snapshot.refresh(source)
+    click.echo(f'Snapshot as of {as_of:%Y-%m-%d %H:%M:%S} written in {time.perf_counter() - started:.1f} s')
 
 @app.route('/reports')
 @login_required
+@reporting_route
+@query_budget(12)
 def reports():
     today = datetime.now().date()
     dates = [(today - timedelta(days=x)) for x in range(6, -1, -1)]
-    daily_sales = []
-    
-    for date in dates:
-        daily_total = db.session.query(db.func.sum(Invoice.total_amount))\
-            .filter(db.func.date(Invoice.date) == date)\
-            .filter(Invoice.status == 'paid')\
-            .scalar() or 0
-        daily_sales.append(daily_total)
+    # Paid invoices by their date, which is local time like dates
+    sale_day = db.func.date(Invoice.date)
+    totals = dict(db.session.query(sale_day, db.func.sum(Invoice.total_amount))
+                  .filter(Invoice.status == 'paid', Invoice.date >= dates[0]).group_by(sale_day))
+    daily_sales = [totals.get(date.isoformat(), 0) for date in dates]
     
     arabic_days = ['السبت', 'الأحد', 'الإثنين', 'الثلاثاء', 'الأربعاء', 'الخميس', 'الجمعة']
     labels = [arabic_days[date.weekday()] for date in dates]
@@ -672,19 +1774,38 @@ def reports():
         db.func.sum(Invoice.remaining_amount).label('total_pending')
     ).join(Invoice).filter(Invoice.payment_status != 'paid')\
      .group_by(Client.id).all()
-    # Get top selling items from invoice items
+    # Top selling products from the hot lines of paid invoices and the archived daily totals
+    sold_items = db.union_all(
+        db.select(InvoiceItem.jeans_id, InvoiceItem.quantity)
+            .join(Invoice)
+            .where(Invoice.status == 'paid', InvoiceItem.sale_date.is_not(None)),
+        db.select(SalesSummary.jeans_id, SalesSummary.quantity)
+    ).subquery()
     top_selling = db.session.query(
         Jeans,
-        db.func.sum(InvoiceItem.quantity).label('total_sold')
-    ).join(InvoiceItem)\
-     .join(Invoice)\
-     .filter(Invoice.status == 'paid')\
+        db.func.sum(sold_items.c.quantity).label('total_sold')
+    ).join(sold_items, sold_items.c.jeans_id == Jeans.id)\
      .group_by(Jeans.id)\
      .order_by(db.desc('total_sold'))\
      .limit(5)\
      .all()
+
+    # Customer segments and bought-together products, from the analytics tables only
+    segments = {segment: (clients, spent) for segment, clients, spent in db.session.query(
+        ClientRfm.segment, db.func.count(), db.func.sum(ClientRfm.monetary_total)).group_by(ClientRfm.segment)}
+    other = db.aliased(Jeans)
+    top_pairs = db.session.query(Jeans.name, other.name, ProductPair.invoice_count)\
+        .join(Jeans, Jeans.id == ProductPair.jeans_id)\
+        .join(other, other.id == ProductPair.other_jeans_id)\
+        .order_by(ProductPair.invoice_count.desc())\
+        .limit(TOP_PAIRS)\
+        .all()
+    analytics_run = AnalyticsRun.query.order_by(AnalyticsRun.id.desc()).first()
     
     return render_template('reports.html', 
+        segments=[(key, title, *segments[key]) for key, title, _, _, _ in RFM_SEGMENTS if key in segments],
+        top_pairs=top_pairs,
+        analytics_run=analytics_run,
         total_value=total_value,
         total_sales=formatted_sales,
         top_selling=top_selling,
@@ -697,6 +1818,7 @@ def reports():
 
 @app.route('/debtors')
 @login_required
+@reporting_route
 def debtors():
     debtors = db.session.query(
         Client,
@@ -706,9 +1828,217 @@ def debtors():
      .group_by(Client.id)\
      .having(db.func.sum(Invoice.remaining_amount) > 0)\
      .all()
+
+    # The open invoices of every debtor in one query, not a walk over each client's invoices
+    open_invoices = {}
+    for invoice in Invoice.query.filter(Invoice.client_id.in_([client.id for client, _ in debtors]),
+                                        Invoice.status.in_(['pending', 'partial']))\
+            .order_by(Invoice.date, Invoice.id):
+        open_invoices.setdefault(invoice.client_id, []).append(invoice)
     
-    return render_template('debtors.html', debtors=debtors)
+    return render_template('debtors.html', debtors=debtors, open_invoices=open_invoices)
+
+AGING_PER_PAGE = 50
+# (column, title, oldest age in days); an invoice falls in the last bucket it is old enough for
+AGING_BUCKETS = (
+    ('current', 'حالية', 0),
+    ('days_30', '31-60 يوم', 30),
+    ('days_60', '61-90 يوم', 60),
+    ('days_90', 'أكثر من 90 يوم', 90),
+)
+AGING_SORTS = ('total', 'days_90', 'oldest', 'name')
+
+def invoice_outstanding():
+    return db.func.coalesce(Invoice.total_amount, 0) - db.func.coalesce(Invoice.paid_amount, 0)
+
+def open_invoice_condition():
+    """Invoices with money still owed on them."""
+    return db.and_(db.func.coalesce(Invoice.status, 'pending') != 'cancelled',
+                   invoice_outstanding() >= 0.005)
+
+def aging_query(as_of, sort='total'):
+    """Outstanding amounts per client split by invoice age, in one statement.
+
+    Invoices are grouped per client straight off ix_invoice_aging, and
+    window functions over the grouped rows add the number of clients and
+    the grand totals to every row, so a page needs no second query and an
+    export is the same statement without a LIMIT.
+    """
+    outstanding = invoice_outstanding()
+    age = db.func.julianday(as_of) - db.func.julianday(Invoice.date)
+    buckets = []
+    for index, (column, title, days) in enumerate(AGING_BUCKETS):
+        in_bucket = age > days if days else db.true()
+        if index + 1 < len(AGING_BUCKETS):
+            in_bucket = db.and_(in_bucket, age <= AGING_BUCKETS[index + 1][2])
+        buckets.append(db.func.sum(db.case((in_bucket, outstanding), else_=0)).label(column))
+    per_client = db.select(
+        Invoice.client_id, *buckets,
+        db.func.sum(outstanding).label('total'),
+        db.func.count().label('invoices'),
+        db.func.min(Invoice.date).label('oldest')
+    ).where(open_invoice_condition()).group_by(Invoice.client_id).subquery()
+
+    columns = [per_client.c[column] for column, _, _ in AGING_BUCKETS] + [per_client.c.total]
+    order = {
+        'total': (per_client.c.total.desc(),),
+        'days_90': (per_client.c.days_90.desc(), per_client.c.total.desc()),
+        'oldest': (per_client.c.oldest,),
+        'name': (Client.name,),
+    }[sort if sort in AGING_SORTS else 'total']
+    return db.select(
+        Client.id, Client.name, Client.phone, *columns, per_client.c.invoices, per_client.c.oldest,
+        db.func.count().over().label('clients'),
+        *[db.func.sum(column).over().label(f'all_{column.name}') for column in columns]
+    ).join(per_client, per_client.c.client_id == Client.id).order_by(*order, Client.id)
+
+def aging_csv(rows):
+    """Yield the report as CSV a few hundred rows at a time."""
+    si = io.StringIO()
+    si.write('\ufeff')  # Add BOM for Excel UTF-8 detection
+    cw = csv.writer(si)
+    cw.writerow(['اسم العميل', 'رقم الهاتف'] + [title for _, title, _ in AGING_BUCKETS]
+                + ['الإجمالي', 'عدد الفواتير', 'أقدم فاتورة'])
+    for count, row in enumerate(rows, start=1):
+        cw.writerow([row.name, row.phone] + [round(getattr(row, column), 2) for column, _, _ in AGING_BUCKETS]
+                    + [round(row.total, 2), row.invoices, str(row.oldest)[:10]])
+        if count % 500 == 0:
+            yield si.getvalue()
+            si.seek(0)
+            si.truncate()
+    yield si.getvalue()
+
+def aging_pdf(rows, title):
+    pdf = StyledPDF()
+    add_amiri_fonts(pdf)
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.heading = shape(title)
+    pdf.add_page()
+    # Laid out left to right, so the Arabic columns are reversed
+    headers = [('الإجمالي', 24)] + [(title, 24) for _, title, _ in reversed(AGING_BUCKETS)] \
+        + [('رقم الهاتف', 25), ('اسم العميل', 45)]
+    pdf.set_font('Amiri', 'B', 10)
+    pdf.set_fill_color(230, 230, 230)
+    for header, width in headers:
+        pdf.cell(width, 10, shape(header), border=1, align='C', fill=True)
+    pdf.ln()
+    pdf.set_font('Amiri', '', 10)
+    totals = [0.0] * (len(AGING_BUCKETS) + 1)
+    for row in rows:
+        amounts = [row.total] + [getattr(row, column) for column, _, _ in reversed(AGING_BUCKETS)]
+        for index, amount in enumerate(amounts):
+            totals[index] += amount or 0
+            pdf.cell(24, 8, f'{amount or 0:,.2f}', border=1, align='C')
+        pdf.cell(25, 8, row.phone or '', border=1, align='C')
+        pdf.cell(45, 8, shape(row.name), border=1, align='R')
+        pdf.ln()
+    pdf.set_font('Amiri', 'B', 10)
+    for amount in totals:
+        pdf.cell(24, 8, f'{amount:,.2f}', border=1, align='C', fill=True)
+    pdf.cell(70, 8, shape('الإجمالي'), border=1, align='C', fill=True)
+    return pdf
+
+@app.route('/reports/aging')
+@login_required
+@reporting_route
+def aging_report():
+    # Ages count to when the data is from, which is earlier on a snapshot
+    as_of = g.get('snapshot_as_of') or datetime.now()
+    sort = request.args.get('sort') if request.args.get('sort') in AGING_SORTS else 'total'
+    query = aging_query(as_of, sort)
+    export = request.args.get('format')
+
+    if export == 'csv':
+        rows = db.session.execute(query.execution_options(yield_per=500))
+        return Response(stream_with_context(aging_csv(rows)), mimetype='text/csv; charset=utf-8',
+                        headers={'Content-Disposition': f'attachment; filename=aging_{as_of:%Y-%m-%d}.csv'})
+    if export == 'pdf':
+        rows = db.session.execute(query.execution_options(yield_per=500))
+        pdf = aging_pdf(rows, f'أعمار الديون حتى {as_of:%Y-%m-%d}')
+        return send_file(io.BytesIO(pdf_bytes(pdf)), download_name=f'aging_{as_of:%Y-%m-%d}.pdf',
+                         as_attachment=True, mimetype='application/pdf')
+
+    page = max(1, request.args.get('page', 1, type=int))
+    rows = db.session.execute(query.limit(AGING_PER_PAGE).offset((page - 1) * AGING_PER_PAGE)).all()
+    totals = {column: getattr(rows[0], f'all_{column}') if rows else 0
+              for column in [column for column, _, _ in AGING_BUCKETS] + ['total']}
+    clients = rows[0].clients if rows else 0
+    return render_template('aging.html', rows=rows, totals=totals, clients=clients, page=page,
+                           pages=max(1, -(-clients // AGING_PER_PAGE)), sort=sort, buckets=AGING_BUCKETS,
+                           as_of=as_of)
+
+
+def to_piastres(amount):
+    return int(round((amount or 0) * 100))
 
+def allocate_payments(payments):
+    """Spread client payments over their open invoices, oldest first.
+
+    Each payment is a dict with client_id, amount and payment_method, and
+    optionally notes, reference and payment_date; several payments of one
+    client are applied in the order given. The open invoices of all the
+    clients come from one query ordered the way they are paid off, and a
+    single merge over them and the payments works out every share in whole
+    piastres. The invoices are then updated and the payments inserted with
+    one executemany statement each; the caller commits.
+
+    Returns the amount of each payment that was left over, in order.
+    """
+    by_client = {}
+    for index, payment in enumerate(payments):
+        by_client.setdefault(payment['client_id'], []).append(index)
+    leftover = [to_piastres(payment['amount']) for payment in payments]
+    if not by_client:
+        return [0.0] * len(payments)
+
+    open_invoices = db.session.execute(
+        db.select(Invoice.id, Invoice.client_id, Invoice.total_amount, Invoice.paid_amount)
+        .where(Invoice.client_id.in_(by_client), open_invoice_condition())
+        .order_by(Invoice.client_id, Invoice.date, Invoice.id)
+    )
+
+    invoice_updates, payment_rows = [], []
+    queues = {client_id: iter(indexes) for client_id, indexes in by_client.items()}
+    current = {client_id: next(queue) for client_id, queue in queues.items()}
+    for invoice_id, client_id, total, paid in open_invoices:
+        total, paid = to_piastres(total), to_piastres(paid)
+        owed = total - paid
+        while owed > 0 and current[client_id] is not None:
+            index = current[client_id]
+            share = min(owed, leftover[index])
+            if share > 0:
+                payment = payments[index]
+                payment_rows.append({
+                    'invoice_id': invoice_id,
+                    'amount': share / 100,
+                    'payment_method': payment['payment_method'],
+                    'payment_date': payment.get('payment_date') or datetime.utcnow(),
+                    'notes': payment.get('notes', ''),
+                    'reference': payment.get('reference'),
+                })
+                leftover[index] -= share
+                owed -= share
+            if leftover[index] == 0:
+                current[client_id] = next(queues[client_id], None)
+        if owed < total - paid:
+            status = 'paid' if owed <= 0 else 'partial'
+            invoice_updates.append({
+                'id': invoice_id,
+                'paid_amount': (total - owed) / 100,
+                'remaining_amount': owed / 100,
+                'payment_status': status,
+                'status': status,
+            })
+
+    if invoice_updates:
+        db.session.execute(db.update(Invoice), invoice_updates)
+        log_changes(Invoice, 'update', [row['id'] for row in invoice_updates])
+    if payment_rows:
+        payment_ids = db.session.scalars(
+            db.insert(Payment).returning(Payment.id, sort_by_parameter_order=True), payment_rows
+        ).all()
+        log_changes(Payment, 'insert', payment_ids)
+    return [amount / 100 for amount in leftover]
 
 @app.route('/client/<int:client_id>/add_payment', methods=['POST'])
 @login_required
@@ -718,36 +2048,12 @@ def add_client_payment(client_id):
     payment_method = request.form['payment_method']
     notes = request.form.get('notes', '')
 
-    # Get all unpaid invoices for this client
-    unpaid_invoices = Invoice.query.filter_by(client_id=client_id)\
-        .filter(Invoice.status.in_(['pending', 'partial']))\
-        .order_by(Invoice.date).all()
-
-    remaining_payment = amount
-    for invoice in unpaid_invoices:
-        if remaining_payment <= 0:
-            break
-
-        payment_for_invoice = min(remaining_payment, invoice.remaining_amount)
-        
-        payment = Payment(
-            invoice_id=invoice.id,
-            amount=payment_for_invoice,
-            payment_method=payment_method,
-            notes=f"دفع من {client.name}: {notes}"
-        )
-        
-        invoice.paid_amount += payment_for_invoice
-        invoice.remaining_amount = invoice.total_amount - invoice.paid_amount
-        
-        if invoice.remaining_amount <= 0:
-            invoice.payment_status = 'paid'
-        else:
-            invoice.payment_status = 'partial'
-            
-        remaining_payment -= payment_for_invoice
-        db.session.add(payment)
-        
+    remaining_payment = allocate_payments([{
+        'client_id': client.id,
+        'amount': amount,
+        'payment_method': payment_method,
+        'notes': f"دفع من {client.name}: {notes}"
+    }])[0]
     db.session.commit()
     unpaid_count = Invoice.query.filter_by(client_id=client_id)\
         .filter(Invoice.status.in_(['pending', 'partial']))\
@@ -761,11 +2067,120 @@ def add_client_payment(client_id):
     return redirect(url_for('debtors'))
 
 
+def read_payment_csv(stream):
+    """Parse a bank/wallet statement export into allocate_payments() rows.
+
+    Columns: client_id or phone, amount, and optionally payment_method,
+    date (YYYY-MM-DD), reference and notes. Clients and already imported
+    references are looked up with one query each, not per row. Returns
+    (payments, rejected), rejected being (line number, reason) pairs.
+    """
+    lines = []
+    for line_number, row in enumerate(csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig')), start=2):
+        lines.append((line_number, {(key or '').strip().lower(): (value or '').strip() for key, value in row.items()}))
+
+    phones = {row['phone'] for _, row in lines if row.get('phone')}
+    client_ids = {int(row['client_id']) for _, row in lines if row.get('client_id', '').isdigit()}
+    clients = {}
+    for client_id, phone in db.session.query(Client.id, Client.phone)\
+            .filter(db.or_(Client.phone.in_(phones), Client.id.in_(client_ids))).order_by(Client.id.desc()):
+        clients[phone] = client_id
+        clients[str(client_id)] = client_id
+    references = {row['reference'] for _, row in lines if row.get('reference')}
+    seen = {reference for (reference,) in db.session.query(Payment.reference).filter(Payment.reference.in_(references))
+            .union(db.session.query(PaymentHistory.reference).filter(PaymentHistory.reference.in_(references)))}
+
+    payments, rejected = [], []
+    for line_number, row in lines:
+        client_id = clients.get(row.get('client_id')) or clients.get(row.get('phone'))
+        try:
+            amount = float(row.get('amount', '').replace(',', ''))
+        except ValueError:
+            amount = 0
+        payment_date = parse_date(row.get('date')) if row.get('date') else datetime.utcnow()
+        payment_method = (row.get('payment_method') or 'bank').lower()
+        reference = row.get('reference') or None
+        if not client_id:
+            rejected.append((line_number, 'عميل غير موجود'))
+        elif not math.isfinite(amount) or amount <= 0:
+            rejected.append((line_number, 'مبلغ غير صحيح'))
+        elif payment_date is None:
+            rejected.append((line_number, 'تاريخ غير صحيح'))
+        elif payment_method not in PAYMENT_METHODS:
+            rejected.append((line_number, f'طريقة دفع غير معروفة: {payment_method}'))
+        elif reference in seen:
+            rejected.append((line_number, f'تم استيراده من قبل: {reference}'))
+        else:
+            if reference:
+                seen.add(reference)
+            payments.append({
+                'client_id': client_id,
+                'amount': amount,
+                'payment_method': payment_method,
+                'payment_date': payment_date,
+                'reference': reference,
+                'notes': row.get('notes') or f'استيراد كشف حساب {reference or ""}'.strip(),
+                'line': line_number,
+            })
+    return payments, rejected
+
+def import_payments(stream):
+    """Allocate every payment of a statement in one transaction; returns a summary."""
+    payments, rejected = read_payment_csv(stream)
+    leftovers = allocate_payments(payments)
+    db.session.commit()
+    return {
+        'imported': len(payments),
+        'amount': sum(payment['amount'] for payment in payments),
+        'unallocated': [(payment['line'], leftover) for payment, leftover in zip(payments, leftovers) if leftover > 0],
+        'rejected': rejected,
+    }
+
+@app.route('/payments/import', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def import_payments_page():
+    result = None
+    if request.method == 'POST':
+        file = request.files.get('payments_file')
+        if not file or not file.filename.lower().endswith('.csv'):
+            flash('اختر ملف CSV', 'error')
+            return redirect(url_for('import_payments_page'))
+        try:
+            result = import_payments(file.stream)
+        except UnicodeDecodeError:
+            flash('الملف ليس بترميز UTF-8', 'error')
+            return redirect(url_for('import_payments_page'))
+        flash(f"تم استيراد {result['imported']} دفعة", 'success')
+    return render_template('payments_import.html', result=result)
+
+@app.cli.command('import-payments')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_payments_command(path):
+    """Import a CSV of client payments, allocated to their oldest invoices first."""
+    with open(path, 'rb') as stream:
+        try:
+            result = import_payments(stream)
+        except UnicodeDecodeError:
+            raise click.ClickException(f'{path} is not UTF-8')
+    click.echo(f"Imported {result['imported']} payments ({result['amount']:.2f}), "
+               f"{len(result['unallocated'])} with money left over, {len(result['rejected'])} rejected")
+    for line_number, reason in result['rejected']:
+        click.echo(f'  line {line_number}: {reason}')
+
 @app.route('/clients')
 @login_required
 def list_clients():
-    clients = Client.query.all()
-    return render_template('clients/list.html', clients=clients)
+    """Clients with their invoice count, purchases and debt, in one grouped query."""
+    clients = db.session.query(
+        Client,
+        db.func.count(Invoice.id),
+        db.func.coalesce(db.func.sum(Invoice.total_amount), 0),
+        db.func.coalesce(db.func.sum(db.case(
+            (Invoice.status.in_(['pending', 'partial']), Invoice.remaining_amount), else_=0
+        )), 0)
+    ).outerjoin(Invoice).group_by(Client.id).order_by(Client.id)
+    return stream_template('clients/list.html', clients=stream_rows(clients, Client.id))
 
 @app.route('/clients/export')
 @login_required
@@ -830,11 +2245,113 @@ def view_warehouse(warehouse_id):
     stocks = JeansStock.query.filter_by(warehouse_id=warehouse_id).all()
     return render_template('warehouses/view.html', warehouse=warehouse, stocks=stocks)
 
+INVOICES_PER_PAGE = 50
+INVOICE_FILTERS = ('status', 'payment_method', 'client_id', 'date_from', 'date_to')
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+def local_to_utc(moment):
+    """A naive local time as naive UTC, the clock of the utcnow() columns."""
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+@app.template_filter('local_time')
+def utc_to_local(moment):
+    return moment.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None) if moment else moment
+
+def encode_invoice_cursor(invoice):
+    return f"{invoice.date.strftime('%Y%m%d%H%M%S%f')}-{invoice.id}"
+
+def decode_invoice_cursor(cursor):
+    try:
+        date, invoice_id = cursor.split('-')
+        return datetime.strptime(date, '%Y%m%d%H%M%S%f'), int(invoice_id)
+    except (AttributeError, ValueError):
+        return None
+
+def invoice_page(args):
+    """Return one page of invoices (newest first) and the cursor of the next page.
+
+    Pages are keyed on (date, id) instead of OFFSET so every page costs the
+    same index seek no matter how deep the user scrolls.
+    """
+    query = filter_invoices(Invoice.query.options(db.joinedload(Invoice.client)), args)
+
+    cursor = decode_invoice_cursor(args.get('before'))
+    if cursor:
+        cursor_date, cursor_id = cursor
+        query = query.filter(
+            Invoice.date <= cursor_date,
+            db.or_(Invoice.date < cursor_date, Invoice.id < cursor_id)
+        )
+
+    per_page = max(1, min(args.get('per_page', INVOICES_PER_PAGE, type=int), 200))
+    invoices = query.order_by(Invoice.date.desc(), Invoice.id.desc())\
+        .limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(invoices) > per_page:
+        invoices = invoices[:per_page]
+        next_cursor = encode_invoice_cursor(invoices[-1])
+    return invoices, next_cursor
+
+def filter_invoices(query, args):
+    """Apply the invoice list filters (INVOICE_FILTERS) from args to query."""
+    if args.get('status'):
+        query = query.filter(Invoice.status == args['status'])
+    if args.get('payment_method'):
+        query = query.filter(Invoice.payment_method == args['payment_method'])
+    if args.get('client_id', type=int):
+        query = query.filter(Invoice.client_id == args.get('client_id', type=int))
+    date_from = parse_date(args.get('date_from'))
+    if date_from:
+        query = query.filter(Invoice.date >= date_from)
+    date_to = parse_date(args.get('date_to'))
+    if date_to:
+        query = query.filter(Invoice.date < date_to + timedelta(days=1))
+    return query
+
+def invoice_to_dict(invoice):
+    return {
+        'id': invoice.id,
+        'invoice_number': invoice.invoice_number,
+        'client_id': invoice.client_id,
+        'client_name': invoice.client.name if invoice.client else None,
+        'date': invoice.date.strftime('%Y-%m-%d'),
+        'total_amount': invoice.total_amount,
+        'paid_amount': invoice.paid_amount,
+        'remaining_amount': invoice.remaining_amount,
+        'payment_method': invoice.payment_method,
+        'status': invoice.status,
+        'edit_url': url_for('edit_invoice', invoice_id=invoice.id),
+        'delete_url': url_for('delete_invoice', invoice_id=invoice.id),
+        'print_url': url_for('print_invoice', invoice_id=invoice.id)
+    }
+
 @app.route('/invoices')
 @login_required
+@query_budget(4)
 def list_invoices():
-    invoices = Invoice.query.order_by(Invoice.date.desc()).all()
-    return render_template('invoices/list.html', invoices=invoices)
+    invoices, next_cursor = invoice_page(request.args)
+    filters = {key: request.args[key] for key in INVOICE_FILTERS if request.args.get(key)}
+    client = Client.query.get(filters['client_id']) if 'client_id' in filters else None
+    return stream_template('invoices/list.html',
+                         invoices=invoices,
+                         next_cursor=next_cursor,
+                         filters=filters,
+                         client=client)
+
+@app.route('/api/invoices')
+@login_required
+def api_invoices():
+    invoices, next_cursor = invoice_page(request.args)
+    return jsonify({
+        'invoices': [invoice_to_dict(invoice) for invoice in invoices],
+        'next_cursor': next_cursor
+    })
 
 @app.route('/invoice/create', methods=['GET', 'POST'])
 @login_required
@@ -925,32 +2442,149 @@ def new_client():
     return render_template('clients/new.html')
 
 
-@app.route('/invoice/<int:invoice_id>/edit', methods=['GET', 'POST'])
-@login_required
+def split_values(text):
+    """'30, 32،34' -> ['30', '32', '34'], without blanks or repeats."""
+    values = []
+    for value in (text or '').replace('،', ',').split(','):
+        value = value.strip()
+        if value and value not in values:
+            values.append(value)
+    return values
+
+def sync_variants(jeans):
+    """Create the variants for every size and color listed on the product.
+
+    Variants that are no longer listed are kept, since stock and invoice
+    lines may point at them.
+    """
+    existing = {(variant.size, variant.color) for variant in jeans.variants}
+    for size in split_values(jeans.sizes):
+        for color in split_values(jeans.colors):
+            if (size, color) not in existing:
+                db.session.add(JeansVariant(jeans=jeans, size=size, color=color))
+
+PRODUCTS_PER_PAGE = 20
+
+@app.route('/api/jeans/search')
+@login_required
+def search_jeans():
+    """One page of products matching q by name or barcode, with their stock.
+
+    Pages are keyed on (name, id) so SQLite walks ix_jeans_name_id and
+    stops after the page; the stock of the whole page comes from a single
+    grouped query instead of loading every product's stock rows.
+    """
+    q = request.args.get('q', '').strip()
+    per_page = max(1, min(request.args.get('per_page', PRODUCTS_PER_PAGE, type=int), 100))
+    page = db.select(Jeans.id, Jeans.name, Jeans.barcode, Jeans.price)
+    if q:
+        page = page.where(db.or_(Jeans.name.contains(q), Jeans.barcode.startswith(q)))
+    after = db.session.get(Jeans, request.args.get('after', type=int)) if request.args.get('after') else None
+    if after:
+        page = page.where(db.tuple_(Jeans.name, Jeans.id) > db.tuple_(after.name, after.id))
+    page = page.order_by(Jeans.name, Jeans.id).limit(per_page + 1).subquery()
+
+    rows = db.session.query(
+        page.c.id, page.c.name, page.c.barcode, page.c.price,
+        JeansStock.warehouse_id, db.func.sum(JeansStock.quantity)
+    ).outerjoin(JeansStock, JeansStock.jeans_id == page.c.id)\
+     .group_by(page.c.id, JeansStock.warehouse_id)\
+     .order_by(page.c.name, page.c.id)
+
+    products = {}
+    for jeans_id, name, barcode, price, warehouse_id, quantity in rows:
+        product = products.setdefault(jeans_id, {
+            'id': jeans_id, 'name': name, 'barcode': barcode, 'price': price, 'total': 0, 'stock': {}
+        })
+        if warehouse_id is not None:
+            product['stock'][warehouse_id] = quantity or 0
+            product['total'] += quantity or 0
+    products = list(products.values())
+
+    next_cursor = None
+    if len(products) > per_page:
+        products = products[:per_page]
+        next_cursor = products[-1]['id']
+    return jsonify({'products': products, 'next_cursor': next_cursor})
+
+@app.route('/api/jeans/<int:jeans_id>/variants')
+@login_required
+def jeans_variants(jeans_id):
+    """Stock of a product per variant and warehouse, for the invoice editor."""
+    rows = db.session.query(JeansStock.variant_id, JeansStock.warehouse_id, JeansStock.quantity)\
+        .filter(JeansStock.jeans_id == jeans_id, JeansStock.quantity > 0)
+    stock = {}
+    for variant_id, warehouse_id, quantity in rows:
+        stock.setdefault(variant_id, {})[warehouse_id] = quantity
+    variants = JeansVariant.query.filter_by(jeans_id=jeans_id).order_by(JeansVariant.id).all()
+    return jsonify({
+        'variants': [{'id': variant.id, 'label': variant.label, 'size': variant.size, 'color': variant.color,
+                      'stock': stock.get(variant.id, {})} for variant in variants],
+        'unassigned': stock.get(None, {})
+    })
+
+@app.cli.command('split-variants')
+def split_variants_command():
+    """Create variants from the size and color strings of every product.
+
+    Stock of products with a single size and color moves onto that
+    variant; other stock stays unassigned until it is counted per variant.
+    """
+    created = assigned = last_id = 0
+    while True:
+        products = Jeans.query.options(db.selectinload(Jeans.variants))\
+            .filter(Jeans.id > last_id).order_by(Jeans.id).limit(500).all()
+        if not products:
+            break
+        for jeans in products:
+            before = len(jeans.variants)
+            sync_variants(jeans)
+            db.session.flush()
+            created += len(jeans.variants) - before
+            if len(jeans.variants) == 1:
+                unassigned = db.and_(JeansStock.jeans_id == jeans.id, JeansStock.variant_id.is_(None))
+                moved = sync_ids(JeansStock, unassigned)
+                assigned += JeansStock.query.filter(unassigned).update({'variant_id': jeans.variants[0].id})
+                log_changes(JeansStock, 'update', moved)
+        last_id = products[-1].id
+        db.session.commit()
+    click.echo(f'Created {created} variants; moved {assigned} stock rows onto their only variant')
+
+@app.route('/invoice/<int:invoice_id>/edit', methods=['GET', 'POST'])
+@login_required
+@query_budget(12)
 def edit_invoice(invoice_id):
     invoice = Invoice.query.get_or_404(invoice_id)
-    jeans = Jeans.query.all()
     warehouses = Warehouse.query.all()
-    for item in invoice.items:
-        item.product_name = item.jeans.name
     return render_template('invoices/edit.html', 
                          invoice=invoice, 
-                         jeans=jeans,
                          warehouses=warehouses)
 
 
 @app.route('/invoice/<int:invoice_id>/add_item', methods=['POST'])
 @login_required
+@query_budget(10)
 def add_invoice_item(invoice_id):
     invoice = Invoice.query.get_or_404(invoice_id)
+    if invoice.status == 'cancelled':
+        flash('لا يمكن تعديل فاتورة ملغاة')
+        return redirect(url_for('edit_invoice', invoice_id=invoice_id))
     jeans_id = request.form.get('jeans_id')
     warehouse_id = request.form.get('warehouse_id')
+    # No variant means the product's stock that is not split by size and color
+    variant_id = request.form.get('variant_id', type=int)
     quantity = int(request.form.get('quantity'))
     
     stock = JeansStock.query.filter_by(
         jeans_id=jeans_id,
-        warehouse_id=warehouse_id
+        warehouse_id=warehouse_id,
+        variant_id=variant_id
     ).first()
+    if stock is None and variant_id is None:
+        # A product stocked as a single variant sells without picking it
+        stocks = JeansStock.query.filter_by(jeans_id=jeans_id, warehouse_id=warehouse_id).limit(2).all()
+        if len(stocks) == 1:
+            stock, variant_id = stocks[0], stocks[0].variant_id
     
     if not stock or stock.quantity < quantity:
         flash(f'الكمية المتوفرة في المخزن: {stock.quantity if stock else 0}')
@@ -962,7 +2596,8 @@ def add_invoice_item(invoice_id):
     existing_item = InvoiceItem.query.filter_by(
         invoice_id=invoice_id,
         jeans_id=jeans_id,
-        warehouse_id=warehouse_id
+        warehouse_id=warehouse_id,
+        variant_id=variant_id
     ).first()
     
     if existing_item:
@@ -974,6 +2609,7 @@ def add_invoice_item(invoice_id):
             invoice_id=invoice_id,
             jeans_id=jeans_id,
             warehouse_id=warehouse_id,
+            variant_id=variant_id,
             quantity=quantity,
             price=jeans.price,
             subtotal=subtotal
@@ -982,15 +2618,7 @@ def add_invoice_item(invoice_id):
         invoice.total_amount += subtotal
     
     stock.quantity -= quantity
-    
-    sale = Sale(
-        jeans_id=jeans_id,
-        quantity=quantity,
-        total_amount=subtotal,
-        sale_date=datetime.utcnow()
-    )
-    
-    db.session.add(sale)
+    stock_reason('sale', f'invoice:{invoice_id}')
     db.session.commit()
     
     flash('تم إضافة المنتج بنجاح!')
@@ -998,10 +2626,13 @@ def add_invoice_item(invoice_id):
 
 
 class StyledPDF(FPDF):
+    # The page heading; FPDF's own title is document metadata and must stay latin-1
+    heading = ''
+
     def header(self):
         self.set_font('Amiri', 'B', 16)
         self.set_text_color(0, 102, 204)
-        self.cell(0, 10, self.title, ln=True, align='C')
+        self.cell(0, 10, self.heading, ln=True, align='C')
         self.ln(10)
 
     def footer(self):
@@ -1010,16 +2641,26 @@ class StyledPDF(FPDF):
         self.cell(0, 10, 'Page %s' % self.page_no(), align='C')
 import arabic_reshaper
 from bidi.algorithm import get_display
+FONT_DIR = os.path.join(BASE_DIR, 'static', 'fonts')
+
+def add_amiri_fonts(pdf):
+    # Every registered font writes its full width table into the document
+    # (~0.3 s each), so only the styles the PDFs use are added
+    pdf.add_font('Amiri', '', os.path.join(FONT_DIR, 'Amiri-Regular.ttf'), uni=True)
+    pdf.add_font('Amiri', 'B', os.path.join(FONT_DIR, 'Amiri-Bold.ttf'), uni=True)
+    pdf.add_font('Amiri', 'I', os.path.join(FONT_DIR, 'Amiri-Italic.ttf'), uni=True)
+
+def pdf_bytes(pdf):
+    # fpdf 1.7 returns the document as a latin-1 str
+    return pdf.output(dest='S').encode('latin-1')
+
 def create_sales_pdf(sales_data, title):
     pdf = StyledPDF()
     # Add all required fonts
-    pdf.add_font('Amiri', '', 'static/fonts/Amiri-Regular.ttf', uni=True)
-    pdf.add_font('Amiri', 'B', 'static/fonts/Amiri-Bold.ttf', uni=True)
-    pdf.add_font('Amiri', 'I', 'static/fonts/Amiri-Italic.ttf', uni=True)
-    pdf.add_font('Amiri', 'BI', 'static/fonts/Amiri-BoldItalic.ttf', uni=True)
+    add_amiri_fonts(pdf)
 
     pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.title = get_display(arabic_reshaper.reshape(title))  # Process title for Arabic
+    pdf.heading = get_display(arabic_reshaper.reshape(title))  # Process title for Arabic
     pdf.add_page()
 
     # Table header
@@ -1050,66 +2691,311 @@ def create_sales_pdf(sales_data, title):
 
     return pdf
 
+def sales_since(start_date=None):
+    """(date, amount) rows for sales on or after start_date.
+
+    Hot sales come back one row per invoice line; archived periods come back
+    as one row per day from SalesSummary.
+    """
+    hot = db.session.query(InvoiceItem.sale_date, InvoiceItem.subtotal).filter(InvoiceItem.sale_date.is_not(None))
+    archived = db.session.query(SalesSummary.day, db.func.sum(SalesSummary.total_amount))\
+        .group_by(SalesSummary.day)
+    if start_date:
+        hot = hot.filter(InvoiceItem.sale_date >= start_date)
+        archived = archived.filter(SalesSummary.day >= start_date)
+    return archived.order_by(SalesSummary.day).all() + hot.order_by(InvoiceItem.sale_date).all()
+
 @app.route('/download_sales_pdf/<period>')
 @login_required
+@reporting_route
 def download_sales_pdf(period):
     today = datetime.now()
 
     if period == 'day':
         start_date = today.date()
         title = f"مبيعات اليوم {start_date}"
-        sales = Sale.query.filter(db.func.date(Sale.sale_date) == start_date).all()
 
     elif period == 'week':
         start_date = today.date() - timedelta(days=7)
         title = "مبيعات الأسبوع"
-        sales = Sale.query.filter(Sale.sale_date >= start_date).all()
 
     elif period == 'month':
-        start_date = today.replace(day=1)
+        start_date = today.date().replace(day=1)
         title = "مبيعات الشهر"
-        sales = Sale.query.filter(Sale.sale_date >= start_date).all()
 
     else:  # total
+        start_date = None
         title = "إجمالي المبيعات"
-        sales = Sale.query.all()
 
-    sales_data = [(sale.sale_date, sale.total_amount) for sale in sales]
+    if g.get('snapshot_as_of'):
+        title = f"{title} - حتى {g.snapshot_as_of:%Y-%m-%d %H:%M}"
+    sales_data = sales_since(start_date)
     pdf = create_sales_pdf(sales_data, title)
 
-    # Write PDF to BytesIO without encoding issues
-    pdf_output = io.BytesIO()
-    pdf.output(pdf_output)
-    pdf_output.seek(0)
-
     return send_file(
-        pdf_output,
+        io.BytesIO(pdf_bytes(pdf)),
         download_name=f'sales_{period}.pdf',
         as_attachment=True,
         mimetype='application/pdf'
     )
     
+app.config['PDF_WORKERS'] = int(os.environ.get('PDF_WORKERS', os.cpu_count() or 1))
+PDF_CACHE_DIR = os.path.join(BASE_DIR, 'instance', 'pdf_cache')
+PDF_CACHE_MAX_FILES = 2000
+# Smaller batches are shaped in-process; the pool only pays off above this
+PDF_POOL_MIN_BATCH = 20
+MAX_PRINT_BATCH = 1000
+# Column titles and widths of the invoice table, laid out left to right
+INVOICE_PDF_COLUMNS = (('المجموع', 40), ('السعر', 35), ('الكمية', 25), ('المنتج', 90))
+
+def shape(text):
+    return get_display(arabic_reshaper.reshape(str(text)))
+
+def money(amount):
+    return f"{amount or 0:,.2f} جنيه"
+
+def invoice_pdf_data(invoice):
+    """Everything the PDF shows, as plain values that can be sent to a worker process."""
+    client = invoice.client
+    return {
+        'title': f'فاتورة رقم {invoice.invoice_number}',
+        'details': [
+            f'السيد/ {client.name if client else ""}',
+            client.phone if client else '',
+            f"التاريخ: {invoice.date.strftime('%Y-%m-%d')}",
+            f"طريقة الدفع: {invoice.payment_method or 'كاش'}",
+        ],
+        'lines': [(' - '.join(filter(None, [item.jeans.name if item.jeans else '',
+                                            item.variant.label if item.variant else ''])),
+                   item.quantity, item.price, item.subtotal)
+                  for item in invoice.line_items],
+        'totals': [('إجمالي الفاتورة', invoice.total_amount), ('المبلغ المدفوع', invoice.paid_amount)]
+                  + ([('المبلغ المتبقي', invoice.remaining_amount)] if (invoice.remaining_amount or 0) > 0 else []),
+    }
+
+def shape_invoice(data):
+    """Reshape and reorder every Arabic string of an invoice for the PDF.
+
+    This is the expensive part of rendering and needs nothing but the
+    data, so batches run it in worker processes.
+    """
+    return {
+        'title': shape(data['title']),
+        'details': [shape(line) for line in data['details'] if line],
+        'header': [shape(title) for title, width in INVOICE_PDF_COLUMNS],
+        'lines': [(shape(money(subtotal)), shape(money(price)), str(quantity), shape(name))
+                  for name, quantity, price, subtotal in data['lines']],
+        'totals': [(shape(money(amount)), shape(label)) for label, amount in data['totals']],
+        'footer': shape('شكراً لتعاملكم معنا'),
+    }
+
+def draw_invoice(pdf, shaped):
+    pdf.heading = shaped['title']
+    pdf.add_page()
+    pdf.set_font('Amiri', '', 12)
+    for line in shaped['details']:
+        pdf.cell(0, 8, line, ln=True, align='R')
+    pdf.ln(5)
+
+    pdf.set_font('Amiri', 'B', 12)
+    pdf.set_fill_color(230, 230, 230)
+    for title, (_, width) in zip(shaped['header'], INVOICE_PDF_COLUMNS):
+        pdf.cell(width, 10, title, border=1, align='C', fill=True)
+    pdf.ln()
+
+    pdf.set_font('Amiri', '', 12)
+    for row in shaped['lines']:
+        for value, (_, width) in zip(row, INVOICE_PDF_COLUMNS):
+            pdf.cell(width, 10, value, border=1, align='C')
+        pdf.ln()
+
+    pdf.ln(5)
+    pdf.set_font('Amiri', 'B', 12)
+    for amount, label in shaped['totals']:
+        pdf.cell(60, 10, amount, border=1, align='C')
+        pdf.cell(60, 10, label, border=1, align='C', fill=True)
+        pdf.ln()
+
+    pdf.ln(10)
+    pdf.set_font('Amiri', '', 12)
+    pdf.cell(0, 10, shaped['footer'], ln=True, align='C')
+
+def render_invoices_pdf(shaped_invoices):
+    pdf = StyledPDF()
+    add_amiri_fonts(pdf)
+    pdf.set_auto_page_break(auto=True, margin=15)
+    for shaped in shaped_invoices:
+        draw_invoice(pdf, shaped)
+    return pdf_bytes(pdf)
+
+pdf_pool = None
+pdf_pool_lock = threading.Lock()
+
+def shape_invoices(datas):
+    global pdf_pool
+    workers = app.config['PDF_WORKERS']
+    if workers < 2 or len(datas) < PDF_POOL_MIN_BATCH:
+        return [shape_invoice(data) for data in datas]
+    with pdf_pool_lock:
+        if pdf_pool is None:
+            pdf_pool = ProcessPoolExecutor(max_workers=workers)
+    return list(pdf_pool.map(shape_invoice, datas, chunksize=max(1, len(datas) // (workers * 4))))
+
+def cached_pdf(key, render, stale_prefix=None):
+    """Return the PDF stored under key, rendering and storing it on a miss.
+
+    Keys include pdf_fingerprint() of what the PDF shows, so an edited
+    invoice, or a renamed client or product, never hits an old file;
+    stale_prefix names the older files to remove on a miss.
+    """
+    path = os.path.join(PDF_CACHE_DIR, f'{key}.pdf')
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        metrics.record_cache('invoice_pdf', True)
+        return data
+    except FileNotFoundError:
+        metrics.record_cache('invoice_pdf', False)
+
+    data = render()
+    os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+    temp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp, 'wb') as f:
+        f.write(data)
+    os.replace(temp, path)
+
+    # Other workers prune the same directory, so files may vanish under us
+    names = os.listdir(PDF_CACHE_DIR)
+    if stale_prefix:
+        for name in names:
+            if name.startswith(stale_prefix) and name != f'{key}.pdf':
+                with suppress(FileNotFoundError):
+                    os.remove(os.path.join(PDF_CACHE_DIR, name))
+    if len(names) > PDF_CACHE_MAX_FILES:
+        paths = sorted((os.path.join(PDF_CACHE_DIR, name) for name in names), key=modified_time)
+        for old in paths[:len(paths) - PDF_CACHE_MAX_FILES]:
+            if old != path:
+                with suppress(FileNotFoundError):
+                    os.remove(old)
+    return data
+
+def modified_time(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+def pdf_fingerprint(datas):
+    """A short hash of invoice_pdf_data() output, for cache keys."""
+    return hashlib.sha1(json.dumps(datas, ensure_ascii=False, default=str).encode()).hexdigest()[:16]
+
+def invoices_for_print():
+    return Invoice.query.options(
+        db.joinedload(Invoice.client),
+        db.selectinload(Invoice.items).joinedload(InvoiceItem.jeans),
+        db.selectinload(Invoice.items).joinedload(InvoiceItem.variant),
+        db.selectinload(Invoice.archived_items).joinedload(InvoiceItemHistory.jeans),
+        db.selectinload(Invoice.archived_items).joinedload(InvoiceItemHistory.variant),
+    )
+
+@app.route('/invoice/<int:invoice_id>/pdf')
+@login_required
+def invoice_pdf(invoice_id):
+    invoice = invoices_for_print().filter(Invoice.id == invoice_id).first_or_404()
+    pdf_data = invoice_pdf_data(invoice)
+    data = cached_pdf(
+        f'invoice-{invoice.id}-{pdf_fingerprint(pdf_data)}',
+        lambda: render_invoices_pdf([shape_invoice(pdf_data)]),
+        stale_prefix=f'invoice-{invoice.id}-'
+    )
+    return send_file(io.BytesIO(data), download_name=f'{invoice.invoice_number}.pdf', mimetype='application/pdf')
+
+@app.route('/invoices/print', methods=['GET', 'POST'])
+@login_required
+def print_invoices():
+    """One PDF of the selected invoices (POST invoice_ids) or of every
+    invoice matching the list filters (GET), oldest first."""
+    query = invoices_for_print()
+    if request.method == 'POST':
+        invoice_ids = [int(invoice_id) for invoice_id in request.form.getlist('invoice_ids') if invoice_id.isdigit()]
+        query = query.filter(Invoice.id.in_(invoice_ids))
+    else:
+        query = filter_invoices(query, request.args)
+    invoices = query.order_by(Invoice.date, Invoice.id).limit(MAX_PRINT_BATCH + 1).all()
+    if not invoices:
+        flash('لا توجد فواتير للطباعة', 'warning')
+        return redirect(url_for('list_invoices'))
+    if len(invoices) > MAX_PRINT_BATCH:
+        flash(f'لا يمكن طباعة أكثر من {MAX_PRINT_BATCH} فاتورة مرة واحدة', 'warning')
+        return redirect(url_for('list_invoices', **request.args))
+
+    started = time.perf_counter()
+    datas = [invoice_pdf_data(invoice) for invoice in invoices]
+    data = cached_pdf(f'batch-{pdf_fingerprint(datas)}', lambda: render_invoices_pdf(shape_invoices(datas)))
+    app.logger.info('Printed %d invoices in %.1f ms', len(invoices), (time.perf_counter() - started) * 1000)
+    return send_file(io.BytesIO(data), download_name=f'invoices_{datetime.now():%Y%m%d%H%M%S}.pdf',
+                     mimetype='application/pdf')
+
+def restore_stock(invoice_ids):
+    """Return the items of invoice_ids to warehouse stock in one grouped UPDATE."""
+    invoice_items = db.and_(
+        InvoiceItem.invoice_id.in_(invoice_ids),
+        InvoiceItem.jeans_id == JeansStock.jeans_id,
+        InvoiceItem.warehouse_id == JeansStock.warehouse_id,
+        InvoiceItem.variant_id.is_not_distinct_from(JeansStock.variant_id)
+    )
+    returned = db.select(db.func.sum(InvoiceItem.quantity)).where(invoice_items).scalar_subquery()
+    record_returned_stock(invoice_ids)
+    # Find the stock rows from the invoice lines first; testing every stock
+    # row against the lines took seconds for a thousand invoices
+    deltas = dict(db.session.query(JeansStock.id, db.func.sum(InvoiceItem.quantity))
+                  .join(InvoiceItem, invoice_items).group_by(JeansStock.id).all())
+    if deltas:
+        db.session.execute(
+            db.update(JeansStock)
+                .where(JeansStock.id.in_(list(deltas)))
+                .values(quantity=JeansStock.quantity + returned)
+        )
+    log_changes(JeansStock, 'update', list(deltas), deltas)
+
+def record_removed_lines(model, condition):
+    """Note the products of the invoice lines about to be deleted or voided."""
+    db.session.execute(db.insert(RemovedInvoiceLine).from_select(
+        ['jeans_id', 'removed_at'],
+        db.select(model.jeans_id, db.literal(datetime.utcnow())).where(condition, model.jeans_id.is_not(None))
+    ))
+
+def void_invoice_sales(invoice_ids):
+    """Take the lines of invoice_ids out of the sales figures; the lines stay on the invoices."""
+    sold = db.and_(InvoiceItem.invoice_id.in_(invoice_ids), InvoiceItem.sale_date.is_not(None))
+    voided = sync_ids(InvoiceItem, sold)
+    record_removed_lines(InvoiceItem, sold)
+    db.session.execute(
+        db.update(InvoiceItem).where(sold).values(sale_date=None)
+            .execution_options(synchronize_session=False)
+    )
+    log_changes(InvoiceItem, 'update', voided)
+
 @app.route('/invoice/<int:invoice_id>/delete', methods=['POST'])
 @login_required
 def delete_invoice(invoice_id):
     invoice = Invoice.query.get_or_404(invoice_id)
     
-    # Delete all invoice items first and restore stock
-    for item in invoice.items:
-        # Get the stock record for this item
-        stock = JeansStock.query.filter_by(
-            jeans_id=item.jeans_id,
-            warehouse_id=item.warehouse_id
-        ).first()
-        
-        if stock:
-            # Restore the quantity to warehouse stock
-            stock.quantity += item.quantity
-            
-        db.session.delete(item)
+    # Cancelled invoices already returned their stock
+    if invoice.status != 'cancelled':
+        restore_stock([invoice_id])
+    deleted_items = sync_ids(InvoiceItem, InvoiceItem.invoice_id == invoice_id)
+    deleted_payments = sync_ids(Payment, Payment.invoice_id == invoice_id)
+    record_removed_lines(InvoiceItem, InvoiceItem.invoice_id == invoice_id)
+    record_removed_lines(InvoiceItemHistory, InvoiceItemHistory.invoice_id == invoice_id)
+    InvoiceItem.query.filter_by(invoice_id=invoice_id).delete()
     
     # Delete any payments associated with this invoice
     Payment.query.filter_by(invoice_id=invoice_id).delete()
+    log_changes(InvoiceItem, 'delete', deleted_items)
+    log_changes(Payment, 'delete', deleted_payments)
+    InvoiceItemHistory.query.filter_by(invoice_id=invoice_id).delete()
+    PaymentHistory.query.filter_by(invoice_id=invoice_id).delete()
     
     # Delete the invoice
     db.session.delete(invoice)
@@ -1118,30 +3004,61 @@ def delete_invoice(invoice_id):
     flash('تم حذف الفاتورة بنجاح', 'success')
     return redirect(url_for('list_invoices'))
 
+@app.route('/invoices/cancel', methods=['POST'])
+@login_required
+def cancel_invoices():
+    """Void many invoices at once: stock comes back, their sales are dropped
+    and the invoices stay on record as cancelled with nothing left to pay."""
+    invoice_ids = [int(invoice_id) for invoice_id in request.form.getlist('invoice_ids') if invoice_id.isdigit()]
+    started = time.perf_counter()
+    open_ids = [invoice_id for (invoice_id,) in db.session.query(Invoice.id)
+        .filter(Invoice.id.in_(invoice_ids), Invoice.status != 'cancelled')]
+
+    if open_ids:
+        try:
+            restore_stock(open_ids)
+            void_invoice_sales(open_ids)
+            db.session.execute(
+                db.update(Invoice)
+                    .where(Invoice.id.in_(open_ids))
+                    .values(status='cancelled', payment_status='cancelled', remaining_amount=0)
+            )
+            log_changes(Invoice, 'update', open_ids)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    app.logger.info('Cancelled %d invoices in %.1f ms', len(open_ids), elapsed_ms)
+    flash(f'تم إلغاء {len(open_ids)} فاتورة ({elapsed_ms:.0f} ms)', 'success')
+    return redirect(url_for('list_invoices'))
+
 @app.route('/invoice/<int:invoice_id>/delete_item/<int:item_id>', methods=['POST'])
 @login_required
 def delete_invoice_item(invoice_id, item_id):
     item = InvoiceItem.query.get_or_404(item_id)
     invoice = Invoice.query.get_or_404(invoice_id)
+    # A cancelled invoice's stock has already been returned
+    if invoice.status == 'cancelled':
+        flash('لا يمكن تعديل فاتورة ملغاة')
+        return redirect(url_for('edit_invoice', invoice_id=invoice_id))
     
-    # Restore the quantity back to inventory
-    jeans = Jeans.query.get(item.jeans_id)
-    jeans.quantity += item.quantity
-    
-    # Update invoice total
-    invoice.total_amount -= item.subtotal
-    
-    # Delete the sale record
-    sale = Sale.query.filter_by(
+    # Restore the quantity back to the warehouse it was taken from
+    stock = JeansStock.query.filter_by(
         jeans_id=item.jeans_id,
-        quantity=item.quantity,
-        total_amount=item.subtotal
+        warehouse_id=item.warehouse_id,
+        variant_id=item.variant_id
     ).first()
+    if stock:
+        stock.quantity += item.quantity
+        stock_reason('return', f'invoice:{invoice_id}')
     
-    if sale:
-        db.session.delete(sale)
+    # Update invoice total
+    invoice.total_amount -= item.subtotal
     
-    # Delete the invoice item
+    # Delete the invoice item, and its sale with it
+    record_removed_lines(InvoiceItem, InvoiceItem.id == item.id)
     db.session.delete(item)
     db.session.commit()
     
@@ -1149,9 +3066,1668 @@ def delete_invoice_item(invoice_id, item_id):
 @app.route('/invoice/<int:invoice_id>/print')
 @login_required
 def print_invoice(invoice_id):
-    invoice = Invoice.query.get_or_404(invoice_id)
+    invoice = invoices_for_print().filter(Invoice.id == invoice_id).first_or_404()
     return render_template('invoices/print.html', invoice=invoice, timedelta=timedelta)
 
+def closed_invoice_ids(cutoff):
+    return db.select(Invoice.id).where(
+        Invoice.date < cutoff,
+        Invoice.status == 'paid',
+        Invoice.remaining_amount <= 0
+    )
+
+def move_rows(model, history_model, condition):
+    """Copy the rows matching condition into history_model, then delete them."""
+    columns = [column.name for column in history_model.__table__.columns]
+    source = [getattr(model, name) for name in columns]
+    moved = db.session.execute(
+        db.insert(history_model).from_select(columns, db.select(*source).where(condition))
+    ).rowcount
+    db.session.execute(db.delete(model).where(condition))
+    return moved
+
+def archive_closed_periods(cutoff):
+    """Move the items and payments of invoices settled before cutoff into
+    the history tables in one transaction.
+
+    The archived items' sales are also rolled up into SalesSummary so period
+    reports keep working from a handful of rows per day.
+    """
+    closed = closed_invoice_ids(cutoff)
+    archived_items = InvoiceItem.invoice_id.in_(closed)
+    sale_day = db.func.date(InvoiceItem.sale_date)
+    summary = sqlite_insert(SalesSummary).from_select(
+        ['day', 'jeans_id', 'sale_count', 'quantity', 'total_amount'],
+        db.select(
+            sale_day,
+            InvoiceItem.jeans_id,
+            db.func.count(InvoiceItem.id),
+            db.func.sum(InvoiceItem.quantity),
+            db.func.sum(InvoiceItem.subtotal)
+        ).where(archived_items, InvoiceItem.sale_date.is_not(None)).group_by(sale_day, InvoiceItem.jeans_id)
+    )
+    summary = summary.on_conflict_do_update(
+        index_elements=['day', 'jeans_id'],
+        set_={
+            'sale_count': SalesSummary.sale_count + summary.excluded.sale_count,
+            'quantity': SalesSummary.quantity + summary.excluded.quantity,
+            'total_amount': SalesSummary.total_amount + summary.excluded.total_amount
+        }
+    )
+
+    try:
+        db.session.execute(summary)
+        counts = {
+            'invoice_items': move_rows(InvoiceItem, InvoiceItemHistory, archived_items),
+            'payments': move_rows(Payment, PaymentHistory, Payment.invoice_id.in_(closed))
+        }
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return counts
+
+@app.cli.command('archive')
+@click.option('--before', help='Archive everything dated before this day (YYYY-MM-DD).')
+@click.option('--months', default=12, show_default=True,
+              help='When --before is not given, keep this many whole months hot.')
+def archive_command(before, months):
+    """Move closed periods out of the invoice_item and payment tables."""
+    cutoff = parse_date(before)
+    if before and not cutoff:
+        raise click.BadParameter('expected YYYY-MM-DD', param_hint='--before')
+    if not cutoff:
+        month_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        year, month = divmod(month_start.year * 12 + month_start.month - 1 - months, 12)
+        cutoff = month_start.replace(year=year, month=month + 1)
+
+    counts = archive_closed_periods(cutoff)
+    click.echo(f"Archived before {cutoff.date()}: "
+               f"{counts['invoice_items']} invoice items, "
+               f"{counts['payments']} payments")
+
+SYNCED_MODELS = {model.__tablename__: model for model in
+                 (Warehouse, Jeans, JeansVariant, JeansStock, Client, Invoice, InvoiceItem, Payment)}
+# Columns that are never overwritten by a remote update
+SYNC_IMMUTABLE = {'invoice': {'invoice_number'}, 'jeans_stock': {'quantity'}}
+SYNC_BATCH_SIZE = 1000
+# Rows both branches already have without a sync key, e.g. those of the
+# database they were both copied from, are matched on these columns
+SYNC_NATURAL_KEYS = {
+    'warehouse': ('name',),
+    'jeans': ('barcode', 'name'),
+    'jeans_variant': ('jeans_id', 'size', 'color'),
+    'jeans_stock': ('jeans_id', 'warehouse_id', 'variant_id'),
+    'client': ('phone', 'name'),
+    'invoice': ('invoice_number', 'date'),
+    'invoice_item': ('invoice_id', 'jeans_id', 'warehouse_id', 'variant_id'),
+    'payment': ('invoice_id', 'payment_date'),
+}
+
+class SyncError(Exception):
+    """A change or request from a peer that cannot be applied here."""
+
+def encode_value(value):
+    return value.isoformat() if isinstance(value, (datetime, date)) else value
+
+def row_data(obj):
+    return {column.name: encode_value(getattr(obj, column.name)) for column in obj.__table__.columns}
+
+def stock_delta(obj, operation):
+    if operation == 'insert':
+        return obj.quantity or 0
+    history = db.inspect(obj).attrs.quantity.history
+    if not history.added or not history.deleted:
+        return 0
+    return (history.added[0] or 0) - (history.deleted[0] or 0)
+
+@event.listens_for(RoutingSession, 'after_flush')
+def capture_changes(session, flush_context):
+    """Append every flushed change to a synced table to the change log,
+    in the same transaction as the change itself."""
+    if not app.config['BRANCH_ID']:
+        return
+    origin = session.info.get('sync_origin', app.config['BRANCH_ID'])
+    changes = []
+    for operation, objects in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for obj in objects:
+            table = getattr(obj, '__tablename__', None)
+            if table not in SYNCED_MODELS:
+                continue
+            if operation == 'update' and not session.is_modified(obj, include_collections=False):
+                continue
+            data = None
+            if operation != 'delete':
+                data = row_data(obj)
+                if table == 'jeans_stock':
+                    data['quantity_delta'] = stock_delta(obj, operation)
+            changes.append({
+                'table_name': table, 'row_id': obj.id, 'operation': operation, 'origin': origin,
+                'data': json.dumps(data) if data is not None else None, 'changed_at': datetime.utcnow()
+            })
+    if changes:
+        session.connection().execute(ChangeLog.__table__.insert(), changes)
+
+def sync_ids(model, condition):
+    """Ids a bulk statement is about to touch, when changes are being logged."""
+    if not app.config['BRANCH_ID']:
+        return []
+    return [row_id for (row_id,) in db.session.query(model.id).filter(condition)]
+
+def log_changes(model, operation, ids, deltas=None):
+    """Log changes made by bulk statements, which bypass the flush hook."""
+    if not app.config['BRANCH_ID'] or not ids:
+        return
+    origin = db.session.info.get('sync_origin', app.config['BRANCH_ID'])
+    rows = {row_id: None for row_id in ids}
+    if operation != 'delete':
+        rows = {obj.id: row_data(obj) for obj in model.query.filter(model.id.in_(ids)).populate_existing()}
+        for row_id, delta in (deltas or {}).items():
+            rows[row_id]['quantity_delta'] = delta
+    db.session.execute(ChangeLog.__table__.insert(), [
+        {'table_name': model.__tablename__, 'row_id': row_id, 'operation': operation, 'origin': origin,
+         'data': json.dumps(data) if data is not None else None, 'changed_at': datetime.utcnow()}
+        for row_id, data in rows.items()
+    ])
+
+def foreign_tables(model):
+    return {column.name: next(iter(column.foreign_keys)).column.table.name
+            for column in model.__table__.columns if column.foreign_keys}
+
+def key_lookup(wanted):
+    """A global_key(table, local_id) function for the ids in wanted, a
+    {table: ids} dict: [origin, origin_id] for rows received from another
+    branch, [BRANCH_ID, local_id] for our own."""
+    keys = {}
+    for table, ids in wanted.items():
+        for key in SyncKey.query.filter(SyncKey.table_name == table, SyncKey.local_id.in_(ids)):
+            keys[table, key.local_id] = [key.origin, key.origin_id]
+
+    def global_key(table, local_id):
+        if local_id is None:
+            return None
+        # Form values can reach the flush as strings
+        local_id = int(local_id)
+        return keys.get((table, local_id), [app.config['BRANCH_ID'], local_id])
+    return global_key
+
+def export_changes(changes):
+    """Serialize change log rows, replacing local ids with branch-neutral
+    [origin, origin_id] keys so the receiving branch can map them."""
+    wanted = {}
+    for change in changes:
+        wanted.setdefault(change.table_name, set()).add(change.row_id)
+        for column, table in foreign_tables(SYNCED_MODELS[change.table_name]).items():
+            data = json.loads(change.data) if change.data else {}
+            if data.get(column) is not None:
+                wanted.setdefault(table, set()).add(int(data[column]))
+    global_key = key_lookup(wanted)
+
+    exported = []
+    for change in changes:
+        data = json.loads(change.data) if change.data else None
+        if data:
+            data.pop('id', None)
+            for column, table in foreign_tables(SYNCED_MODELS[change.table_name]).items():
+                data[column] = global_key(table, data.get(column))
+        exported.append({
+            'seq': change.seq, 'table': change.table_name, 'op': change.operation, 'origin': change.origin,
+            'key': global_key(change.table_name, change.row_id), 'data': data
+        })
+    return exported
+
+def local_id_for(table, key):
+    if key is None:
+        return None
+    origin, origin_id = key
+    if origin == app.config['BRANCH_ID']:
+        return origin_id
+    mapped = SyncKey.query.filter_by(table_name=table, origin=origin, origin_id=origin_id).first()
+    return mapped.local_id if mapped else None
+
+def local_ids_for(table, keys):
+    """local_id_for many keys at once, as a {(origin, origin_id): local_id} dict."""
+    found = {(origin, origin_id): origin_id for origin, origin_id in keys if origin == app.config['BRANCH_ID']}
+    remote = {origin_id for origin, origin_id in keys if origin != app.config['BRANCH_ID']}
+    for key in SyncKey.query.filter(SyncKey.table_name == table, SyncKey.origin_id.in_(remote)):
+        if (key.origin, key.origin_id) in keys:
+            found[key.origin, key.origin_id] = key.local_id
+    return found
+
+def decode_row(model, data):
+    row = {}
+    for column in model.__table__.columns:
+        if column.name == 'id' or column.name not in data:
+            continue
+        value = data[column.name]
+        if column.foreign_keys and value is not None:
+            table = next(iter(column.foreign_keys)).column.table.name
+            origin, origin_id = value
+            value = local_id_for(table, value)
+            if value is None:
+                raise SyncError(f'{model.__tablename__}.{column.name} refers to {table} {origin_id} of '
+                                f'branch {origin}, which is not known here; sync with --bootstrap '
+                                f'to match the rows both branches already have')
+        elif value is not None and isinstance(column.type, db.DateTime):
+            value = datetime.fromisoformat(value)
+        elif value is not None and isinstance(column.type, db.Date):
+            value = date.fromisoformat(value)
+        row[column.name] = value
+    return row
+
+def apply_change(change):
+    """Apply one remote change. Stock quantities merge by adding the
+    remote delta; every other column is last-writer-wins."""
+    table = change['table']
+    model = SYNCED_MODELS[table]
+    local_id = local_id_for(table, change['key'])
+    obj = db.session.get(model, local_id) if local_id else None
+
+    if change['op'] == 'delete':
+        if obj:
+            if model is InvoiceItem:
+                record_removed_lines(InvoiceItem, InvoiceItem.id == obj.id)
+            db.session.delete(obj)
+        return
+
+    row = decode_row(model, change['data'])
+    delta = change['data'].get('quantity_delta')
+    if model is InvoiceItem and obj is not None and obj.sale_date is not None and row.get('sale_date') is None:
+        record_removed_lines(InvoiceItem, InvoiceItem.id == obj.id)
+
+    if obj is None:
+        # The same product or stock row may already exist here under its own id
+        if model is Jeans and row.get('barcode'):
+            obj = Jeans.query.filter_by(barcode=row['barcode']).first()
+        elif model is JeansVariant:
+            obj = JeansVariant.query.filter_by(jeans_id=row.get('jeans_id'), size=row.get('size'), color=row.get('color')).first()
+        elif model is JeansStock:
+            obj = JeansStock.query.filter_by(jeans_id=row.get('jeans_id'), warehouse_id=row.get('warehouse_id'),
+                                             variant_id=row.get('variant_id')).first()
+        created = obj is None
+        if created:
+            if model is Invoice and Invoice.query.filter_by(invoice_number=row.get('invoice_number')).first():
+                row['invoice_number'] = f"{row['invoice_number']}-{change['key'][0]}"
+            obj = model(**row)
+            db.session.add(obj)
+            db.session.flush()
+        if change['key'][0] != app.config['BRANCH_ID']:
+            db.session.add(SyncKey(table_name=table, local_id=obj.id, origin=change['key'][0], origin_id=change['key'][1]))
+        if created:
+            return
+
+    for column, value in row.items():
+        if column not in SYNC_IMMUTABLE.get(table, ()):
+            setattr(obj, column, value)
+    if model is JeansStock:
+        obj.quantity = (obj.quantity or 0) + (delta or 0)
+
+def sync_peer(branch_id, url=None):
+    peer = SyncPeer.query.filter_by(branch_id=branch_id).first()
+    if not peer:
+        peer = SyncPeer(branch_id=branch_id, last_pulled_seq=0, last_pushed_seq=0)
+        db.session.add(peer)
+    if url:
+        peer.url = url
+    return peer
+
+def apply_changes(branch_id, changes):
+    """Apply a batch of a peer's changes in one transaction, skipping any
+    already applied; returns the peer's last applied seq."""
+    peer = sync_peer(branch_id)
+    try:
+        for change in sorted(changes, key=lambda change: change['seq']):
+            if change['seq'] <= peer.last_pulled_seq:
+                continue
+            if change['table'] not in SYNCED_MODELS:
+                # Tables a peer on an older version still logs, e.g. sale
+                peer.last_pulled_seq = change['seq']
+                continue
+            db.session.info['sync_origin'] = change['origin']
+            apply_change(change)
+            db.session.flush()
+            db.session.info.pop('sync_origin')
+            peer.last_pulled_seq = change['seq']
+        peer.last_synced_at = datetime.utcnow()
+        db.session.commit()
+    except Exception:
+        db.session.info.pop('sync_origin', None)
+        db.session.rollback()
+        raise
+    return peer.last_pulled_seq
+
+def natural_keys(table, after, limit=SYNC_BATCH_SIZE):
+    """Our rows of table after id after, as [global_key, natural_key] pairs;
+    returns them with the last id listed and whether there are more."""
+    model = SYNCED_MODELS[table]
+    columns = SYNC_NATURAL_KEYS[table]
+    references = foreign_tables(model)
+    rows = db.session.query(model.id, *(getattr(model, column) for column in columns))\
+        .filter(model.id > after).order_by(model.id).limit(limit).all()
+    wanted = {table: {row[0] for row in rows}}
+    for position, column in enumerate(columns, 1):
+        if column in references:
+            wanted.setdefault(references[column], set()).update(row[position] for row in rows if row[position] is not None)
+    global_key = key_lookup(wanted)
+    keys = [[global_key(table, row[0]),
+             [global_key(references[column], value) if column in references else encode_value(value)
+              for column, value in zip(columns, row[1:])]]
+            for row in rows]
+    return keys, rows[-1][0] if rows else after, len(rows) == limit
+
+def match_keys(table, keys):
+    """Map a peer's rows, listed by natural_keys(), to the rows here with
+    the same natural key that are not mapped from that branch yet. Rows with
+    equal natural keys pair up in id order. Returns how many were mapped."""
+    model = SYNCED_MODELS[table]
+    columns = SYNC_NATURAL_KEYS[table]
+    references = foreign_tables(model)
+    parents = {}
+    for position, column in enumerate(columns):
+        if column in references:
+            parents[column] = local_ids_for(references[column], {tuple(natural[position]) for _, natural in keys
+                                                                 if natural[position] is not None})
+    known = local_ids_for(table, {tuple(key) for key, _ in keys})
+
+    wanted = []
+    for (origin, origin_id), natural in keys:
+        if (origin, origin_id) in known:
+            continue
+        local = []
+        for column, value in zip(columns, natural):
+            if column in parents and value is not None:
+                value = parents[column].get(tuple(value))
+                if value is None:
+                    break  # a row it refers to is not known here
+            local.append(value)
+        else:
+            wanted.append((origin, origin_id, tuple(local)))
+    if not wanted:
+        return 0
+
+    first = getattr(model, columns[0])
+    values = {local[0] for _, _, local in wanted}
+    condition = first.in_(values - {None})
+    if None in values:
+        condition = db.or_(condition, first.is_(None))
+    candidates = {}
+    for row in db.session.query(model.id, *(getattr(model, column) for column in columns)).filter(condition).order_by(model.id):
+        natural = tuple(value if column in references else encode_value(value) for column, value in zip(columns, row[1:]))
+        candidates.setdefault(natural, []).append(row[0])
+    candidate_ids = [local_id for ids in candidates.values() for local_id in ids]
+    taken = {(key.local_id, key.origin) for key in SyncKey.query.filter(SyncKey.table_name == table,
+                                                                       SyncKey.local_id.in_(candidate_ids))}
+    mapped = 0
+    for origin, origin_id, local in wanted:
+        local_id = next((local_id for local_id in candidates.get(local, ()) if (local_id, origin) not in taken), None)
+        if local_id is None:
+            continue
+        taken.add((local_id, origin))
+        db.session.add(SyncKey(table_name=table, local_id=local_id, origin=origin, origin_id=origin_id))
+        mapped += 1
+    db.session.flush()
+    return mapped
+
+def changes_for(branch_id, since, limit=SYNC_BATCH_SIZE):
+    """Our log after since, minus what branch_id itself sent us."""
+    return ChangeLog.query.filter(ChangeLog.seq > since, ChangeLog.origin != branch_id,
+                                  ChangeLog.table_name.in_(SYNCED_MODELS))\
+        .order_by(ChangeLog.seq).limit(limit).all()
+
+def sync_authorized():
+    token = app.config['SYNC_TOKEN']
+    return bool(app.config['BRANCH_ID'] and token) and \
+        request.headers.get('Authorization') == f'Bearer {token}'
+
+@app.route('/sync/status')
+def sync_status():
+    if not sync_authorized():
+        return jsonify({'error': 'sync is disabled or the token is wrong'}), 403
+    return jsonify({
+        'branch': app.config['BRANCH_ID'],
+        'last_seq': db.session.query(db.func.max(ChangeLog.seq)).scalar() or 0
+    })
+
+@app.route('/sync/changes')
+def sync_changes():
+    if not sync_authorized():
+        return jsonify({'error': 'sync is disabled or the token is wrong'}), 403
+    since = request.args.get('since', 0, type=int)
+    limit = max(1, min(request.args.get('limit', SYNC_BATCH_SIZE, type=int), SYNC_BATCH_SIZE))
+    changes = changes_for(request.args.get('branch', ''), since, limit)
+    return jsonify({
+        'branch': app.config['BRANCH_ID'],
+        'changes': export_changes(changes),
+        'more': len(changes) == limit
+    })
+
+@app.route('/sync/changes', methods=['POST'])
+def receive_changes():
+    if not sync_authorized():
+        return jsonify({'error': 'sync is disabled or the token is wrong'}), 403
+    payload = request.get_json()
+    try:
+        acked_seq = apply_changes(payload['branch'], payload['changes'])
+    except SyncError as error:
+        return jsonify({'error': str(error)}), 409
+    return jsonify({'branch': app.config['BRANCH_ID'], 'acked_seq': acked_seq})
+
+@app.route('/sync/keys')
+def sync_keys():
+    if not sync_authorized():
+        return jsonify({'error': 'sync is disabled or the token is wrong'}), 403
+    table = request.args.get('table')
+    if table not in SYNCED_MODELS:
+        return jsonify({'error': f'unknown table {table}'}), 400
+    keys, last_id, more = natural_keys(table, request.args.get('after', 0, type=int))
+    return jsonify({'branch': app.config['BRANCH_ID'], 'keys': keys, 'next': last_id, 'more': more})
+
+@app.route('/sync/keys', methods=['POST'])
+def receive_keys():
+    if not sync_authorized():
+        return jsonify({'error': 'sync is disabled or the token is wrong'}), 403
+    payload = request.get_json()
+    if payload.get('table') not in SYNCED_MODELS:
+        return jsonify({'error': f"unknown table {payload.get('table')}"}), 400
+    mapped = match_keys(payload['table'], payload['keys'])
+    db.session.commit()
+    return jsonify({'branch': app.config['BRANCH_ID'], 'mapped': mapped})
+
+def sync_request(url, payload=None):
+    body = json.dumps(payload).encode() if payload is not None else None
+    sync_call = urllib.request.Request(url, data=body, headers={
+        'Authorization': f"Bearer {app.config['SYNC_TOKEN']}",
+        'Content-Type': 'application/json'
+    })
+    try:
+        with urllib.request.urlopen(sync_call, timeout=60) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as error:
+        try:
+            message = json.load(error)['error']
+        except (ValueError, KeyError):
+            message = f'{error.code} {error.reason}'
+        raise SyncError(f'{url}: {message}') from error
+
+def exchange_keys(call):
+    """Map the rows both branches already have to each other, in both
+    directions; returns how many were mapped here and at the peer."""
+    mapped = 0
+    for table in SYNCED_MODELS:
+        last_id, more = 0, True
+        while more:
+            page = call(f"/sync/keys?{urllib.parse.urlencode({'table': table, 'after': last_id})}")
+            mapped += match_keys(table, page['keys'])
+            db.session.commit()
+            last_id, more = page['next'], page['more']
+        last_id, more = 0, True
+        while more:
+            keys, last_id, more = natural_keys(table, last_id)
+            if keys:
+                mapped += call('/sync/keys', {'branch': app.config['BRANCH_ID'], 'table': table, 'keys': keys})['mapped']
+    return mapped
+
+def sync_with(call, peer_url=None, bootstrap=False):
+    """Pull the peer's changes since the last sync, then push ours.
+    call(path, payload=None) sends one request to the peer and returns its
+    JSON. The first sync with a peer, or any with bootstrap, first maps the
+    rows both already have. Returns the peer's branch id and the numbers of
+    rows mapped, changes pulled and changes pushed."""
+    branch_id = call('/sync/status')['branch']
+    peer = sync_peer(branch_id, peer_url)
+    bootstrap = bootstrap or peer.last_synced_at is None
+    db.session.commit()
+
+    mapped = exchange_keys(call) if bootstrap else 0
+
+    pulled = 0
+    while True:
+        query = urllib.parse.urlencode({'since': peer.last_pulled_seq, 'branch': app.config['BRANCH_ID']})
+        batch = call(f'/sync/changes?{query}')
+        apply_changes(branch_id, batch['changes'])
+        pulled += len(batch['changes'])
+        if not batch['more']:
+            break
+
+    pushed = 0
+    while True:
+        changes = changes_for(branch_id, peer.last_pushed_seq)
+        if not changes:
+            break
+        result = call('/sync/changes', {'branch': app.config['BRANCH_ID'], 'changes': export_changes(changes)})
+        peer.last_pushed_seq = result['acked_seq']
+        db.session.commit()
+        pushed += sum(1 for change in changes if change.seq <= result['acked_seq'])
+        if result['acked_seq'] < changes[-1].seq:
+            break
+    return branch_id, mapped, pulled, pushed
+
+@app.cli.command('sync')
+@click.argument('peer_url')
+@click.option('--bootstrap', is_flag=True,
+              help='Map the rows both branches already have first; the first sync with a peer always does.')
+def sync_command(peer_url, bootstrap):
+    """Pull the peer's changes since the last sync, then push ours."""
+    if not (app.config['BRANCH_ID'] and app.config['SYNC_TOKEN']):
+        raise click.UsageError('set BRANCH_ID and SYNC_TOKEN to sync')
+    peer_url = peer_url.rstrip('/')
+    try:
+        branch_id, mapped, pulled, pushed = sync_with(
+            lambda path, payload=None: sync_request(peer_url + path, payload), peer_url, bootstrap)
+    except SyncError as error:
+        raise click.ClickException(str(error))
+
+    if mapped:
+        click.echo(f'Mapped {mapped} rows both branches already had')
+    click.echo(f'Synced with {branch_id}: pulled {pulled} changes, pushed {pushed} changes')
+
+STOCK_SNAPSHOT_INTERVAL = timedelta(days=1)
+
+def stock_reason(movement_type, reference=None):
+    """Label the stock changes of the current transaction in the ledger."""
+    db.session.info['stock_reason'] = (movement_type, reference)
+
+@event.listens_for(RoutingSession, 'after_flush')
+def record_stock_movements(session, flush_context):
+    """Write one ledger row per flushed change to a stock quantity."""
+    if 'sync_origin' in session.info:
+        movement_type, reference = 'sync', session.info['sync_origin']
+    else:
+        movement_type, reference = session.info.get('stock_reason', ('adjustment', None))
+    movements = []
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, JeansStock):
+            continue
+        if obj in session.new:
+            delta = obj.quantity or 0
+        elif obj in session.deleted:
+            delta = -(db.inspect(obj).attrs.quantity.loaded_value or 0)
+        else:
+            history = db.inspect(obj).attrs.quantity.history
+            if not history.added or not history.deleted:
+                continue
+            delta = (history.added[0] or 0) - (history.deleted[0] or 0)
+        if delta:
+            movements.append({
+                'jeans_id': int(obj.jeans_id), 'warehouse_id': int(obj.warehouse_id),
+                'variant_id': int(obj.variant_id) if obj.variant_id else None,
+                'movement_type': movement_type, 'reference': reference,
+                'delta': delta, 'created_at': datetime.utcnow()
+            })
+    if movements:
+        session.connection().execute(StockMovement.__table__.insert(), movements)
+
+@event.listens_for(RoutingSession, 'after_commit')
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def clear_stock_reason(session, *args):
+    session.info.pop('stock_reason', None)
+
+def record_returned_stock(invoice_ids):
+    """Ledger rows for restore_stock(), which updates stock in bulk."""
+    columns = ('jeans_id', 'warehouse_id', 'variant_id', 'movement_type', 'reference', 'delta', 'created_at')
+    returned = db.select(
+        InvoiceItem.jeans_id, InvoiceItem.warehouse_id, InvoiceItem.variant_id, db.literal('return'),
+        db.literal('invoice:') + db.cast(InvoiceItem.invoice_id, db.String),
+        db.func.sum(InvoiceItem.quantity), db.literal(datetime.utcnow())
+    ).join(JeansStock, db.and_(
+        JeansStock.jeans_id == InvoiceItem.jeans_id, JeansStock.warehouse_id == InvoiceItem.warehouse_id,
+        JeansStock.variant_id.is_not_distinct_from(InvoiceItem.variant_id)
+    )).where(InvoiceItem.invoice_id.in_(invoice_ids))\
+        .group_by(InvoiceItem.invoice_id, InvoiceItem.jeans_id, InvoiceItem.warehouse_id, InvoiceItem.variant_id)
+    db.session.execute(StockMovement.__table__.insert().from_select(columns, returned))
+
+def take_stock_snapshot():
+    """Copy the current stock into a new snapshot and return it."""
+    snapshot = StockSnapshot(
+        taken_at=datetime.utcnow(),
+        last_movement_id=db.session.query(db.func.max(StockMovement.id)).scalar() or 0
+    )
+    db.session.add(snapshot)
+    db.session.flush()
+    db.session.execute(StockSnapshotLine.__table__.insert().from_select(
+        ('snapshot_id', 'jeans_id', 'warehouse_id', 'quantity'),
+        db.select(db.literal(snapshot.id), JeansStock.jeans_id, JeansStock.warehouse_id, db.func.sum(JeansStock.quantity))
+            .group_by(JeansStock.jeans_id, JeansStock.warehouse_id)
+            .having(db.func.sum(JeansStock.quantity) != 0)
+    ))
+    db.session.commit()
+    return snapshot
+
+def stock_on(at, warehouse_id=None):
+    """{(jeans_id, warehouse_id): quantity} on hand at the given UTC time.
+
+    Starts from the last snapshot taken before then and adds the movements
+    since; before the first snapshot it walks back from that one instead,
+    and with no snapshot at all from the live stock. Either way only the
+    movements between the starting point and the time are read.
+    """
+    snapshot = StockSnapshot.query.filter(StockSnapshot.taken_at <= at)\
+        .order_by(StockSnapshot.taken_at.desc()).first()
+    forward = snapshot is not None
+    if not forward:
+        snapshot = StockSnapshot.query.order_by(StockSnapshot.taken_at).first()
+
+    stock = Counter()
+    if snapshot:
+        lines = db.session.query(StockSnapshotLine.jeans_id, StockSnapshotLine.warehouse_id, StockSnapshotLine.quantity)\
+            .filter(StockSnapshotLine.snapshot_id == snapshot.id)
+        if warehouse_id:
+            lines = lines.filter(StockSnapshotLine.warehouse_id == warehouse_id)
+    else:
+        lines = db.session.query(JeansStock.jeans_id, JeansStock.warehouse_id, db.func.sum(JeansStock.quantity))\
+            .group_by(JeansStock.jeans_id, JeansStock.warehouse_id)
+        if warehouse_id:
+            lines = lines.filter(JeansStock.warehouse_id == warehouse_id)
+    for jeans_id, line_warehouse_id, quantity in lines:
+        stock[jeans_id, line_warehouse_id] = quantity or 0
+
+    movements = db.session.query(StockMovement.jeans_id, StockMovement.warehouse_id, db.func.sum(StockMovement.delta))
+    if forward:
+        movements = movements.filter(StockMovement.id > snapshot.last_movement_id, StockMovement.created_at <= at)
+        sign = 1
+    else:
+        movements = movements.filter(StockMovement.created_at > at)
+        if snapshot:
+            movements = movements.filter(StockMovement.id <= snapshot.last_movement_id)
+        sign = -1
+    if warehouse_id:
+        movements = movements.filter(StockMovement.warehouse_id == warehouse_id)
+    for jeans_id, movement_warehouse_id, delta in movements.group_by(StockMovement.jeans_id, StockMovement.warehouse_id):
+        stock[jeans_id, movement_warehouse_id] += sign * delta
+    return {key: quantity for key, quantity in stock.items() if quantity}
+
+@app.route('/stock/history')
+@login_required
+@reporting_route
+def stock_history():
+    """Stock and its value per warehouse at the end of a chosen day, a
+    local calendar day; the ledger's times are UTC."""
+    day = parse_date(request.args.get('date')) or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    day_end = local_to_utc(day + timedelta(days=1))
+    warehouse_id = request.args.get('warehouse_id', type=int)
+    stock = stock_on(day_end, warehouse_id)
+
+    products = {jeans.id: jeans for jeans in Jeans.query.filter(Jeans.id.in_({jeans_id for jeans_id, _ in stock}))}
+    warehouses = Warehouse.query.order_by(Warehouse.name).all()
+    warehouse_names = {warehouse.id: warehouse.name for warehouse in warehouses}
+    rows, totals = [], {}
+    for (jeans_id, row_warehouse_id), quantity in sorted(stock.items()):
+        jeans = products.get(jeans_id)
+        value = quantity * (jeans.price if jeans else 0)
+        rows.append({'jeans': jeans, 'warehouse': warehouse_names.get(row_warehouse_id, row_warehouse_id),
+                     'quantity': quantity, 'value': value})
+        total = totals.setdefault(warehouse_names.get(row_warehouse_id, row_warehouse_id), [0, 0.0])
+        total[0] += quantity
+        total[1] += value
+
+    movements = []
+    jeans_id = request.args.get('jeans_id', type=int)
+    if jeans_id:
+        movements = StockMovement.query.filter(StockMovement.jeans_id == jeans_id, StockMovement.created_at < day_end)
+        if warehouse_id:
+            movements = movements.filter(StockMovement.warehouse_id == warehouse_id)
+        movements = movements.order_by(StockMovement.id.desc()).limit(200).all()
+
+    return render_template('stock_history.html', day=day, rows=rows, totals=totals, warehouses=warehouses,
+                           warehouse_id=warehouse_id, jeans_id=jeans_id, movements=movements,
+                           warehouse_names=warehouse_names)
+
+@app.cli.command('stock-snapshot')
+@click.option('--if-older', is_flag=True, help='only when the last snapshot is older than a day')
+def stock_snapshot_command(if_older):
+    """Snapshot current stock so point-in-time queries stay short; run from cron."""
+    last = db.session.query(db.func.max(StockSnapshot.taken_at)).scalar()
+    if if_older and last and datetime.utcnow() - last < STOCK_SNAPSHOT_INTERVAL:
+        click.echo(f'Last snapshot {last:%Y-%m-%d %H:%M} is recent enough')
+        return
+    snapshot = take_stock_snapshot()
+    lines = StockSnapshotLine.query.filter_by(snapshot_id=snapshot.id).count()
+    click.echo(f'Snapshot {snapshot.id}: {lines} stock rows as of movement {snapshot.last_movement_id}')
+
+# Writes counted to tell whether the shop is busy
+MAINTENANCE_WRITE_WINDOW = timedelta(minutes=5)
+MAINTENANCE_INTERVAL = timedelta(hours=20)
+# A scheduler's claim on a run that has not finished by then is taken to have died with its worker
+MAINTENANCE_CLAIM_TIMEOUT = timedelta(hours=1)
+# Free pages released per incremental_vacuum step; the write lock is let go between steps
+VACUUM_STEP_PAGES = 1000
+AUTO_VACUUM_MODES = {0: 'none', 1: 'full', 2: 'incremental'}
+
+def recent_writes():
+    """Stock movements and invoices written in the last MAINTENANCE_WRITE_WINDOW."""
+    since = datetime.utcnow() - MAINTENANCE_WRITE_WINDOW
+    return StockMovement.query.filter(StockMovement.created_at >= since).count() + \
+        Invoice.query.filter(Invoice.date >= datetime.now() - MAINTENANCE_WRITE_WINDOW).count()
+
+def database_stats(connection, path):
+    def pragma(name):
+        return connection.exec_driver_sql(f'PRAGMA {name}').scalar()
+    wal = path + '-wal'
+    return {
+        'size': os.path.getsize(path),
+        'wal_size': os.path.getsize(wal) if os.path.exists(wal) else 0,
+        'page_size': pragma('page_size'),
+        'pages': pragma('page_count'),
+        'free_pages': pragma('freelist_count'),
+        'auto_vacuum': AUTO_VACUUM_MODES.get(pragma('auto_vacuum')),
+        'journal_mode': pragma('journal_mode'),
+    }
+
+def fragmentation(connection):
+    """Pages and unused space per table and index, from SQLite's dbstat
+    table; None when this SQLite build lacks it. Reads every page."""
+    try:
+        rows = connection.exec_driver_sql(
+            'SELECT name, COUNT(*), SUM(unused), SUM(pgsize) FROM dbstat GROUP BY name ORDER BY SUM(pgsize) DESC'
+        ).all()
+    except exc.OperationalError:
+        return None
+    return [{'name': name, 'pages': pages, 'bytes': size, 'unused_pct': round(100 * unused / size, 1) if size else 0}
+            for name, pages, unused, size in rows]
+
+@contextmanager
+def write_transaction(connection):
+    """BEGIN IMMEDIATE on an autocommit connection. Taking the write lock up
+    front waits out other writers; a statement that reads and then writes
+    gets SQLITE_BUSY at once, without waiting, if a writer got in between."""
+    connection.exec_driver_sql('BEGIN IMMEDIATE')
+    try:
+        yield
+    except BaseException:
+        connection.exec_driver_sql('ROLLBACK')
+        raise
+    connection.exec_driver_sql('COMMIT')
+
+def analyze(connection):
+    """Full ANALYZE the first time, PRAGMA optimize after that."""
+    has_stats = connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+    ).first()
+    with write_transaction(connection):
+        if not has_stats:
+            connection.exec_driver_sql('ANALYZE')
+        else:
+            # Look at every table, sampling at most 1000 rows of each index
+            connection.exec_driver_sql('PRAGMA analysis_limit = 1000')
+            connection.exec_driver_sql('PRAGMA optimize = 0x10002')
+    return 'optimize' if has_stats else 'analyze'
+
+def incremental_vacuum(connection):
+    """Hand the free pages back to the file system, a step at a time."""
+    if connection.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2:
+        return 'auto_vacuum is not incremental'
+    released = 0
+    while (free := connection.exec_driver_sql('PRAGMA freelist_count').scalar()) > 0:
+        # pysqlite steps the pragma once per execute, and each step frees one page
+        with write_transaction(connection):
+            for _ in range(min(free, VACUUM_STEP_PAGES)):
+                connection.exec_driver_sql('PRAGMA incremental_vacuum')
+        released += min(free, VACUUM_STEP_PAGES)
+        time.sleep(0.05)
+    return f'{released} pages released'
+
+def wal_checkpoint(connection):
+    if connection.exec_driver_sql('PRAGMA journal_mode').scalar() != 'wal':
+        return 'not in WAL mode'
+    busy, log_pages, checkpointed = connection.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)').one()
+    return f'{checkpointed}/{log_pages} pages checkpointed' + (', readers kept it from truncating' if busy else '')
+
+MAINTENANCE_TASKS = (('analyze', analyze), ('incremental_vacuum', incremental_vacuum), ('wal_checkpoint', wal_checkpoint))
+
+def run_maintenance(trigger, force=False, run_id=None):
+    """Run the maintenance tasks and record the run, in the claimed run_id
+    row if given. Unless forced, the run is skipped while the shop is
+    writing more than MAINTENANCE_MAX_WRITES rows per MAINTENANCE_WRITE_WINDOW."""
+    path = report_snapshot.source()
+    if path is None:
+        raise RuntimeError('database maintenance needs a SQLite database file')
+    run = db.session.get(MaintenanceRun, run_id) if run_id else MaintenanceRun(started_at=datetime.utcnow(), trigger=trigger)
+    writes = recent_writes()
+    if writes > app.config['MAINTENANCE_MAX_WRITES'] and not force:
+        run.status = 'skipped'
+        run.details = json.dumps({'reason': f'{writes} writes in the last {MAINTENANCE_WRITE_WINDOW}'})
+        db.session.add(run)
+        db.session.commit()
+        return run
+
+    started = time.perf_counter()
+    tasks = {}
+    run.status = 'done'
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        before = database_stats(connection, path)
+        for name, task in MAINTENANCE_TASKS:
+            task_started = time.perf_counter()
+            try:
+                result = task(connection)
+            except exc.OperationalError as error:
+                # Most likely the database stayed locked past the busy timeout
+                result, run.status = f'failed: {error.orig}', 'failed'
+            tasks[name] = {'ms': round((time.perf_counter() - task_started) * 1000, 1), 'result': result}
+        after = database_stats(connection, path)
+    run.duration_ms = round((time.perf_counter() - started) * 1000, 1)
+    run.size_before, run.size_after = before['size'], after['size']
+    run.free_pages_before, run.free_pages_after = before['free_pages'], after['free_pages']
+    run.wal_size_before, run.wal_size_after = before['wal_size'], after['wal_size']
+    run.details = json.dumps({'tasks': tasks, 'before': before, 'after': after})
+    db.session.add(run)
+    db.session.commit()
+    return run
+
+def in_maintenance_hours(now):
+    start, end = (int(hour) for hour in app.config['MAINTENANCE_HOURS'].split('-'))
+    return start <= now.hour < end if start <= end else (now.hour >= start or now.hour < end)
+
+def claim_maintenance_run(trigger):
+    """Claim the next run if maintenance is due and return its id, or None.
+
+    Every worker runs its own scheduler; checking and claiming in one
+    BEGIN IMMEDIATE transaction lets only the first of them run it.
+    """
+    if not in_maintenance_hours(datetime.now()):
+        return None
+    now = datetime.utcnow()
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        with write_transaction(connection):
+            last = connection.execute(db.select(db.func.max(MaintenanceRun.started_at)).where(db.or_(
+                MaintenanceRun.status == 'done',
+                db.and_(MaintenanceRun.status == 'running', MaintenanceRun.started_at >= now - MAINTENANCE_CLAIM_TIMEOUT)
+            ))).scalar()
+            if last is not None and now - last < MAINTENANCE_INTERVAL:
+                return None
+            return connection.execute(db.insert(MaintenanceRun).values(
+                started_at=now, trigger=trigger, status='running')).inserted_primary_key[0]
+
+class MaintenanceScheduler:
+    """Checks every CHECK_INTERVAL whether maintenance is due and runs it
+    in the background. Started by the first request when MAINTENANCE_SCHEDULE is set."""
+    CHECK_INTERVAL = 15 * 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='maintenance', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.CHECK_INTERVAL)
+            with app.app_context():
+                try:
+                    run_id = claim_maintenance_run('scheduler')
+                    if run_id is not None:
+                        run = run_maintenance('scheduler', run_id=run_id)
+                        app.logger.info('Database maintenance %s in %s ms', run.status, run.duration_ms)
+                except Exception:
+                    app.logger.exception('Database maintenance failed')
+
+maintenance_scheduler = MaintenanceScheduler()
+
+@app.before_request
+def start_maintenance_scheduler():
+    if app.config['MAINTENANCE_SCHEDULE']:
+        maintenance_scheduler.start()
+
+def format_size(size):
+    return f'{size / 1024 / 1024:.1f} MB'
+
+@app.cli.command('maintenance')
+@click.option('--force', is_flag=True, help='run even while the shop is busy writing')
+@click.option('--report', is_flag=True, help='only report fragmentation per table and index')
+@click.option('--enable-incremental-vacuum', is_flag=True,
+              help='switch an existing database to incremental vacuum (rewrites the whole file once)')
+def maintenance_command(force, report, enable_incremental_vacuum):
+    """Run ANALYZE/optimize, incremental vacuum and a WAL checkpoint; run from cron at quiet hours."""
+    path = report_snapshot.source()
+    if path is None:
+        raise click.UsageError('database maintenance needs a SQLite database file')
+    if report or enable_incremental_vacuum:
+        writes = recent_writes()
+        if enable_incremental_vacuum and writes > app.config['MAINTENANCE_MAX_WRITES'] and not force:
+            raise click.ClickException(f'{writes} writes in the last {MAINTENANCE_WRITE_WINDOW}; try again later')
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            if enable_incremental_vacuum:
+                started = time.perf_counter()
+                before = os.path.getsize(path)
+                use_incremental_vacuum(connection)
+                click.echo(f'Rebuilt with incremental vacuum in {time.perf_counter() - started:.1f} s: '
+                           f'{format_size(before)} -> {format_size(os.path.getsize(path))}')
+            if report:
+                stats = database_stats(connection, path)
+                click.echo(f"{format_size(stats['size'])}, {stats['pages']} pages of {stats['page_size']} bytes, "
+                           f"{stats['free_pages']} free; auto_vacuum {stats['auto_vacuum']}, "
+                           f"journal {stats['journal_mode']}, WAL {format_size(stats['wal_size'])}")
+                tables = fragmentation(connection)
+                if tables is None:
+                    click.echo('This SQLite build has no dbstat table for a per-table report')
+                for table in tables or []:
+                    click.echo(f"  {table['name']:<40} {table['pages']:>8} pages  {table['unused_pct']:>5}% unused")
+        return
+
+    run = run_maintenance('cli', force=force)
+    details = json.loads(run.details)
+    if run.status == 'skipped':
+        raise click.ClickException(f"Skipped: {details['reason']}; use --force to run anyway")
+    for name, task in details['tasks'].items():
+        click.echo(f"{name:<20} {task['ms']:>9.1f} ms  {task['result']}")
+    click.echo(f'{run.status} in {run.duration_ms:.0f} ms: {format_size(run.size_before)} -> '
+               f'{format_size(run.size_after)}, free pages {run.free_pages_before} -> {run.free_pages_after}, '
+               f'WAL {format_size(run.wal_size_before)} -> {format_size(run.wal_size_after)}')
+    if run.status == 'failed':
+        raise click.exceptions.Exit(1)
+
+# Customer analytics: RFM segments and products bought together, kept in
+# summary tables so the reports page never scans the invoice lines.
+# (segment, title, recency, frequency, monetary score ranges); a client
+# falls in the first segment whose ranges hold all three scores
+RFM_SEGMENTS = (
+    ('champions', 'أفضل العملاء', (4, 5), (4, 5), (4, 5)),
+    ('at_risk', 'مهددون بالفقد', (1, 2), (3, 5), (1, 5)),
+    ('loyal', 'عملاء دائمون', (3, 5), (4, 5), (1, 5)),
+    ('new', 'عملاء جدد', (4, 5), (1, 2), (1, 5)),
+    ('lost', 'عملاء مفقودون', (1, 2), (1, 2), (1, 5)),
+    ('regular', 'عملاء عاديون', (1, 5), (1, 5), (1, 5)),
+)
+# More changed products than this and the pairs are recounted from scratch
+ANALYTICS_MAX_INCREMENTAL = 500
+ANALYTICS_CHUNK_PRODUCTS = 500
+TOP_PAIRS = 10
+
+def rfm_score(column, order):
+    """1-5 by the rank of column among all clients; equal values score the same."""
+    return db.func.min(5, 1 + db.cast(db.func.percent_rank().over(order_by=order) * 5, db.Integer))
+
+def refresh_client_rfm():
+    """Rebuild client_rfm in one statement.
+
+    The per-client totals are grouped straight off ix_invoice_aging, which
+    holds every column they need, so this reads one index entry per
+    invoice and never the invoice lines. Returns the number of clients.
+    """
+    purchases = db.select(
+        Invoice.client_id,
+        db.func.max(Invoice.date).label('last_purchase'),
+        db.func.count().label('invoice_count'),
+        db.func.coalesce(db.func.sum(Invoice.total_amount), 0).label('monetary_total'),
+    ).where(Invoice.client_id.is_not(None), db.func.coalesce(Invoice.status, 'pending') != 'cancelled')\
+        .group_by(Invoice.client_id).subquery()
+    scored = db.select(
+        purchases,
+        rfm_score(purchases.c.last_purchase, purchases.c.last_purchase).label('recency'),
+        rfm_score(purchases.c.invoice_count, purchases.c.invoice_count).label('frequency'),
+        rfm_score(purchases.c.monetary_total, purchases.c.monetary_total).label('monetary'),
+    ).subquery()
+    segment = db.case(*[
+        (db.and_(scored.c.recency.between(*recency), scored.c.frequency.between(*frequency),
+                 scored.c.monetary.between(*monetary)), key)
+        for key, _, recency, frequency, monetary in RFM_SEGMENTS[:-1]
+    ], else_=RFM_SEGMENTS[-1][0])
+
+    columns = ('client_id', 'last_purchase', 'invoice_count', 'monetary_total', 'recency', 'frequency', 'monetary')
+    db.session.execute(db.delete(ClientRfm))
+    db.session.execute(db.insert(ClientRfm).from_select(
+        columns + ('segment',), db.select(*[scored.c[column] for column in columns], segment)
+    ))
+    db.session.commit()
+    return db.session.query(db.func.count(ClientRfm.client_id)).scalar()
+
+def pair_counts(condition):
+    """Invoices per pair of products sold on them, for the pairs whose lines
+    a (smaller product id) and b match condition(a, b).
+
+    Archiving moves whole invoices, so the live and archived lines are
+    paired separately, each off its (invoice_id, jeans_id) index, and added up.
+    """
+    counts = []
+    for model in (InvoiceItem, InvoiceItemHistory):
+        a, b = db.aliased(model), db.aliased(model)
+        counts.append(
+            db.select(a.jeans_id.label('jeans_id'), b.jeans_id.label('other_jeans_id'),
+                      db.func.count(db.distinct(a.invoice_id)).label('invoice_count'))
+            .join(b, db.and_(b.invoice_id == a.invoice_id, b.jeans_id > a.jeans_id))
+            .where(a.sale_date.is_not(None), b.sale_date.is_not(None), condition(a, b))
+            .group_by(a.jeans_id, b.jeans_id)
+        )
+    pairs = db.union_all(*counts).subquery()
+    return db.select(pairs.c.jeans_id, pairs.c.other_jeans_id, db.func.sum(pairs.c.invoice_count))\
+        .group_by(pairs.c.jeans_id, pairs.c.other_jeans_id)
+
+def store_pairs(stale, *conditions):
+    """Replace the stale pairs with the counts of the pairs matching
+    conditions, which must not overlap, in one transaction."""
+    db.session.execute(db.delete(ProductPair).where(stale))
+    for condition in conditions:
+        db.session.execute(db.insert(ProductPair).from_select(
+            ('jeans_id', 'other_jeans_id', 'invoice_count'), pair_counts(condition)
+        ))
+    db.session.commit()
+
+def refresh_all_pairs():
+    """Recount every pair, ANALYTICS_CHUNK_PRODUCTS products at a time.
+
+    Each chunk replaces the pairs whose smaller id falls in it in one short
+    transaction, so sales are not held up and the report never sees a half
+    empty table. Returns the number of products covered.
+    """
+    last_id = max(
+        db.session.query(db.func.max(Jeans.id)).scalar() or 0,
+        db.session.query(db.func.max(InvoiceItem.jeans_id)).scalar() or 0,
+        db.session.query(db.func.max(InvoiceItemHistory.jeans_id)).scalar() or 0,
+    )
+    for low in range(0, last_id + 1, ANALYTICS_CHUNK_PRODUCTS):
+        high = low + ANALYTICS_CHUNK_PRODUCTS - 1
+        store_pairs(ProductPair.jeans_id.between(low, high), lambda a, b: a.jeans_id.between(low, high))
+    db.session.execute(db.delete(ProductPair).where(ProductPair.jeans_id > last_id))
+    db.session.commit()
+    return last_id
+
+def changed_products(run):
+    """Products sold, returned or synced since run, from the stock ledger,
+    the invoice lines added after it and the ones deleted or voided."""
+    moved = db.select(StockMovement.jeans_id).where(
+        StockMovement.id > run.last_movement_id, StockMovement.movement_type.in_(('sale', 'return', 'sync')))
+    added = db.select(InvoiceItem.jeans_id).where(InvoiceItem.id > run.last_item_id, InvoiceItem.jeans_id.is_not(None))
+    removed = db.select(RemovedInvoiceLine.jeans_id).where(RemovedInvoiceLine.id > (run.last_removal_id or 0))
+    return sorted(db.session.scalars(db.union(moved, added, removed)))
+
+def run_analytics(full=False):
+    """Refresh the RFM scores and the bought-together counts and record the run.
+
+    Pairs are recounted only for the products that changed since the last
+    run; any pair whose count changed has one of them on an invoice that
+    changed. The change feeds are read up to where they stood when the run
+    started, so changes made during it are picked up by the next one.
+    """
+    started = time.perf_counter()
+    last_run = AnalyticsRun.query.order_by(AnalyticsRun.id.desc()).first()
+    run = AnalyticsRun(
+        started_at=datetime.utcnow(),
+        last_movement_id=db.session.query(db.func.max(StockMovement.id)).scalar() or 0,
+        last_item_id=db.session.query(db.func.max(InvoiceItem.id)).scalar() or 0,
+        last_removal_id=db.session.query(db.func.max(RemovedInvoiceLine.id)).scalar() or 0,
+    )
+    products = None if full or last_run is None else changed_products(last_run)
+    if products is None or len(products) > ANALYTICS_MAX_INCREMENTAL:
+        run.mode = 'full'
+        run.products = refresh_all_pairs()
+    else:
+        run.mode = 'incremental'
+        run.products = len(products)
+        if products:
+            # Two index searches, by the smaller and by the larger product, instead of an OR that scans
+            store_pairs(db.or_(ProductPair.jeans_id.in_(products), ProductPair.other_jeans_id.in_(products)),
+                        lambda a, b: a.jeans_id.in_(products),
+                        lambda a, b: db.and_(b.jeans_id.in_(products), a.jeans_id.not_in(products)))
+    run.clients = refresh_client_rfm()
+    run.duration_ms = round((time.perf_counter() - started) * 1000, 1)
+    db.session.add(run)
+    db.session.commit()
+    return run
+
+@app.cli.command('analytics')
+@click.option('--full', is_flag=True, help='recount every product pair instead of the changed ones')
+def analytics_command(full):
+    """Refresh the customer segments and bought-together products on the reports page; run from cron."""
+    run = run_analytics(full=full)
+    click.echo(f'{run.mode}: {run.clients} clients scored, pairs of {run.products} products recounted '
+               f'in {run.duration_ms:.0f} ms')
+
+AUDITED_MODELS = (Jeans, JeansStock, Invoice, InvoiceItem, Payment)
+AUDITED_TABLES = {model.__tablename__ for model in AUDITED_MODELS}
+AUDIT_TABLE_NAMES = {'jeans': 'المنتجات', 'jeans_stock': 'المخزون', 'invoice': 'الفواتير',
+                     'invoice_item': 'بنود الفواتير', 'payment': 'المدفوعات'}
+AUDIT_PER_PAGE = 100
+
+def audit_entry(table_name, row_id, operation, changes):
+    username = path = None
+    if has_request_context():
+        path = request.path[:200]
+        if current_user.is_authenticated:
+            username = current_user.username
+    return {'created_at': datetime.utcnow(), 'username': username, 'path': path,
+            'table_name': table_name, 'row_id': row_id, 'operation': operation,
+            'changes': json.dumps(changes, ensure_ascii=False, default=str)}
+
+@event.listens_for(RoutingSession, 'after_flush')
+def capture_audit(session, flush_context):
+    """Note the audited rows this flush changed; they are queued once the
+    transaction commits and dropped if it rolls back."""
+    entries = session.info.setdefault('audit', [])
+    for operation, objs in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for obj in objs:
+            if not isinstance(obj, AUDITED_MODELS):
+                continue
+            if operation == 'update':
+                state = db.inspect(obj)
+                changes = {}
+                for attr in state.mapper.column_attrs:
+                    history = state.attrs[attr.key].history
+                    if history.added and history.deleted:
+                        changes[attr.key] = [encode_value(history.deleted[0]), encode_value(history.added[0])]
+                if not changes:
+                    continue
+            else:
+                changes = row_data(obj)
+            entries.append(audit_entry(obj.__tablename__, obj.id, operation, changes))
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def capture_bulk_audit(orm_execute_state):
+    """Bulk UPDATE/DELETE/INSERT statements skip the flush, so note them here."""
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert):
+        return None
+    table = getattr(orm_execute_state.statement, 'table', None)
+    if table is None or table.name not in AUDITED_TABLES:
+        return None
+    result = orm_execute_state.invoke_statement()
+    entries = orm_execute_state.session.info.setdefault('audit', [])
+    parameters = orm_execute_state.parameters
+    operation = 'insert' if orm_execute_state.is_insert else \
+        'update' if orm_execute_state.is_update else 'delete'
+    if isinstance(parameters, list):
+        # executemany: one entry per row, with the values it was given
+        ids = [row.get('id') for row in parameters]
+        if orm_execute_state.is_insert and orm_execute_state.statement.returning_column_descriptions:
+            # RETURNING carries the new ids; replay the rows for the caller
+            frozen = result.freeze()
+            ids = [row[0] for row in frozen().all()]
+            result = frozen()
+        for row, row_id in zip(parameters, ids):
+            changes = {column: [None, encode_value(value)] for column, value in row.items() if column != 'id'}
+            entries.append(audit_entry(table.name, row_id, operation, changes))
+    else:
+        entries.append(audit_entry(table.name, None, f'bulk_{operation}', {'rows': result.rowcount}))
+    return result
+
+@event.listens_for(RoutingSession, 'after_commit')
+def queue_audit(session):
+    entries = session.info.pop('audit', None)
+    if entries:
+        audit_writer.put(entries)
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def discard_audit(session, previous_transaction):
+    session.info.pop('audit', None)
+
+class AuditWriter:
+    """Writes audit entries from a background thread, in batches.
+
+    Requests only put entries on a bounded queue. When the writer falls
+    that far behind, a commit waits up to PUT_TIMEOUT in all for room and
+    then drops the rest of its entries rather than hold up the counter. Dropped
+    entries, and batches that could not be written, are logged as errors,
+    counted in /metrics and shown on the audit page. Whatever is queued is
+    written on shutdown.
+    """
+    BATCH_SIZE = 500
+    PUT_TIMEOUT = 0.05
+
+    def __init__(self):
+        self.queue = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.engine = None
+        self.dropped = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.queue = self.queue or queue.Queue(maxsize=app.config['AUDIT_QUEUE_SIZE'])
+            self.engine = audit_engine()
+            self.thread = threading.Thread(target=self.run, name='audit-writer', daemon=True)
+            self.thread.start()
+        metrics.register_queue('audit', self.queue.qsize)
+
+    def put(self, entries):
+        self.start()
+        # One deadline for the whole commit, however many entries it made
+        deadline = time.monotonic() + self.PUT_TIMEOUT
+        for index, entry in enumerate(entries):
+            timeout = deadline - time.monotonic()
+            try:
+                self.queue.put(entry, timeout=timeout) if timeout > 0 else self.queue.put_nowait(entry)
+            except queue.Full:
+                self.drop(len(entries) - index, 'the audit queue is full')
+                return
+
+    def drop(self, count, reason):
+        with self.lock:
+            self.dropped += count
+        metrics.increment('audit_entries_dropped_total', count)
+        app.logger.error('Dropped %d audit entries, %s (%d so far)', count, reason, self.dropped)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            entry = self.queue.get()
+            batch = []
+            while entry is not None:
+                batch.append(entry)
+                if len(batch) >= self.BATCH_SIZE:
+                    break
+                try:
+                    entry = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            stopping = entry is None
+            if batch:
+                self.write(batch)
+            for _ in range(len(batch) + stopping):
+                self.queue.task_done()
+
+    def write(self, batch):
+        for attempt in range(3):
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(AuditEntry.__table__.insert(), batch)
+                return
+            except Exception:
+                if attempt == 2:
+                    app.logger.exception('Writing %d audit entries failed', len(batch))
+                    self.drop(len(batch), 'they could not be written')
+                else:
+                    time.sleep(0.5)
+
+    def flush(self):
+        """Block until everything queued so far is written."""
+        if self.queue is not None and self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    def stop(self, timeout=10):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout)
+
+audit_writer = AuditWriter()
+atexit.register(audit_writer.stop)
+
+def audit_database_path():
+    """The file audit entries go to, or None for the main database."""
+    path = app.config['AUDIT_DATABASE']
+    if path == 'main':
+        return None
+    if path:
+        return os.path.abspath(path)
+    url = db.engine.url
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    return f'{os.path.splitext(url.database)[0]}-audit.db'
+
+def audit_engine():
+    """The engine audit entries go to. A new audit file starts with the
+    entries the main database already has."""
+    path = audit_database_path()
+    if not path:
+        return db.engine
+    engine = audit_engines.get(path)
+    if engine is None:
+        new_file = not os.path.exists(path)
+        engine = create_engine(f'sqlite:///{path}')
+        AuditEntry.__table__.create(engine, checkfirst=True)
+        for index in AuditEntry.__table__.indexes:
+            index.create(engine, checkfirst=True)
+        if new_file and db.engine.url.get_backend_name() == 'sqlite':
+            copy_audit_entries(engine, db.engine.url.database)
+        audit_engines[path] = engine
+    return engine
+
+def copy_audit_entries(engine, source):
+    table = AuditEntry.__tablename__
+    columns = ', '.join(column.name for column in AuditEntry.__table__.columns)
+    with engine.connect() as connection:
+        connection.exec_driver_sql('ATTACH DATABASE ? AS source', (source,))
+        if connection.exec_driver_sql("SELECT 1 FROM source.sqlite_master WHERE name = ?", (table,)).first():
+            connection.exec_driver_sql(f'INSERT INTO {table} ({columns}) SELECT {columns} FROM source.{table}')
+            connection.commit()
+        connection.exec_driver_sql('DETACH DATABASE source')
+
+audit_engines = {}
+
+@app.route('/audit')
+@login_required
+@admin_required
+def audit_log():
+    """Audit entries, newest first, filtered on indexed columns and paged by id."""
+    audit = AuditEntry.__table__
+    query = db.select(audit)
+    table_name = request.args.get('table_name')
+    row_id = request.args.get('row_id', type=int)
+    username = request.args.get('username', '').strip()
+    if table_name:
+        query = query.where(audit.c.table_name == table_name)
+        if row_id:
+            query = query.where(audit.c.row_id == row_id)
+    if username:
+        query = query.where(audit.c.username == username)
+    date_from = parse_date(request.args.get('date_from'))
+    if date_from:
+        query = query.where(audit.c.created_at >= date_from)
+    date_to = parse_date(request.args.get('date_to'))
+    if date_to:
+        query = query.where(audit.c.created_at < date_to + timedelta(days=1))
+    before = request.args.get('before', type=int)
+    if before:
+        query = query.where(audit.c.id < before)
+
+    with audit_engine().connect() as connection:
+        entries = connection.execute(query.order_by(audit.c.id.desc()).limit(AUDIT_PER_PAGE + 1)).all()
+    next_before = entries[AUDIT_PER_PAGE - 1].id if len(entries) > AUDIT_PER_PAGE else None
+    entries = [dict(entry._mapping, changes=json.loads(entry.changes or '{}')) for entry in entries[:AUDIT_PER_PAGE]]
+    filters = {key: request.args[key] for key in ('table_name', 'row_id', 'username', 'date_from', 'date_to')
+               if request.args.get(key)}
+    return render_template('audit.html', entries=entries, next_before=next_before, filters=filters,
+                           table_names=AUDIT_TABLE_NAMES,
+                           dropped=sum(snapshot.get('counters', {}).get('audit_entries_dropped_total', 0)
+                                       for snapshot in metrics.collect()),
+                           pending=audit_writer.queue.qsize() if audit_writer.queue else 0)
+
+# Versioned JSON API for the POS and handheld clients. Rows are read with Core
+# selects, never loaded as ORM objects, and sent as arrays under one list of
+# field names: {"fields": [...], "rows": [[...], ...], "next": <id or null>}.
+API_RESOURCES = {
+    'products': Jeans, 'variants': JeansVariant, 'warehouses': Warehouse, 'stock': JeansStock,
+    'clients': Client, 'invoices': Invoice, 'invoice_items': InvoiceItem, 'payments': Payment,
+}
+# Columns each list can be filtered on (?client_id=3); an empty value matches NULL
+API_FILTERS = {
+    'products': ('barcode',),
+    'variants': ('jeans_id', 'size', 'color'),
+    'warehouses': (),
+    'stock': ('jeans_id', 'warehouse_id', 'variant_id'),
+    'clients': ('phone',),
+    'invoices': ('client_id', 'status', 'payment_method'),
+    'invoice_items': ('invoice_id', 'jeans_id'),
+    'payments': ('invoice_id', 'reference'),
+}
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+API_MAX_BATCH = 500
+PAYMENT_METHODS = ('cash', 'visa', 'wallet', 'bank')
+
+class ApiError(Exception):
+    def __init__(self, message, status=400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+@app.errorhandler(ApiError)
+def api_error(error):
+    return jsonify({'error': str(error), **error.details}), error.status
+
+def api_columns(table, fields):
+    """The columns named in ?fields=, id always first; every column without it."""
+    if not fields:
+        return list(table.c)
+    names = ['id'] + [name for name in split_values(fields) if name != 'id']
+    unknown = [name for name in names if name not in table.c]
+    if unknown:
+        raise ApiError(f"unknown fields: {', '.join(unknown)}")
+    return [table.c[name] for name in names]
+
+def api_value(column, text):
+    if text == '':
+        return None
+    try:
+        return column.type.python_type(text)
+    except ValueError:
+        raise ApiError(f'bad value for {column.name}: {text}')
+
+def api_ids(text):
+    try:
+        ids = [int(value) for value in split_values(text)]
+    except ValueError:
+        raise ApiError('ids must be numbers')
+    if len(ids) > API_MAX_BATCH:
+        raise ApiError(f'at most {API_MAX_BATCH} ids per request')
+    return ids
+
+def api_rows(columns, rows, next_after=None):
+    """Serialize Core rows; only date columns need converting, so the other
+    rows are sent as the tuples the driver returned."""
+    dates = [index for index, column in enumerate(columns) if isinstance(column.type, (db.DateTime, db.Date))]
+    if dates:
+        rows = [[encode_value(value) if index in dates else value for index, value in enumerate(row)]
+                for row in rows]
+    else:
+        rows = [tuple(row) for row in rows]
+    return jsonify({'fields': [column.name for column in columns], 'rows': rows, 'next': next_after})
+
+def api_batch():
+    rows = (request.get_json(silent=True) or {}).get('rows')
+    if not isinstance(rows, list) or not rows:
+        raise ApiError('expected {"rows": [...]}')
+    if len(rows) > API_MAX_BATCH:
+        raise ApiError(f'at most {API_MAX_BATCH} rows per request')
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            raise ApiError('each row must be an object', row=index)
+    return rows
+
+def api_number(row, index, name, kind=float, required=True):
+    value = row.get(name)
+    if value is None and not required:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or kind is int and value != int(value):
+        raise ApiError(f'{name} must be a number', row=index)
+    return kind(value)
+
+@app.route('/api/v1/<resource>')
+@login_required
+@query_budget(3)
+def api_list(resource):
+    """?ids=1,2,3 reads a batch in one query; otherwise rows are paged by
+    id (?after=<next>&limit=) and filtered on API_FILTERS."""
+    if resource not in API_RESOURCES:
+        raise ApiError(f'unknown resource: {resource}', 404)
+    table = API_RESOURCES[resource].__table__
+    columns = api_columns(table, request.args.get('fields'))
+    query = db.select(*columns)
+
+    if request.args.get('ids'):
+        rows = db.session.execute(query.where(table.c.id.in_(api_ids(request.args['ids']))).order_by(table.c.id))
+        return api_rows(columns, rows.all())
+
+    for name in API_FILTERS[resource]:
+        if name in request.args:
+            value = api_value(table.c[name], request.args[name])
+            query = query.where(table.c[name].is_(None) if value is None else table.c[name] == value)
+    after = request.args.get('after', type=int)
+    if after:
+        query = query.where(table.c.id > after)
+    limit = max(1, min(request.args.get('limit', API_PAGE_SIZE, type=int), API_MAX_PAGE_SIZE))
+    rows = db.session.execute(query.order_by(table.c.id).limit(limit + 1)).all()
+    next_after = rows[limit - 1][0] if len(rows) > limit else None
+    return api_rows(columns, rows[:limit], next_after)
+
+@app.route('/api/v1/clients', methods=['POST'])
+@login_required
+def api_create_clients():
+    """Insert {"rows": [{name, phone, location?, gender?}, ...]} with one statement."""
+    clients = []
+    for index, row in enumerate(api_batch()):
+        if not str(row.get('name') or '').strip() or not str(row.get('phone') or '').strip():
+            raise ApiError('name and phone are required', row=index)
+        clients.append({'name': str(row['name']).strip(), 'phone': str(row['phone']).strip(),
+                        'location': row.get('location'), 'gender': row.get('gender'),
+                        'date_added': datetime.utcnow()})
+    ids = db.session.scalars(db.insert(Client).returning(Client.id, sort_by_parameter_order=True), clients).all()
+    log_changes(Client, 'insert', ids)
+    db.session.commit()
+    return jsonify({'ids': ids}), 201
+
+@app.route('/api/v1/payments', methods=['POST'])
+@login_required
+def api_create_payments():
+    """Record {"rows": [{client_id, amount, payment_method, reference?, notes?}, ...]},
+    each paying off the client's oldest open invoices like the debtors page.
+
+    A reference that was recorded before fails the batch, so a client can
+    safely resend one it never got an answer for.
+    """
+    rows = api_batch()
+    known = set(db.session.scalars(db.select(Client.id).where(Client.id.in_(
+        [row.get('client_id') for row in rows if isinstance(row.get('client_id'), int)]))))
+    references = [row['reference'] for row in rows if row.get('reference')]
+    seen = set(db.session.scalars(db.select(Payment.reference).where(Payment.reference.in_(references))
+                                  .union(db.select(PaymentHistory.reference)
+                                         .where(PaymentHistory.reference.in_(references)))))
+    payments = []
+    for index, row in enumerate(rows):
+        amount = api_number(row, index, 'amount')
+        if row.get('client_id') not in known:
+            raise ApiError(f"unknown client: {row.get('client_id')}", row=index)
+        if amount <= 0:
+            raise ApiError('amount must be positive', row=index)
+        if row.get('payment_method') not in PAYMENT_METHODS:
+            raise ApiError(f"payment_method must be one of {', '.join(PAYMENT_METHODS)}", row=index)
+        if row.get('reference') in seen:
+            raise ApiError(f"already recorded: {row['reference']}", 409, row=index)
+        if row.get('reference'):
+            seen.add(row['reference'])
+        payments.append({'client_id': row['client_id'], 'amount': amount, 'payment_method': row['payment_method'],
+                         'notes': row.get('notes') or '', 'reference': row.get('reference') or None})
+    leftover = allocate_payments(payments)
+    db.session.commit()
+    return jsonify({'leftover': leftover}), 201
+
+def api_stock_lines(rows):
+    """Validate the invoice lines of a checkout batch and find their stock
+    rows and prices, for all of the batch at once.
+
+    Returns a list of lines per invoice: (stock row, price, quantity).
+    Raises ApiError (409) when the batch needs more stock than there is.
+    """
+    wanted = []
+    for index, row in enumerate(rows):
+        items = row.get('items')
+        if not isinstance(items, list) or not items:
+            raise ApiError('items are required', row=index)
+        for item in items:
+            if not isinstance(item, dict):
+                raise ApiError('each item must be an object', row=index)
+            wanted.append((index, api_number(item, index, 'jeans_id', int),
+                           api_number(item, index, 'warehouse_id', int),
+                           api_number(item, index, 'variant_id', int, required=False),
+                           api_number(item, index, 'quantity', int)))
+
+    places = list({(jeans_id, warehouse_id) for _, jeans_id, warehouse_id, _, _ in wanted})
+    stocks = {}
+    for stock in JeansStock.query.filter(db.tuple_(JeansStock.jeans_id, JeansStock.warehouse_id).in_(places)):
+        stocks.setdefault((stock.jeans_id, stock.warehouse_id), {})[stock.variant_id] = stock
+    prices = dict(db.session.execute(db.select(Jeans.id, Jeans.price)
+                                     .where(Jeans.id.in_([jeans_id for _, jeans_id, _, _, _ in wanted]))).all())
+
+    lines = [[] for _ in rows]
+    taken = Counter()
+    for index, jeans_id, warehouse_id, variant_id, quantity in wanted:
+        if jeans_id not in prices:
+            raise ApiError(f'unknown product: {jeans_id}', row=index)
+        if quantity <= 0:
+            raise ApiError('quantity must be positive', row=index)
+        variants = stocks.get((jeans_id, warehouse_id), {})
+        stock = variants.get(variant_id)
+        if stock is None and variant_id is None and len(variants) == 1:
+            # A product stocked as a single variant sells without picking it
+            stock = next(iter(variants.values()))
+        available = (stock.quantity or 0) - taken[stock] if stock else 0
+        if quantity > available:
+            raise ApiError(f'only {available} in stock of product {jeans_id}', 409, row=index, available=available)
+        taken[stock] += quantity
+        lines[index].append((stock, prices[jeans_id], quantity))
+    return lines
+
+def take_stock(sold):
+    """Take {stock row: quantity} off the stock rows. Each UPDATE only
+    applies while the row still holds that much, so two checkouts can't
+    both sell the last pieces. Raises ApiError (409), with nothing taken,
+    when another checkout got there first."""
+    for stock, quantity in sold.items():
+        taken = db.session.execute(
+            db.update(JeansStock)
+              .where(JeansStock.id == stock.id, JeansStock.quantity >= quantity)
+              .values(quantity=JeansStock.quantity - quantity)
+              .execution_options(synchronize_session=False)
+        ).rowcount
+        if not taken:
+            db.session.rollback()
+            available = db.session.scalar(db.select(JeansStock.quantity).where(JeansStock.id == stock.id)) or 0
+            raise ApiError(f'only {available} in stock of product {stock.jeans_id}', 409, available=available)
+    for stock in sold:
+        db.session.expire(stock, ['quantity'])
+    log_changes(JeansStock, 'update', [stock.id for stock in sold],
+                {stock.id: -quantity for stock, quantity in sold.items()})
+
+@app.route('/api/v1/invoices', methods=['POST'])
+@login_required
+def api_create_invoices():
+    """Check out {"rows": [{client_id, items: [{jeans_id, warehouse_id,
+    variant_id?, quantity}], paid?, payment_method?}, ...]}.
+
+    Stock and prices for the whole batch come from one query each, and
+    nothing is written unless every line is in stock. The invoices and
+    lines are ORM objects so the sync and audit hooks see them; the stock
+    is taken by take_stock(), which writes its own ledger rows.
+    """
+    rows = api_batch()
+    known = set(db.session.scalars(db.select(Client.id).where(Client.id.in_(
+        [row.get('client_id') for row in rows if isinstance(row.get('client_id'), int)]))))
+    for index, row in enumerate(rows):
+        if row.get('client_id') not in known:
+            raise ApiError(f"unknown client: {row.get('client_id')}", row=index)
+        if row.get('payment_method', 'cash') not in PAYMENT_METHODS:
+            raise ApiError(f"payment_method must be one of {', '.join(PAYMENT_METHODS)}", row=index)
+    lines = api_stock_lines(rows)
+    amounts = []
+    for index, row in enumerate(rows):
+        total = sum(to_piastres(price * quantity) for _, price, quantity in lines[index])
+        paid = to_piastres(api_number(row, index, 'paid', required=False))
+        if paid < 0 or paid > total:
+            raise ApiError('paid must be between 0 and the invoice total', row=index)
+        amounts.append((total, paid))
+    sold = Counter()
+    for invoice_lines in lines:
+        for stock, _, quantity in invoice_lines:
+            sold[stock] += quantity
+    take_stock(sold)
+
+    now = datetime.now()
+    invoices = []
+    for index, row in enumerate(rows):
+        total, paid = amounts[index]
+        status = 'paid' if paid == total else 'partial' if paid else 'pending'
+        invoices.append(Invoice(
+            invoice_number=f'INV-{now:%Y%m%d%H%M%S%f}-{index + 1}', client_id=row['client_id'], date=now,
+            total_amount=total / 100, paid_amount=paid / 100, remaining_amount=(total - paid) / 100,
+            payment_method=row.get('payment_method', 'cash'), payment_status=status, status=status,
+        ))
+    db.session.add_all(invoices)
+    db.session.flush()
+
+    movements = []
+    for index, invoice in enumerate(invoices):
+        for stock, price, quantity in lines[index]:
+            db.session.add(InvoiceItem(
+                invoice_id=invoice.id, jeans_id=stock.jeans_id, warehouse_id=stock.warehouse_id,
+                variant_id=stock.variant_id, quantity=quantity, price=price, subtotal=price * quantity,
+            ))
+            movements.append({
+                'jeans_id': stock.jeans_id, 'warehouse_id': stock.warehouse_id, 'variant_id': stock.variant_id,
+                'movement_type': 'sale', 'reference': f'invoice:{invoice.id}',
+                'delta': -quantity, 'created_at': datetime.utcnow()
+            })
+        if invoice.paid_amount:
+            db.session.add(Payment(invoice_id=invoice.id, amount=invoice.paid_amount,
+                                   payment_method=invoice.payment_method, notes=''))
+    db.session.execute(StockMovement.__table__.insert(), movements)
+    db.session.commit()
+
+    columns = [Invoice.__table__.c[name] for name in ('id', 'invoice_number', 'total_amount', 'remaining_amount')]
+    response = api_rows(columns, [[getattr(invoice, column.name) for column in columns] for invoice in invoices])
+    return response, 201
+
 def initialize_database():
     with app.app_context():
         db.create_all()
@@ -1161,10 +4737,10 @@ def initialize_database():
         if not admin:
             admin = User(
                 username='admin',
-                password='admin1234',
                 is_admin=True,
                 role='owner'
             )
+            admin.set_password('admin1234')
             db.session.add(admin)
         
         # Create default settings if not exists
@@ -1187,6 +4763,10 @@ def initialize_database():
             db.session.add(main_warehouse)
             
         db.session.commit()
+
+        # Stock that predates the ledger is only known from a first snapshot
+        if not StockSnapshot.query.first():
+            take_stock_snapshot()
 if __name__ == '__main__':
     initialize_database()
     
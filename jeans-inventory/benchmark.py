@@ -0,0 +1,345 @@
+"""Drive every route through the Flask test client and record a baseline.
+
+    python sample_data.py --database bench.db --scale medium
+    python benchmark.py --database bench.db --output baseline.json
+    # ...change code...
+    python benchmark.py --database bench.db --compare baseline.json
+
+For each route the run records median and p95 latency, the number of SQL
+queries (from the Server-Timing header) and the peak Python memory
+allocated while serving it. --compare exits non-zero when a route got
+slower or ran more queries than the baseline allows. --throughput also
+times reading the rows of the list pages through the JSON API instead,
+and --auth the per-request cost of loading the logged-in user. Unless
+--read-only is given, the run also seeds and cancels a batch of
+--cancel-batch invoices (default 1,000) through /invoices/cancel.
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+# Endpoints that destroy data or sessions, or only serve files
+SKIPPED_ENDPOINTS = {'static', 'logout', 'delete', 'export_database'}
+
+# Sample values for URL arguments, filled from the seeded database
+URL_ARGUMENTS = {
+    'invoice_id': 'Invoice',
+    'client_id': 'Client',
+    'warehouse_id': 'Warehouse',
+    'id': 'Jeans',
+    'jeans_id': 'Jeans',
+}
+
+# Writes worth timing, run after the read-only routes; each returns the request kwargs
+def write_requests(samples):
+    return {
+        'POST new_invoice': dict(method='POST', path='/invoice/create',
+                            data={'client_id': samples['Client']}),
+        'POST add_invoice_item': dict(method='POST', path=f"/invoice/{samples['Invoice']}/add_item",
+                                 data={'jeans_id': samples['stock'][0], 'warehouse_id': samples['stock'][1],
+                                       'quantity': 1}),
+        'POST add_payment': dict(method='POST', path=f"/invoice/{samples['Invoice']}/add_payment",
+                            data={'amount': 1, 'payment_method': 'cash'}),
+    }
+
+# List pages and the /api/v1 reads that return the same rows, for --throughput:
+# (name, HTML page, API list, model whose rows the page lists, most rows the page shows)
+THROUGHPUT_ROUTES = (
+    ('stock', '/inventory', '/api/v1/stock?fields=jeans_id,warehouse_id,variant_id,quantity', 'JeansStock', None),
+    ('clients', '/clients', '/api/v1/clients?fields=name,phone,location', 'Client', None),
+    ('invoices', '/invoices?per_page=200',
+     '/api/v1/invoices?fields=invoice_number,client_id,date,total_amount,remaining_amount,status', 'Invoice', 200),
+)
+API_PAGE_LIMIT = 1000
+# A page that does little else than authenticate, for --auth
+AUTH_PROBE_PATH = '/api/v1/warehouses?fields=name'
+
+
+def sample_ids():
+    import app as inventory
+    samples = {}
+    for model_name in set(URL_ARGUMENTS.values()):
+        model = getattr(inventory, model_name)
+        samples[model_name] = inventory.db.session.query(inventory.db.func.max(model.id)).scalar()
+    stock = inventory.JeansStock.query.order_by(inventory.JeansStock.quantity.desc()).first()
+    samples['stock'] = (stock.jeans_id, stock.warehouse_id) if stock else (None, None)
+    return samples
+
+
+def read_requests(flask_app, samples):
+    requests = {}
+    for rule in flask_app.url_map.iter_rules():
+        if rule.endpoint in SKIPPED_ENDPOINTS or 'GET' not in rule.methods:
+            continue
+        values = {}
+        for argument in rule.arguments:
+            if argument == 'period':
+                values[argument] = 'month'
+            elif URL_ARGUMENTS.get(argument) and samples[URL_ARGUMENTS[argument]]:
+                values[argument] = samples[URL_ARGUMENTS[argument]]
+            else:
+                break
+        else:
+            with flask_app.test_request_context():
+                from flask import url_for
+                requests.setdefault(rule.endpoint, dict(method='GET', path=url_for(rule.endpoint, **values)))
+    return requests
+
+
+def query_count(response):
+    match = re.search(r'desc="(\d+) queries"', response.headers.get('Server-Timing', ''))
+    return int(match.group(1)) if match else None
+
+
+def measure(client, method, path, data=None, runs=5):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        response = client.open(path, method=method, data=data)
+        response.get_data()
+        timings.append((time.perf_counter() - started) * 1000)
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    response = client.open(path, method=method, data=data)
+    response.get_data()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        'path': path,
+        'status': response.status_code,
+        'median_ms': round(statistics.median(timings), 2),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2),
+        'queries': query_count(response),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def read_api(client, path, rows):
+    """Page through an API list until rows rows were read; returns the bytes received."""
+    received, read, after = 0, 0, None
+    while read < rows:
+        page = f"{path}&limit={min(API_PAGE_LIMIT, rows - read)}" + (f"&after={after}" if after else '')
+        response = client.get(page)
+        received += len(response.get_data())
+        payload = response.get_json()
+        read += len(payload['rows'])
+        after = payload['next']
+        if after is None:
+            break
+    return received
+
+
+def throughput(client, counts, runs=5):
+    """Median time and rows per second of each list page against the API."""
+    results = {}
+    for name, page, api, model_name, most in THROUGHPUT_ROUTES:
+        rows = min(counts[model_name], most or counts[model_name])
+        timings = {'html': [], 'api': []}
+        for _ in range(runs):
+            started = time.perf_counter()
+            html_bytes = len(client.get(page).get_data())
+            timings['html'].append(time.perf_counter() - started)
+            started = time.perf_counter()
+            api_bytes = read_api(client, api, rows)
+            timings['api'].append(time.perf_counter() - started)
+        result = {'rows': rows}
+        for kind, size in (('html', html_bytes), ('api', api_bytes)):
+            seconds = statistics.median(timings[kind])
+            result[kind] = {'median_ms': round(seconds * 1000, 2), 'kib': round(size / 1024, 1),
+                            'rows_per_s': round(rows / seconds) if seconds else None}
+        results[name] = result
+        print(f"{name:<10} {rows:>7} rows  html {result['html']['median_ms']:9.1f} ms "
+              f"{result['html']['kib']:9.1f} KiB  api {result['api']['median_ms']:9.1f} ms "
+              f"{result['api']['kib']:9.1f} KiB  x{result['html']['median_ms'] / max(result['api']['median_ms'], 0.01):.1f}")
+    return results
+
+
+def seed_invoices(count, samples):
+    """Insert count open invoices of two lines each from the most stocked product; returns their ids."""
+    import app as inventory
+    db = inventory.db
+    jeans_id, warehouse_id = samples['stock']
+    now = datetime.now()
+    invoice_ids = db.session.scalars(db.insert(inventory.Invoice).returning(
+        inventory.Invoice.id, sort_by_parameter_order=True), [
+        {'invoice_number': f'BENCH-{now:%Y%m%d%H%M%S%f}-{index}', 'client_id': samples['Client'], 'date': now,
+         'total_amount': 200.0, 'paid_amount': 0.0, 'remaining_amount': 200.0, 'status': 'pending'}
+        for index in range(count)
+    ]).all()
+    db.session.execute(db.insert(inventory.InvoiceItem), [
+        {'invoice_id': invoice_id, 'jeans_id': jeans_id, 'warehouse_id': warehouse_id, 'quantity': 1,
+         'price': 100.0, 'subtotal': 100.0, 'sale_date': now}
+        for invoice_id in invoice_ids for _ in range(2)
+    ])
+    db.session.commit()
+    return invoice_ids
+
+
+def measure_cancel(flask_app, client, samples, count, runs=5):
+    """Time cancelling count freshly seeded invoices in one request, runs times."""
+    timings, response = [], None
+    for run_number in range(runs + 1):
+        with flask_app.app_context():
+            invoice_ids = seed_invoices(count, samples)
+        if run_number == runs:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        response = client.post('/invoices/cancel', data={'invoice_ids': [str(i) for i in invoice_ids]})
+        elapsed = (time.perf_counter() - started) * 1000
+        if run_number < runs:
+            timings.append(elapsed)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        'path': f'/invoices/cancel ({count} invoices)',
+        'status': response.status_code,
+        'median_ms': round(statistics.median(timings), 2),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2),
+        'queries': query_count(response),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def auth_overhead(flask_app, client, runs):
+    """Time AUTH_PROBE_PATH with the user loaded on every request, then from the per-worker cache."""
+    from app import principal_cache
+    ttl = flask_app.config['AUTH_CACHE_TTL']
+    results = {}
+    for name, value in (('uncached', 0), ('cached', ttl or 300)):
+        flask_app.config['AUTH_CACHE_TTL'] = value
+        principal_cache.clear()
+        results[name] = measure(client, 'GET', AUTH_PROBE_PATH, runs=runs)
+        print(f"auth {name:<10} {results[name]['median_ms']:9.2f} ms  {results[name]['queries']} queries")
+    flask_app.config['AUTH_CACHE_TTL'] = ttl
+    return results
+
+
+def print_result(endpoint, result):
+    print(f"{endpoint:<28} {result['status']}  {result['median_ms']:9.1f} ms  "
+          f"{result['queries'] if result['queries'] is not None else '-':>5} queries  "
+          f"{result['peak_kib']:10.1f} KiB")
+
+
+def run(args):
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(args.database)}'
+    os.environ['SQL_PROFILING'] = '1'
+    from app import app, db, initialize_database, Invoice, InvoiceItem, Client, Jeans, JeansStock
+
+    initialize_database()
+    # Broken routes are recorded as 500s instead of aborting the run
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    app.logger.disabled = True
+    client = app.test_client()
+    client.post('/login', data={'username': args.username, 'password': args.password})
+
+    with app.app_context():
+        samples = sample_ids()
+        dataset = {model.__tablename__: model.query.count() for model in (Jeans, Client, Invoice, InvoiceItem)}
+        counts = {model.__name__: model.query.count() for model in (JeansStock, Client, Invoice)}
+
+    routes = {}
+    requests = read_requests(app, samples)
+    if not args.read_only:
+        requests.update(write_requests(samples))
+    for endpoint, spec in requests.items():
+        if args.only and endpoint not in args.only:
+            continue
+        result = measure(client, spec['method'], spec['path'], spec.get('data'), runs=args.runs)
+        routes[endpoint] = result
+        print_result(endpoint, result)
+    endpoint = 'POST cancel_invoices'
+    if not args.read_only and args.cancel_batch and samples['Client'] and samples['stock'][0] \
+            and (not args.only or endpoint in args.only):
+        routes[endpoint] = measure_cancel(app, client, samples, args.cancel_batch, runs=args.runs)
+        print_result(endpoint, routes[endpoint])
+
+    extra = {}
+    if args.throughput:
+        print()
+        extra['throughput'] = throughput(client, counts, runs=args.runs)
+    if args.auth:
+        print()
+        extra['auth'] = auth_overhead(app, client, runs=max(args.runs, 200))
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'meta': {'commit': commit, 'date': datetime.now().isoformat(timespec='seconds'),
+                 'runs': args.runs, 'dataset': dataset},
+        'routes': routes,
+        **extra,
+    }
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """Print per-route changes against baseline; return the regressed endpoints."""
+    regressions = []
+    print(f"\n{'endpoint':<28} {'baseline':>10} {'now':>10} {'ratio':>7}  queries")
+    for endpoint, now in results['routes'].items():
+        before = baseline['routes'].get(endpoint)
+        if not before:
+            continue
+        ratio = now['median_ms'] / before['median_ms'] if before['median_ms'] else 1.0
+        more_queries = (now['queries'] or 0) > (before['queries'] or 0)
+        slower = ratio > tolerance and now['median_ms'] - before['median_ms'] > min_delta_ms
+        flag = ' <-- regression' if slower or more_queries else ''
+        if flag:
+            regressions.append(endpoint)
+        print(f"{endpoint:<28} {before['median_ms']:10.1f} {now['median_ms']:10.1f} {ratio:7.2f}  "
+              f"{before['queries']} -> {now['queries']}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', required=True, help='seeded SQLite file (see sample_data.py)')
+    parser.add_argument('--runs', type=int, default=5, help='timed requests per route')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='baseline JSON from an earlier run')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='allowed median slowdown against the baseline (ratio)')
+    parser.add_argument('--min-delta', type=float, default=5.0,
+                        help='ignore slowdowns smaller than this many milliseconds')
+    parser.add_argument('--only', nargs='*', help='benchmark only these endpoints')
+    parser.add_argument('--read-only', action='store_true', help='skip the POST routes')
+    parser.add_argument('--cancel-batch', type=int, default=1000,
+                        help='invoices seeded and cancelled per timed /invoices/cancel request (0 skips it)')
+    parser.add_argument('--throughput', action='store_true',
+                        help='also compare reading the list pages with the JSON API')
+    parser.add_argument('--auth', action='store_true',
+                        help='also time a cheap page with and without the logged-in user cache')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin1234')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_delta)
+        if regressions:
+            print(f"\n{len(regressions)} route(s) regressed: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
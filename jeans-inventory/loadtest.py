@@ -0,0 +1,293 @@
+"""Concurrent point-of-sale load test against a real server process.
+
+    python sample_data.py --database bench.db --scale small
+    python loadtest.py --database bench.db --cashiers 8 --office 2 --duration 60
+
+Each cashier thread logs in and loops the checkout flow
+(new_invoice -> add_invoice_item x k -> add_payment) while office threads
+browse reports and debtors. The run reports throughput, latency
+percentiles per step and error classes, then checks the database for
+invariant violations: negative stock, invoice totals that do not match
+their lines, and stock that moved without a matching invoice line.
+
+The database is copied to a scratch file first unless --in-place is given.
+Run once with and once without --report-snapshot to see how much the
+office's report scans slow the cashiers down.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, defaultdict
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(database, port, report_snapshot=False):
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{database}')
+    if report_snapshot:
+        env['REPORT_SNAPSHOT'] = '1'
+    server = subprocess.Popen(
+        [sys.executable, '-c',
+         'from app import app, initialize_database\n'
+         'initialize_database()\n'
+         f'app.run(host="127.0.0.1", port={port}, threaded=True)'],
+        cwd=BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1).close()
+            return server
+        except (urllib.error.URLError, OSError):
+            if server.poll() is not None:
+                break
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('server did not start')
+
+
+class Session:
+    """One logged-in user with its own cookie jar, recording every request."""
+
+    def __init__(self, base_url, stats, timeout):
+        self.base_url = base_url
+        self.stats = stats
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def request(self, step, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        started = time.perf_counter()
+        try:
+            with self.opener.open(self.base_url + path, body, timeout=self.timeout) as response:
+                response.read()
+                final_url = response.geturl()
+        except urllib.error.HTTPError as e:
+            self.stats.record(step, time.perf_counter() - started, f'HTTP {e.code}')
+            return None
+        except (urllib.error.URLError, OSError) as e:
+            reason = getattr(e, 'reason', e)
+            self.stats.record(step, time.perf_counter() - started, type(reason).__name__)
+            return None
+        self.stats.record(step, time.perf_counter() - started)
+        return final_url
+
+    def login(self, username, password):
+        return self.request('login', '/login', {'username': username, 'password': password})
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(list)
+        self.errors = Counter()
+        self.flows = 0
+
+    def record(self, step, seconds, error=None):
+        with self.lock:
+            self.latency[step].append(seconds * 1000)
+            if error:
+                self.errors[f'{step}: {error}'] += 1
+
+    def flow_done(self):
+        with self.lock:
+            self.flows += 1
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def cashier(session, rng, products, client_ids, items_per_invoice, stop):
+    while not stop.is_set():
+        data = {'client_id': rng.choice(client_ids)} if client_ids else {'client_name': 'load test', 'client_phone': '0'}
+        edit_url = session.request('new_invoice', '/invoice/create', data)
+        if not edit_url or '/invoice/' not in edit_url:
+            continue
+        invoice_id = urllib.parse.urlparse(edit_url).path.split('/')[2]
+        for _ in range(items_per_invoice):
+            jeans_id, warehouse_id = rng.choice(products)
+            session.request('add_invoice_item', f'/invoice/{invoice_id}/add_item',
+                            {'jeans_id': jeans_id, 'warehouse_id': warehouse_id,
+                             'quantity': rng.choice([1, 1, 2, 3])})
+        session.request('add_payment', f'/invoice/{invoice_id}/add_payment',
+                        {'amount': rng.randrange(50, 500), 'payment_method': rng.choice(['cash', 'visa', 'wallet'])})
+        session.stats.flow_done()
+
+
+def office(session, rng, stop):
+    while not stop.is_set():
+        page = rng.choice(['reports', 'debtors'])
+        session.request(page, f'/{page}')
+
+
+def database_state(path):
+    with sqlite3.connect(path) as conn:
+        return {
+            'stock': conn.execute('SELECT COALESCE(SUM(quantity), 0) FROM jeans_stock').fetchone()[0],
+            'max_invoice_id': conn.execute('SELECT COALESCE(MAX(id), 0) FROM invoice').fetchone()[0],
+        }
+
+
+def check_invariants(path, before):
+    with sqlite3.connect(path) as conn:
+        negative_stock = conn.execute(
+            'SELECT jeans_id, warehouse_id, quantity FROM jeans_stock WHERE quantity < 0'
+        ).fetchall()
+        mismatched_totals = conn.execute('''
+            SELECT invoice.id, invoice.total_amount, COALESCE(SUM(invoice_item.subtotal), 0) AS lines
+            FROM invoice LEFT JOIN invoice_item ON invoice_item.invoice_id = invoice.id
+            WHERE invoice.id > ?
+            GROUP BY invoice.id
+            HAVING ABS(invoice.total_amount - lines) > 0.005
+        ''', (before['max_invoice_id'],)).fetchall()
+        sold = conn.execute('''
+            SELECT COALESCE(SUM(invoice_item.quantity), 0)
+            FROM invoice_item JOIN invoice ON invoice.id = invoice_item.invoice_id
+            WHERE invoice.id > ?
+        ''', (before['max_invoice_id'],)).fetchone()[0]
+        duplicate_numbers = conn.execute('''
+            SELECT invoice_number, COUNT(*) FROM invoice GROUP BY invoice_number HAVING COUNT(*) > 1
+        ''').fetchall()
+    stock_after = database_state(path)['stock']
+    return {
+        'negative_stock': negative_stock,
+        'invoice_total_mismatches': mismatched_totals,
+        'duplicate_invoice_numbers': duplicate_numbers,
+        'stock_drift': (before['stock'] - stock_after) - sold,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', required=True, help='seeded SQLite file (see sample_data.py)')
+    parser.add_argument('--in-place', action='store_true', help='run against the file itself, not a copy')
+    parser.add_argument('--cashiers', type=int, default=4)
+    parser.add_argument('--office', type=int, default=1)
+    parser.add_argument('--items', type=int, default=3, help='add_invoice_item calls per invoice')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run')
+    parser.add_argument('--hot-products', type=int, default=20,
+                        help='sell only the N best stocked products, to force contention')
+    parser.add_argument('--timeout', type=float, default=30, help='per-request timeout in seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin1234')
+    parser.add_argument('--report-snapshot', action='store_true',
+                        help='serve reports from the read-only snapshot instead of the live database')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    args = parser.parse_args(argv)
+
+    workdir = None
+    database = os.path.abspath(args.database)
+    if not args.in_place:
+        workdir = tempfile.mkdtemp(prefix='loadtest-')
+        database = os.path.join(workdir, 'loadtest.db')
+        shutil.copy2(args.database, database)
+
+    with sqlite3.connect(database) as conn:
+        products = conn.execute(
+            'SELECT jeans_id, warehouse_id FROM jeans_stock WHERE quantity > 0 ORDER BY quantity DESC LIMIT ?',
+            (args.hot_products,)
+        ).fetchall()
+        client_ids = [row[0] for row in conn.execute('SELECT id FROM client ORDER BY random() LIMIT 1000')]
+    if not products:
+        parser.error('the database has no stock to sell; seed it with sample_data.py first')
+
+    before = database_state(database)
+    port = free_port()
+    server = start_server(database, port, args.report_snapshot)
+    stats = Stats()
+    stop = threading.Event()
+    threads = []
+    try:
+        base_url = f'http://127.0.0.1:{port}'
+        for i in range(args.cashiers + args.office):
+            session = Session(base_url, stats, args.timeout)
+            session.login(args.username, args.password)
+            rng = random.Random(args.seed + i)
+            if i < args.cashiers:
+                target = (cashier, (session, rng, products, client_ids, args.items, stop))
+            else:
+                target = (office, (session, rng, stop))
+            threads.append(threading.Thread(target=target[0], args=target[1], daemon=True))
+
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join(args.timeout)
+        elapsed = time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait(10)
+
+    invariants = check_invariants(database, before)
+    requests_total = sum(len(values) for values in stats.latency.values())
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key not in ('password', 'output')},
+        'elapsed_s': round(elapsed, 1),
+        'checkouts': stats.flows,
+        'checkouts_per_s': round(stats.flows / elapsed, 2),
+        'requests_per_s': round(requests_total / elapsed, 2),
+        'latency_ms': {
+            step: {'count': len(values),
+                   'p50': round(percentile(values, 0.50), 1),
+                   'p95': round(percentile(values, 0.95), 1),
+                   'p99': round(percentile(values, 0.99), 1)}
+            for step, values in sorted(stats.latency.items())
+        },
+        'errors': dict(stats.errors.most_common()),
+        'invariants': invariants,
+    }
+
+    print(f"{report['checkouts']} checkouts in {report['elapsed_s']} s "
+          f"({report['checkouts_per_s']}/s, {report['requests_per_s']} requests/s)")
+    print(f"\n{'step':<20} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for step, row in report['latency_ms'].items():
+        print(f"{step:<20} {row['count']:>7} {row['p50']:>9} {row['p95']:>9} {row['p99']:>9}")
+    print('\nerrors:' if report['errors'] else '\nerrors: none')
+    for error, count in report['errors'].items():
+        print(f'  {count:>6}  {error}')
+    print('\ninvariants:')
+    print(f"  negative stock rows:        {len(invariants['negative_stock'])}")
+    print(f"  invoice total mismatches:   {len(invariants['invoice_total_mismatches'])}")
+    print(f"  duplicate invoice numbers:  {len(invariants['duplicate_invoice_numbers'])}")
+    print(f"  stock drift (units):        {invariants['stock_drift']}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    violated = (invariants['negative_stock'] or invariants['invoice_total_mismatches']
+                or invariants['duplicate_invoice_numbers'] or invariants['stock_drift'])
+    return 1 if violated else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
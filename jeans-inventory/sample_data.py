@@ -1,14 +1,220 @@
-sample_jeans = [
-    {
-        'brand': 'Levi\'s',
-        'image_url': 'https://example.com/levis-501.jpg'
-    },
-    {
-        'brand': 'Wrangler',
-        'image_url': 'https://example.com/wrangler-classic.jpg'
-    },
-    {
-        'brand': 'Lee',
-        'image_url': 'https://example.com/lee-riders.jpg'
-    }
-]
+"""Generate a realistic synthetic dataset for load and benchmark runs.
+
+    python sample_data.py --database bench.db --scale production
+
+Rows are written with Core bulk inserts in batches, so even the
+production scale (50k SKUs, 200k clients, 2M invoices) finishes in
+minutes. Point DATABASE_URL / --database at a scratch file; the seeder
+appends to whatever is already there.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+
+SCALES = {
+    'small': dict(skus=500, warehouses=3, clients=1000, invoices=5000, items_per_invoice=3, days=90),
+    'medium': dict(skus=5000, warehouses=8, clients=20000, invoices=200000, items_per_invoice=3, days=365),
+    'production': dict(skus=50000, warehouses=20, clients=200000, invoices=2000000, items_per_invoice=1, days=730),
+}
+
+FIRST_NAMES = ['محمد', 'أحمد', 'محمود', 'مصطفى', 'علي', 'حسن', 'حسين', 'عمر', 'خالد', 'يوسف',
+               'إبراهيم', 'عبدالله', 'طارق', 'سامح', 'هاني', 'فاطمة', 'مريم', 'نور', 'سارة', 'هبة',
+               'آية', 'منى', 'ياسمين', 'دينا', 'رحاب']
+LAST_NAMES = ['المكاوي', 'عبدالرحمن', 'السيد', 'الشريف', 'منصور', 'عثمان', 'فؤاد', 'سليمان',
+              'الجمال', 'النجار', 'حجازي', 'رمضان', 'شاهين', 'زكي', 'بدوي', 'عيسى']
+CITIES = ['القاهرة', 'الجيزة', 'الإسكندرية', 'المنصورة', 'طنطا', 'الزقازيق', 'أسيوط', 'سوهاج',
+          'بورسعيد', 'المحلة الكبرى', 'دمياط', 'المنيا']
+STYLES = ['سليم فيت', 'سكيني', 'ريلاكس', 'مستقيم', 'واسع', 'بوي فريند', 'كارجو', 'ممزق', 'كلاسيك', 'مام جينز']
+FABRICS = ['دنيم', 'ستريتش', 'قطن', 'ليكرا']
+COLORS = ['أزرق', 'أزرق فاتح', 'أزرق غامق', 'أسود', 'رمادي', 'أبيض', 'بيج', 'كحلي']
+SIZES = ['28', '29', '30', '31', '32', '33', '34', '36', '38', '40']
+PAYMENT_METHODS = ['cash', 'visa', 'wallet']
+
+BATCH_SIZE = 20000
+
+
+def next_id(model):
+    from app import db
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+def insert_batches(model, rows):
+    """Insert rows (an iterable of dicts) with executemany in fixed-size batches."""
+    from app import db
+    table = model.__table__
+    batch, total = [], 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            db.session.execute(table.insert(), batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+        total += len(batch)
+    db.session.commit()
+    return total
+
+
+def random_date(rng, now, days):
+    return now - timedelta(seconds=rng.randrange(days * 86400))
+
+
+def seed(scale, rng, log=print):
+    from app import db, Warehouse, Jeans, JeansStock, Client, Invoice, InvoiceItem, Payment, take_stock_snapshot
+
+    now = datetime.now()
+    started = time.perf_counter()
+
+    def report(name, count, since):
+        log(f'{name:<14} {count:>10,} rows  {time.perf_counter() - since:7.1f} s')
+
+    # Warehouses
+    since = time.perf_counter()
+    first_warehouse = next_id(Warehouse)
+    warehouse_ids = list(range(first_warehouse, first_warehouse + scale['warehouses']))
+    report('warehouses', insert_batches(Warehouse, (
+        {'id': warehouse_id, 'name': f'مخزن {warehouse_id}', 'location': rng.choice(CITIES),
+         'description': 'بيانات تجريبية'}
+        for warehouse_id in warehouse_ids
+    )), since)
+
+    # Products and their stock
+    since = time.perf_counter()
+    first_jeans = next_id(Jeans)
+    jeans_ids = list(range(first_jeans, first_jeans + scale['skus']))
+    prices = {}
+
+    def jeans_rows():
+        for jeans_id in jeans_ids:
+            prices[jeans_id] = float(rng.randrange(150, 900, 5))
+            size_from = rng.randrange(0, 5)
+            yield {
+                'id': jeans_id,
+                'name': f'{rng.choice(STYLES)} {rng.choice(FABRICS)} {jeans_id}',
+                'barcode': f'SKU{jeans_id:08d}',
+                'sizes': ','.join(SIZES[size_from:size_from + rng.randrange(3, 6)]),
+                'colors': ','.join(rng.sample(COLORS, rng.randrange(1, 4))),
+                'price': prices[jeans_id],
+                'quantity': 0,
+                'pieces_per_dozen': 12,
+                'dozens_per_package': rng.choice([4, 5, 6, 8]),
+                'date_added': random_date(rng, now, scale['days'])
+            }
+    report('jeans', insert_batches(Jeans, jeans_rows()), since)
+
+    since = time.perf_counter()
+    stocked = {}
+
+    def stock_rows():
+        for jeans_id in jeans_ids:
+            warehouses = rng.sample(warehouse_ids, min(len(warehouse_ids), rng.randrange(1, 4)))
+            stocked[jeans_id] = warehouses
+            for warehouse_id in warehouses:
+                yield {'jeans_id': jeans_id, 'warehouse_id': warehouse_id, 'quantity': rng.randrange(0, 600)}
+    report('jeans_stock', insert_batches(JeansStock, stock_rows()), since)
+
+    # Clients
+    since = time.perf_counter()
+    first_client = next_id(Client)
+    client_count = scale['clients']
+    report('clients', insert_batches(Client, (
+        {'id': client_id,
+         'name': f'{rng.choice(FIRST_NAMES)} {rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+         'phone': f'01{rng.choice("0125")}{rng.randrange(10 ** 7, 10 ** 8)}',
+         'location': rng.choice(CITIES),
+         'gender': rng.choice(['male', 'female']),
+         'date_added': random_date(rng, now, scale['days'])}
+        for client_id in range(first_client, first_client + client_count)
+    )), since)
+
+    # Invoices, their items and payments, generated together so the
+    # totals of every invoice match its lines and payments
+    since = time.perf_counter()
+    first_invoice = next_id(Invoice)
+    first_item = next_id(InvoiceItem)
+    items, payments = [], []
+
+    def invoice_rows():
+        item_id = first_item
+        for invoice_id in range(first_invoice, first_invoice + scale['invoices']):
+            date = random_date(rng, now, scale['days'])
+            total = 0.0
+            for _ in range(max(1, round(rng.expovariate(1 / scale['items_per_invoice'])))):
+                jeans_id = rng.choice(jeans_ids)
+                quantity = rng.choice([1, 1, 2, 3, 6, 12])
+                subtotal = prices[jeans_id] * quantity
+                total += subtotal
+                items.append({'id': item_id, 'invoice_id': invoice_id, 'jeans_id': jeans_id,
+                              'warehouse_id': rng.choice(stocked[jeans_id]), 'quantity': quantity,
+                              'price': prices[jeans_id], 'subtotal': subtotal, 'sale_date': date})
+                item_id += 1
+
+            status = rng.choices(['paid', 'partial', 'pending'], weights=[70, 20, 10])[0]
+            paid = {'paid': total, 'partial': round(total * rng.uniform(0.1, 0.9), 2), 'pending': 0.0}[status]
+            method = rng.choice(PAYMENT_METHODS)
+            if paid:
+                payments.append({'invoice_id': invoice_id, 'amount': paid, 'payment_method': method,
+                                 'payment_date': date + timedelta(minutes=rng.randrange(0, 60 * 24 * 30)),
+                                 'notes': ''})
+            yield {
+                'id': invoice_id,
+                'invoice_number': f'INV-S{invoice_id:08d}',
+                'client_id': rng.randrange(first_client, first_client + client_count),
+                'date': date,
+                'total_amount': total,
+                'paid_amount': paid,
+                'remaining_amount': total - paid,
+                'payment_method': method,
+                'payment_status': status,
+                'status': status
+            }
+
+    # Flush the dependent rows every batch so memory stays flat at 2M invoices
+    count = 0
+    rows = invoice_rows()
+    while batch := list(islice(rows, BATCH_SIZE)):
+        db.session.execute(Invoice.__table__.insert(), batch)
+        for model, pending in ((InvoiceItem, items), (Payment, payments)):
+            if pending:
+                db.session.execute(model.__table__.insert(), pending)
+                pending.clear()
+        count += len(batch)
+        db.session.commit()
+        log(f'  invoices {count:>10,} / {scale["invoices"]:,}')
+    report('invoices', count, since)
+
+    # The seeded stock bypassed the movement ledger, so it becomes the baseline
+    take_stock_snapshot()
+
+    log(f'done in {time.perf_counter() - started:.1f} s')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', help='SQLite file to seed (default: DATABASE_URL or the app database)')
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    for option in SCALES['small']:
+        parser.add_argument(f'--{option.replace("_", "-")}', type=int, dest=option,
+                            help=f'override the {option.replace("_", " ")} of the chosen scale')
+    parser.add_argument('--seed', type=int, default=42, help='random seed, for reproducible datasets')
+    args = parser.parse_args(argv)
+
+    if args.database:
+        os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(args.database)}'
+    from app import app, initialize_database
+
+    scale = dict(SCALES[args.scale])
+    scale.update({option: getattr(args, option) for option in scale if getattr(args, option) is not None})
+
+    initialize_database()
+    with app.app_context():
+        seed(scale, random.Random(args.seed))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
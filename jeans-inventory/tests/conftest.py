@@ -0,0 +1,48 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def load_app(tmp_path, monkeypatch):
+    """Import a fresh copy of app.py on its own database. Settings read at
+    import time, like BRANCH_ID, are passed as environment variables."""
+    monkeypatch.chdir(APP_DIR)
+    loaded = []
+
+    def load(name='inventory', database=None, **env):
+        database = database or tmp_path / f'{name}.db'
+        monkeypatch.setenv('DATABASE_URL', f'sqlite:///{database}')
+        for key in ('BRANCH_ID', 'SYNC_TOKEN', 'AUDIT_DATABASE', 'SQL_PROFILING'):
+            monkeypatch.delenv(key, raising=False)
+        for key, value in env.items():
+            monkeypatch.setenv(key, value)
+        spec = importlib.util.spec_from_file_location(f'{name}_{id(tmp_path)}', os.path.join(APP_DIR, 'app.py'))
+        module = importlib.util.module_from_spec(spec)
+        monkeypatch.setitem(sys.modules, spec.name, module)
+        spec.loader.exec_module(module)
+        module.app.config['TESTING'] = True
+        module.metrics.directory = str(tmp_path / 'metrics')
+        module.initialize_database()
+        loaded.append(module)
+        return module
+
+    yield load
+    for module in loaded:
+        module.audit_writer.stop()
+        with module.app.app_context():
+            module.db.engine.dispose()
+
+
+@pytest.fixture
+def login():
+    def log_in(module, username='admin', password='admin1234'):
+        client = module.app.test_client()
+        response = client.post('/login', data={'username': username, 'password': password})
+        assert response.status_code == 302
+        return client
+    return log_in
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def inventory(load_app):
+    """Products J1 and J2, sold together on one paid invoice, with no stock rows left."""
+    inventory = load_app()
+    with inventory.app.app_context():
+        warehouse = inventory.Warehouse.query.first()
+        products = [inventory.Jeans(name=name, barcode=name, sizes='30', colors='blue', price=100,
+                                    pieces_per_dozen=12, dozens_per_package=5) for name in ('J1', 'J2')]
+        invoice = inventory.Invoice(invoice_number='INV-1', date=datetime.now() - timedelta(days=1),
+                                    total_amount=200, paid_amount=200, remaining_amount=0,
+                                    status='paid', payment_status='paid')
+        inventory.db.session.add_all(products + [invoice])
+        inventory.db.session.flush()
+        inventory.db.session.add_all([
+            inventory.InvoiceItem(invoice_id=invoice.id, jeans_id=jeans.id, warehouse_id=warehouse.id,
+                                  quantity=1, price=100, subtotal=100) for jeans in products
+        ])
+        inventory.db.session.commit()
+        inventory.invoice_id = invoice.id
+        inventory.item_id = inventory.InvoiceItem.query.first().id
+        inventory.run_analytics()
+        assert inventory.ProductPair.query.count() == 1
+    return inventory
+
+
+def pairs_after_next_run(inventory):
+    with inventory.app.app_context():
+        run = inventory.run_analytics()
+        return run.mode, inventory.ProductPair.query.count()
+
+
+def test_deleting_an_archived_invoice_recounts_its_pairs(inventory, login):
+    with inventory.app.app_context():
+        inventory.archive_closed_periods(datetime.now())
+        inventory.db.session.commit()
+        assert inventory.InvoiceItemHistory.query.count() == 2
+    login(inventory).post(f'/invoice/{inventory.invoice_id}/delete')
+    assert pairs_after_next_run(inventory) == ('incremental', 0)
+
+
+def test_deleting_a_line_without_a_stock_row_recounts_its_pairs(inventory, login):
+    login(inventory).post(f'/invoice/{inventory.invoice_id}/delete_item/{inventory.item_id}')
+    assert pairs_after_next_run(inventory) == ('incremental', 0)
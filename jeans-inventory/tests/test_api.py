@@ -0,0 +1,61 @@
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def inventory(load_app, tmp_path):
+    inventory = load_app()
+    with inventory.app.app_context():
+        warehouse = inventory.Warehouse.query.first()
+        jeans = inventory.Jeans(name='J1', barcode='B1', sizes='30', colors='blue', price=100,
+                                pieces_per_dozen=12, dozens_per_package=5)
+        client = inventory.Client(name='C1', phone='1')
+        inventory.db.session.add_all([jeans, client])
+        inventory.db.session.flush()
+        inventory.db.session.add(inventory.JeansStock(jeans_id=jeans.id, warehouse_id=warehouse.id, quantity=5))
+        inventory.db.session.commit()
+        inventory.checkout = {'rows': [{'client_id': client.id, 'items': [
+            {'jeans_id': jeans.id, 'warehouse_id': warehouse.id, 'quantity': 2}]}]}
+    inventory.database = tmp_path / 'inventory.db'
+    return inventory
+
+
+def stock(inventory):
+    with inventory.app.app_context():
+        return (inventory.db.session.scalar(inventory.db.select(inventory.JeansStock.quantity)),
+                inventory.db.session.scalars(inventory.db.select(inventory.StockMovement.delta)
+                                             .where(inventory.StockMovement.movement_type == 'sale')).all())
+
+
+def test_checkout_takes_the_stock_and_records_it(inventory, login):
+    response = login(inventory).post('/api/v1/invoices', json=inventory.checkout)
+    assert response.status_code == 201
+    assert stock(inventory) == (3, [-2])
+
+
+def test_checkout_refuses_stock_sold_since_it_was_checked(inventory, login, monkeypatch):
+    check_lines = inventory.api_stock_lines
+
+    def sold_meanwhile(rows):
+        lines = check_lines(rows)
+        with sqlite3.connect(inventory.database) as other:
+            other.execute('UPDATE jeans_stock SET quantity = 1')
+        return lines
+
+    monkeypatch.setattr(inventory, 'api_stock_lines', sold_meanwhile)
+    response = login(inventory).post('/api/v1/invoices', json=inventory.checkout)
+    assert response.status_code == 409
+    assert response.get_json()['available'] == 1
+    assert stock(inventory) == (1, [])
+    with inventory.app.app_context():
+        assert inventory.Invoice.query.count() == 0
+
+
+def test_checkout_with_an_invalid_payment_takes_no_stock(inventory):
+    inventory.checkout['rows'][0]['paid'] = 1000
+    with inventory.app.test_request_context('/api/v1/invoices', method='POST', json=inventory.checkout):
+        with pytest.raises(inventory.ApiError, match='paid'):
+            inventory.api_create_invoices.__wrapped__()
+        # Still inside the request's transaction
+        assert inventory.db.session.scalar(inventory.db.select(inventory.JeansStock.quantity)) == 5
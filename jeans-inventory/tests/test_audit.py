@@ -0,0 +1,83 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+
+def add_product(inventory, name='J1'):
+    with inventory.app.app_context():
+        inventory.db.session.add(inventory.Jeans(name=name, sizes='30', colors='blue', price=100,
+                                                 pieces_per_dozen=12, dozens_per_package=5))
+        inventory.db.session.commit()
+    inventory.audit_writer.flush()
+
+
+def audit_count(path):
+    with sqlite3.connect(path) as connection:
+        return connection.execute('SELECT COUNT(*) FROM audit_log').fetchone()[0]
+
+
+def test_audit_entries_default_to_their_own_file(load_app, tmp_path):
+    inventory = load_app()
+    add_product(inventory)
+    assert audit_count(tmp_path / 'inventory-audit.db') == 1
+    assert audit_count(tmp_path / 'inventory.db') == 0
+
+
+def test_new_audit_file_starts_with_the_main_database_entries(load_app, tmp_path):
+    inventory = load_app(AUDIT_DATABASE='main')
+    add_product(inventory)
+    assert audit_count(tmp_path / 'inventory.db') == 1
+
+    inventory.app.config['AUDIT_DATABASE'] = None
+    with inventory.app.app_context():
+        inventory.audit_engine()
+    assert audit_count(tmp_path / 'inventory-audit.db') == 1
+
+
+def test_dropped_audit_entries_are_reported(load_app, caplog):
+    inventory = load_app()
+    writer = inventory.AuditWriter()
+    writer.queue = queue.Queue(maxsize=1)
+    writer.queue.put({})
+    # A writer that is stuck, so the queue stays full
+    stuck = threading.Event()
+    writer.thread = threading.Thread(target=stuck.wait)
+    writer.thread.start()
+    try:
+        with inventory.app.app_context(), caplog.at_level(logging.ERROR):
+            writer.put([{}, {}])
+    finally:
+        stuck.set()
+
+    assert writer.dropped == 2
+    assert 'Dropped 2 audit entries' in caplog.text
+    body = inventory.app.test_client().get('/metrics').get_data(as_text=True)
+    assert 'audit_entries_dropped_total 2' in body
+
+
+def test_a_commit_waits_for_a_slow_writer_only_once(load_app):
+    inventory = load_app()
+    writer = inventory.AuditWriter()
+    writer.queue = queue.Queue(maxsize=1)
+    writer.queue.put({})
+    # A writer that takes one entry every 20 ms
+    done = threading.Event()
+
+    def slow():
+        while not done.wait(0.02):
+            writer.queue.get()
+
+    writer.thread = threading.Thread(target=slow)
+    writer.thread.start()
+    try:
+        with inventory.app.app_context():
+            started = time.monotonic()
+            writer.put([{}] * 100)
+            elapsed = time.monotonic() - started
+    finally:
+        done.set()
+
+    assert elapsed < 0.5
+    assert writer.dropped > 90
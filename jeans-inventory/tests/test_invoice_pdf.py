@@ -0,0 +1,44 @@
+def rename(inventory, model, name):
+    with inventory.app.app_context():
+        model.query.one().name = name
+        inventory.db.session.commit()
+
+
+def test_renaming_the_client_or_product_renders_the_pdf_again(load_app, login, tmp_path):
+    inventory = load_app()
+    inventory.PDF_CACHE_DIR = str(tmp_path / 'pdf_cache')
+    with inventory.app.app_context():
+        jeans = inventory.Jeans(name='J1', sizes='30', colors='blue', price=100,
+                                pieces_per_dozen=12, dozens_per_package=5)
+        client = inventory.Client(name='C1', phone='1')
+        invoice = inventory.Invoice(invoice_number='INV-1', client=client, total_amount=100)
+        inventory.db.session.add_all([jeans, client, invoice])
+        inventory.db.session.flush()
+        inventory.db.session.add(inventory.InvoiceItem(invoice_id=invoice.id, jeans_id=jeans.id, quantity=1,
+                                                       price=100, subtotal=100))
+        inventory.db.session.commit()
+        invoice_id = invoice.id
+    client = login(inventory)
+
+    def pdf_cache():
+        assert client.get(f'/invoice/{invoice_id}/pdf').status_code == 200
+        return inventory.metrics.caches['invoice_pdf']
+
+    assert pdf_cache() == [0, 1]
+    assert pdf_cache() == [1, 1]
+    rename(inventory, inventory.Client, 'C2')
+    assert pdf_cache() == [1, 2]
+    rename(inventory, inventory.Jeans, 'J2')
+    assert pdf_cache() == [1, 3]
+    assert len(list((tmp_path / 'pdf_cache').iterdir())) == 1
+
+
+def test_pruning_skips_files_another_worker_removed(load_app, tmp_path, monkeypatch):
+    inventory = load_app()
+    inventory.PDF_CACHE_DIR = str(tmp_path / 'pdf_cache')
+    inventory.PDF_CACHE_MAX_FILES = 0
+    listdir = inventory.os.listdir
+    # Files listed, then removed by another worker before we get to them
+    monkeypatch.setattr(inventory.os, 'listdir', lambda path: listdir(path) + ['invoice-1-old.pdf', 'batch-gone.pdf'])
+
+    assert inventory.cached_pdf('invoice-1-new', lambda: b'%PDF', stale_prefix='invoice-1-') == b'%PDF'
@@ -0,0 +1,40 @@
+import pytest
+
+
+@pytest.fixture
+def inventory(load_app):
+    """An open invoice and a product with 10 in stock."""
+    inventory = load_app()
+    with inventory.app.app_context():
+        warehouse = inventory.Warehouse.query.first()
+        jeans = inventory.Jeans(name='J1', barcode='B1', sizes='30', colors='blue', price=100,
+                                pieces_per_dozen=12, dozens_per_package=5)
+        invoice = inventory.Invoice(invoice_number='INV-1', total_amount=0, paid_amount=0,
+                                    remaining_amount=0, status='pending', payment_status='pending')
+        inventory.db.session.add_all([jeans, invoice])
+        inventory.db.session.flush()
+        inventory.db.session.add(inventory.JeansStock(jeans_id=jeans.id, warehouse_id=warehouse.id, quantity=10))
+        inventory.db.session.commit()
+        inventory.invoice_id = invoice.id
+        inventory.line = {'jeans_id': jeans.id, 'warehouse_id': warehouse.id}
+    return inventory
+
+
+def stock_and_lines(inventory):
+    with inventory.app.app_context():
+        return (inventory.JeansStock.query.one().quantity,
+                [item.quantity for item in inventory.InvoiceItem.query.all()])
+
+
+def test_cancelled_invoice_lines_cannot_be_deleted_or_added(inventory, login):
+    client = login(inventory)
+    client.post(f'/invoice/{inventory.invoice_id}/add_item', data={**inventory.line, 'quantity': 4})
+    assert stock_and_lines(inventory) == (6, [4])
+    client.post('/invoices/cancel', data={'invoice_ids': [inventory.invoice_id]})
+    assert stock_and_lines(inventory) == (10, [4])
+
+    with inventory.app.app_context():
+        item_id = inventory.InvoiceItem.query.one().id
+    client.post(f'/invoice/{inventory.invoice_id}/delete_item/{item_id}')
+    client.post(f'/invoice/{inventory.invoice_id}/add_item', data={**inventory.line, 'quantity': 1})
+    assert stock_and_lines(inventory) == (10, [4])
@@ -0,0 +1,40 @@
+import threading
+from datetime import datetime, timedelta
+
+
+def test_only_one_worker_claims_a_due_run(load_app, tmp_path):
+    workers = [load_app(f'worker{n}', database=tmp_path / 'shop.db') for n in range(4)]
+    for worker in workers:
+        worker.app.config['MAINTENANCE_HOURS'] = '0-24'
+    start, claims = threading.Barrier(len(workers)), []
+
+    def claim(worker):
+        with worker.app.app_context():
+            start.wait()
+            claims.append(worker.claim_maintenance_run('scheduler'))
+
+    threads = [threading.Thread(target=claim, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len([run_id for run_id in claims if run_id is not None]) == 1
+
+    first = workers[0]
+    with first.app.app_context():
+        run_id = next(run_id for run_id in claims if run_id is not None)
+        assert first.run_maintenance('scheduler', force=True, run_id=run_id).status == 'done'
+        assert first.MaintenanceRun.query.count() == 1
+        assert first.claim_maintenance_run('scheduler') is None
+
+
+def test_a_claim_left_running_expires(load_app):
+    inventory = load_app()
+    inventory.app.config['MAINTENANCE_HOURS'] = '0-24'
+    with inventory.app.app_context():
+        run_id = inventory.claim_maintenance_run('scheduler')
+        assert inventory.claim_maintenance_run('scheduler') is None
+        run = inventory.db.session.get(inventory.MaintenanceRun, run_id)
+        run.started_at = datetime.utcnow() - timedelta(hours=2)
+        inventory.db.session.commit()
+        assert inventory.claim_maintenance_run('scheduler') not in (None, run_id)
@@ -0,0 +1,60 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+def worker_snapshot(pid, requests):
+    buckets = [requests] + [0] * 11
+    return {'pid': pid, 'latency': {'dashboard': [buckets, [0.004 * requests, requests]]},
+            'caches': {'invoice_pdf': [2, 1]}, 'in_flight': 1, 'queues': {'audit': 3},
+            'pool': {'size': 5, 'checked_out': 1, 'overflow': 0}}
+
+
+@pytest.fixture
+def other_worker():
+    """A live process standing in for another worker."""
+    process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+    yield process.pid
+    process.kill()
+    process.wait()
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def write_snapshot(directory, snapshot):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f"{snapshot['pid']}.json"), 'w') as f:
+        json.dump(snapshot, f)
+
+
+def test_metrics_add_up_live_workers_and_drop_dead_ones(load_app, other_worker):
+    inventory = load_app()
+    directory = inventory.metrics.directory
+    write_snapshot(directory, worker_snapshot(other_worker, 4))
+    dead = dead_pid()
+    write_snapshot(directory, worker_snapshot(dead, 100))
+
+    body = inventory.app.test_client().get('/metrics').get_data(as_text=True)
+
+    assert 'http_request_duration_seconds_count{endpoint="dashboard"} 4' in body
+    assert 'cache_requests_total{cache="invoice_pdf",result="hit"} 2' in body
+    assert f'db_pool_connections{{pid="{other_worker}",state="size"}} 5' in body
+    assert f'pid="{dead}"' not in body
+    assert not os.path.exists(os.path.join(directory, f'{dead}.json'))
+    assert os.path.exists(os.path.join(directory, f'{other_worker}.json'))
+
+
+def test_worker_removes_its_metrics_file(load_app):
+    inventory = load_app()
+    inventory.metrics.flush(force=True)
+    path = os.path.join(inventory.metrics.directory, f'{os.getpid()}.json')
+    assert os.path.exists(path)
+    inventory.metrics.close()
+    assert not os.path.exists(path)
@@ -0,0 +1,37 @@
+import io
+
+import pytest
+
+
+@pytest.fixture
+def inventory(load_app):
+    """Client C1, phone 1, owing 100 on one invoice."""
+    inventory = load_app()
+    with inventory.app.app_context():
+        client = inventory.Client(name='C1', phone='1')
+        inventory.db.session.add(client)
+        inventory.db.session.flush()
+        inventory.db.session.add(inventory.Invoice(
+            invoice_number='INV-1', client_id=client.id, total_amount=100, paid_amount=0,
+            remaining_amount=100, status='pending', payment_status='pending'))
+        inventory.db.session.commit()
+    return inventory
+
+
+def test_import_rejects_amounts_and_methods_it_cannot_record(inventory):
+    statement = ('phone,amount,payment_method,reference\n'
+                 '1,nan,,R1\n1,inf,,R2\n1,10,cheque,R3\n1,20,,R4\n1,5,Wallet,R5\n').encode()
+    with inventory.app.app_context():
+        result = inventory.import_payments(io.BytesIO(statement))
+        assert [line for line, _ in result['rejected']] == [2, 3, 4]
+        assert sorted(inventory.db.session.query(inventory.Payment.payment_method, inventory.Payment.amount)) == \
+            [('bank', 20.0), ('wallet', 5.0)]
+
+
+def test_import_page_refuses_a_file_that_is_not_utf8(inventory, login):
+    client = login(inventory)
+    response = client.post('/payments/import', data={
+        'payments_file': (io.BytesIO('phone,amount,notes\n1,10,دفعة\n'.encode('cp1256')), 'statement.csv')})
+    assert response.status_code == 302
+    with inventory.app.app_context():
+        assert inventory.Payment.query.count() == 0
@@ -0,0 +1,50 @@
+import pytest
+
+
+@pytest.fixture
+def inventory(load_app):
+    inventory = load_app()
+    inventory.app.config['SQL_PROFILING'] = True
+    return inventory
+
+
+def test_route_budgets_come_from_the_decorator_then_the_config(inventory):
+    assert inventory.query_budget_for('dashboard') == 12
+    assert inventory.query_budget_for('settings') is None
+    inventory.app.config['SQL_QUERY_BUDGETS']['dashboard'] = 20
+    inventory.app.config['SQL_QUERY_BUDGET'] = 50
+    assert inventory.query_budget_for('dashboard') == 20
+    assert inventory.query_budget_for('settings') == 50
+
+
+def test_route_over_its_budget_fails_under_testing(inventory, login):
+    client = login(inventory)
+    response = client.get('/dashboard')
+    assert response.status_code == 200
+    assert 'queries' in response.headers['Server-Timing']
+
+    inventory.app.config['SQL_QUERY_BUDGETS']['dashboard'] = 1
+    with pytest.raises(inventory.QueryBudgetExceeded, match='dashboard ran'):
+        client.get('/dashboard')
+
+
+def test_route_over_its_budget_only_warns_outside_testing(inventory, login, caplog):
+    client = login(inventory)
+    inventory.app.config['SQL_QUERY_BUDGETS']['dashboard'] = 1
+    inventory.app.config['TESTING'] = False
+    assert client.get('/dashboard').status_code == 200
+    assert 'dashboard ran' in caplog.text
+
+
+def test_streamed_route_counts_the_queries_of_its_body(inventory, login):
+    client = login(inventory)
+    client.get('/clients').get_data()
+    response = client.get('/clients')
+    assert 'before streaming' in response.headers['Server-Timing']
+    before_streaming = int(response.headers['Server-Timing'].split('desc="')[1].split()[0])
+    response.get_data()
+
+    inventory.app.config['SQL_QUERY_BUDGETS']['list_clients'] = before_streaming
+    response = client.get('/clients')
+    with pytest.raises(inventory.QueryBudgetExceeded, match='list_clients ran'):
+        response.get_data()
@@ -0,0 +1,77 @@
+import time
+from datetime import datetime
+
+import pytest
+
+
+@pytest.fixture
+def cairo_time(monkeypatch):
+    monkeypatch.setenv('TZ', 'EET-2')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_stock_history_days_are_local_days(load_app, login, cairo_time):
+    inventory = load_app()
+    with inventory.app.app_context():
+        jeans = inventory.Jeans(name='J1', sizes='30', colors='blue', price=100,
+                                pieces_per_dozen=12, dozens_per_package=5)
+        inventory.db.session.add(jeans)
+        inventory.db.session.flush()
+        jeans_id = jeans.id
+        inventory.db.session.add(inventory.JeansStock(jeans_id=jeans_id, warehouse_id=1, quantity=5))
+        inventory.db.session.commit()
+        inventory.StockSnapshot.query.update({'taken_at': datetime(2026, 3, 1)})
+        # 01:30 on the 11th in Cairo
+        inventory.StockMovement.query.update({'created_at': datetime(2026, 3, 10, 23, 30)})
+        inventory.db.session.commit()
+    client = login(inventory)
+
+    assert 'J1' not in client.get('/stock/history?date=2026-03-10').get_data(as_text=True)
+    page = client.get(f'/stock/history?date=2026-03-11&jeans_id={jeans_id}').get_data(as_text=True)
+    assert 'J1' in page
+    assert '2026-03-11 01:30' in page
+
+
+def test_stock_without_a_snapshot_walks_back_from_the_live_stock(load_app):
+    inventory = load_app()
+    with inventory.app.app_context():
+        inventory.StockSnapshot.query.delete()
+        jeans = inventory.Jeans(name='J1', sizes='30', colors='blue', price=100,
+                                pieces_per_dozen=12, dozens_per_package=5)
+        inventory.db.session.add(jeans)
+        inventory.db.session.flush()
+        inventory.db.session.add(inventory.JeansStock(jeans_id=jeans.id, warehouse_id=1, quantity=10))
+        inventory.db.session.commit()
+        inventory.StockMovement.query.update({'created_at': datetime(2026, 3, 10)})
+        inventory.db.session.commit()
+
+        assert inventory.stock_on(datetime.utcnow()) == {(jeans.id, 1): 10}
+        assert inventory.stock_on(datetime(2026, 3, 9)) == {}
+
+
+def test_product_edit_labels_counted_stock_apart_from_received_stock(load_app, login):
+    inventory = load_app()
+    with inventory.app.app_context():
+        jeans = inventory.Jeans(name='J1', barcode='B1', sizes='30,32', colors='blue', price=100,
+                                pieces_per_dozen=12, dozens_per_package=5)
+        inventory.db.session.add(jeans)
+        inventory.db.session.flush()
+        inventory.sync_variants(jeans)
+        inventory.db.session.flush()
+        first, second = sorted(variant.id for variant in jeans.variants)
+        stock = inventory.JeansStock(jeans_id=jeans.id, warehouse_id=1, variant_id=first, quantity=5)
+        inventory.db.session.add(stock)
+        inventory.db.session.commit()
+        form = {'barcode': 'B1', 'name': 'J1', 'sizes': '30,32', 'colors': 'blue', 'price': '100',
+                'pieces_per_dozen': '12', 'dozens_per_package': '5', f'quantity_{stock.id}': '7',
+                'new_variant_id': second, 'new_warehouse_id': 1, 'new_quantity': 3}
+        jeans_id = jeans.id
+
+    login(inventory).post(f'/update/{jeans_id}', data=form)
+    with inventory.app.app_context():
+        movements = inventory.db.session.query(inventory.StockMovement.movement_type, inventory.StockMovement.delta)\
+            .order_by(inventory.StockMovement.id).all()
+    assert movements[-2:] == [('adjustment', 2), ('receipt', 3)]
@@ -0,0 +1,122 @@
+import shutil
+
+import pytest
+
+
+@pytest.fixture
+def branches(load_app, tmp_path):
+    """Branches A and B, both copied from one database that was in use
+    before either had a branch id."""
+    shared = load_app('shared')
+    with shared.app.app_context():
+        warehouse = shared.Warehouse.query.first()
+        jeans = shared.Jeans(name='J1', barcode='B1', sizes='30', colors='blue', price=100,
+                             pieces_per_dozen=12, dozens_per_package=5)
+        client = shared.Client(name='C1', phone='1')
+        invoice = shared.Invoice(invoice_number='INV-OLD', client=client)
+        shared.db.session.add_all([jeans, client, invoice])
+        shared.db.session.flush()
+        shared.db.session.add_all([
+            shared.JeansStock(jeans_id=jeans.id, warehouse_id=warehouse.id, quantity=50),
+            shared.InvoiceItem(invoice_id=invoice.id, jeans_id=jeans.id, warehouse_id=warehouse.id,
+                               quantity=2, price=100, subtotal=200)
+        ])
+        shared.db.session.commit()
+        shared.db.engine.dispose()
+    for name in ('a', 'b'):
+        shutil.copy(tmp_path / 'shared.db', tmp_path / f'{name}.db')
+    return (load_app('a', BRANCH_ID='A', SYNC_TOKEN='t'),
+            load_app('b', BRANCH_ID='B', SYNC_TOKEN='t'))
+
+
+def peer_call(caller, peer):
+    """Requests from caller's sync_with to peer, through peer's test client."""
+    client = peer.app.test_client()
+    headers = {'Authorization': 'Bearer t'}
+
+    def call(path, payload=None):
+        if payload is None:
+            response = client.get(path, headers=headers)
+        else:
+            response = client.post(path, json=payload, headers=headers)
+        if response.status_code >= 400:
+            raise caller.SyncError(response.get_json()['error'])
+        return response.get_json()
+    return call
+
+
+def sell(branch, login, quantity, invoice_number=None):
+    with branch.app.app_context():
+        jeans_id = branch.Jeans.query.filter_by(barcode='B1').one().id
+        warehouse_id = branch.Warehouse.query.first().id
+        client_id = branch.Client.query.filter_by(name='C1').one().id
+        if invoice_number:
+            invoice = branch.Invoice(invoice_number=invoice_number, client_id=client_id)
+            branch.db.session.add(invoice)
+            branch.db.session.commit()
+            invoice_id = invoice.id
+    client = login(branch)
+    if not invoice_number:
+        invoice_id = int(client.post('/invoice/create', data={'client_id': client_id}).headers['Location'].split('/')[2])
+    response = client.post(f'/invoice/{invoice_id}/add_item',
+                           data={'jeans_id': jeans_id, 'warehouse_id': warehouse_id, 'quantity': quantity})
+    assert response.status_code == 302
+
+
+def state(branch):
+    with branch.app.app_context():
+        return {
+            'stock': [(stock.jeans_id and stock.jeans.barcode, stock.warehouse_id and stock.warehouse.name, stock.quantity)
+                      for stock in branch.JeansStock.query],
+            'invoices': {invoice.invoice_number for invoice in branch.Invoice.query},
+            'items': sorted((item.invoice.invoice_number, item.jeans.barcode, item.quantity)
+                            for item in branch.InvoiceItem.query if item.jeans_id),
+            'orphan_items': branch.InvoiceItem.query.filter(branch.InvoiceItem.jeans_id.is_(None)).count(),
+            'payments': [(payment.invoice.invoice_number, payment.amount) for payment in branch.Payment.query],
+        }
+
+
+def test_branches_copied_from_one_database_sync_both_ways(branches, login):
+    a, b = branches
+    sell(a, login, 3)
+    sell(a, login, 1, invoice_number='INV-DUP')
+    sell(b, login, 5, invoice_number='INV-DUP')
+    with a.app.app_context():
+        old_invoice_id = a.Invoice.query.filter_by(invoice_number='INV-OLD').one().id
+    login(a).post(f'/invoice/{old_invoice_id}/add_payment', data={'amount': 10, 'payment_method': 'cash'})
+
+    with a.app.app_context():
+        branch_id, mapped, pulled, pushed = a.sync_with(peer_call(a, b))
+    assert branch_id == 'B' and mapped > 0 and pulled > 0 and pushed > 0
+
+    state_a, state_b = state(a), state(b)
+    assert state_a['stock'] == state_b['stock'] == [('B1', 'Main Warehouse', 41)]
+    assert state_a['orphan_items'] == state_b['orphan_items'] == 0
+    assert {'INV-OLD', 'INV-DUP', 'INV-DUP-B'} <= state_a['invoices']
+    assert {'INV-OLD', 'INV-DUP', 'INV-DUP-A'} <= state_b['invoices']
+    assert len(state_a['invoices']) == len(state_b['invoices']) == 4
+    assert sorted(quantity for *_, quantity in state_a['items']) == \
+        sorted(quantity for *_, quantity in state_b['items']) == [1, 2, 3, 5]
+    assert state_a['payments'] == state_b['payments'] == [('INV-OLD', 10)]
+
+    # Nothing is sent twice, and each side agrees on what the other applied
+    with a.app.app_context():
+        assert a.sync_with(peer_call(a, b))[1:] == (0, 0, 0)
+        pushed_seq = a.SyncPeer.query.filter_by(branch_id='B').one().last_pushed_seq
+    with b.app.app_context():
+        assert b.SyncPeer.query.filter_by(branch_id='A').one().last_pulled_seq == pushed_seq
+
+
+def test_change_referring_to_an_unknown_row_is_refused(branches):
+    a, b = branches
+    change = {'seq': 1, 'table': 'jeans_stock', 'op': 'insert', 'origin': 'A', 'key': ['A', 999],
+              'data': {'jeans_id': ['A', 998], 'warehouse_id': ['A', 1], 'variant_id': None,
+                       'quantity': 4, 'quantity_delta': 4}}
+    response = b.app.test_client().post('/sync/changes', json={'branch': 'A', 'changes': [change]},
+                                        headers={'Authorization': 'Bearer t'})
+    assert response.status_code == 409
+    assert 'jeans_stock.jeans_id' in response.get_json()['error']
+    with b.app.app_context():
+        assert b.JeansStock.query.count() == 1
+        peer = b.SyncPeer.query.filter_by(branch_id='A').first()
+        assert peer is None or peer.last_pulled_seq == 0